@@ -0,0 +1,85 @@
+# bench/bench_blocks.py
+# Compresión del crudo en bloques: B/punto en 'blocks' vs B/fila en 'samples',
+# velocidad de compactación y de lectura cruda por tramo.
+#   python -m bench.bench_blocks [minutos_de_datos] [n_real] [n_bool] [n_dint] [hz]
+# Señales sintéticas "de planta" (REAL float32 con ruido, BOOL que conmutan cada
+# pocos s, DINT contadores) con jitter de reloj de ~300 us; valores aleatorios
+# puros (bench_json.make_sample) no comprimen con ningún esquema.
+import os, sys, tempfile, time
+import numpy as np
+from historian.store import connect, ensure_schema
+from historian.rollup import HistorianMaintenance
+from historian.query import HistorianQuery
+
+def signals(n_real, n_bool, n_dint, t):
+    rnd = np.random.default_rng(1)
+    for i in range(n_real):
+        period = rnd.uniform(30, 600)
+        v = 50 + 20 * np.sin(2 * np.pi * t / period + i) + rnd.normal(0, 0.05, len(t))
+        yield "REAL", f"real_{i}", v.astype(np.float32).astype(np.float64)
+    for i in range(n_bool):
+        yield "BOOL", f"bool_{i}", ((t // rnd.uniform(2, 20)) % 2).astype(np.float64)
+    for i in range(n_dint):
+        yield "DINT", f"dint_{i}", np.floor(t * rnd.uniform(0.1, 5)).astype(np.float64)
+
+def main():
+    args = [int(a) for a in sys.argv[1:6]]
+    minutes = args[0] if args else 10
+    shape = args[1:4] or [70, 20, 10]
+    hz = args[4] if len(args) > 4 else 50
+    n = minutes * 60 * hz
+    base = 1_700_000_000.0
+    t = np.arange(n) / hz
+    ts = ((base + t) * 1e9).astype(np.int64) + np.random.default_rng(2).integers(0, 300_000, n)
+    print(f"{n} muestras ({minutes} min a {hz} Hz) x {sum(shape)} tags = {n * sum(shape)} filas")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, "h.db")
+        con = connect(db)
+        ensure_schema(con)
+        con.execute("BEGIN")
+        for tid, (group, name, vals) in enumerate(signals(*shape, t), start=1):
+            con.execute("INSERT INTO tags(id, name, type) VALUES (?, ?, ?)", (tid, f"{group}.{name}", group))
+            con.execute("CREATE TEMP TABLE IF NOT EXISTS x(tag_id, ts, value)")
+            con.executemany("INSERT INTO temp.x VALUES (?, ?, ?)", zip([tid] * n, ts.tolist(), vals.tolist()))
+        # orden de llegada real: todos los tags de una muestra juntos
+        con.execute("INSERT INTO samples(tag_id, ts, value) SELECT tag_id, ts, value FROM temp.x ORDER BY ts, tag_id")
+        con.execute("COMMIT")
+        con.execute("VACUUM")
+        rows = con.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+        raw_bytes = os.path.getsize(db)
+        print(f"samples: {raw_bytes / rows:6.1f} B/fila ({raw_bytes / 1e6:.1f} MB)")
+
+        # ventanas de 1 min para que una corrida corta llene varias (default 600 s)
+        m = HistorianMaintenance(db, block_s=60, block_after_s=0)
+        m._open()
+        t0 = time.perf_counter()
+        while m.rollup_step():
+            pass
+        t1 = time.perf_counter()
+        while m.compact_step() or m._pending_compact():
+            pass
+        t2 = time.perf_counter()
+        print(f"rollup    : {rows / (t1 - t0):10.0f} filas/s")
+        print(f"compactar : {m.compacted_rows / (t2 - t1):10.0f} filas/s  ({m.blocks_written} bloques)")
+
+        for typ, cnt, nbytes in con.execute(
+                "SELECT tags.type, SUM(n), SUM(length(blocks.ts) + length(vals)) "
+                "FROM blocks JOIN tags ON tags.id = blocks.tag_id GROUP BY 1"):
+            print(f"  {typ:<5} {nbytes / cnt:6.2f} B/punto")
+        blk = m.block_bytes / max(1, m.compacted_rows)
+        con.execute("VACUUM")
+        left = con.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+        size = os.path.getsize(db)
+        print(f"bloques   : {blk:6.2f} B/punto (x{raw_bytes / rows / blk:.0f})  "
+              f"base tras VACUUM {size / 1e6:.1f} MB (x{raw_bytes / size:.1f}, {left} filas sin compactar)")
+        con.close()
+
+        q = HistorianQuery(db, workers=1)
+        t0 = time.perf_counter()
+        pts = sum(len(part["t"]) for part in q._raw(1, int(base * 1e9), int((base + minutes * 60) * 1e9), 5000))
+        dt = time.perf_counter() - t0
+        print(f"lectura   : {pts / dt:10.0f} puntos/s (1 tag, {pts} puntos, JSON-listo)")
+
+if __name__ == "__main__":
+    main()
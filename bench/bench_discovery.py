@@ -0,0 +1,62 @@
+# bench/bench_discovery.py
+# Tiempo hasta el primer endpoint: probe secuencial (como antes: TCP uno por uno
+# y después connect completo uno por uno) vs probe_first_alive (por etapas, en paralelo).
+#   python -m bench.bench_discovery [n_muertos] [n_filtrados] [prefijo_scan]
+# Levanta un server OPC UA local (python-opcua) al final de la lista; los "muertos"
+# son puertos cerrados en loopback (RST inmediato) y los "filtrados" direcciones
+# TEST-NET que no responden (agotan el timeout TCP). Al final, scan de 127.0.0.0/prefijo
+# con plc/scanner.py (en loopback todo responde al instante: mide CPU por host).
+import ipaddress, logging, socket, sys, time
+from opcua import Server
+from plc.discovery import _probe_opcua, _probe_tcp_host, _split_url, probe_first_alive
+from plc.scanner import scan
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def sequential(urls, user="", password=""):
+    t0 = time.perf_counter()
+    fast = [u for u in urls if _probe_tcp_host(*_split_url(u))]
+    for u in fast:
+        if _probe_opcua(u, user=user, password=password)[0] == "OK":
+            return u, time.perf_counter() - t0
+    return None, time.perf_counter() - t0
+
+def main():
+    args = [int(a) for a in sys.argv[1:4]]
+    n_dead = args[0] if args else 60
+    n_filtered = args[1] if len(args) > 1 else 8
+    prefix = args[2] if len(args) > 2 else 20
+    logging.getLogger("opcua").setLevel(logging.ERROR)
+
+    port = free_port()
+    srv = Server()
+    srv.set_endpoint(f"opc.tcp://127.0.0.1:{port}")
+    srv.start()
+    try:
+        urls = [f"opc.tcp://127.0.0.1:{free_port()}" for _ in range(n_dead)]
+        urls += [f"opc.tcp://192.0.2.{i + 1}:4840" for i in range(n_filtered)]
+        urls.append(f"opc.tcp://127.0.0.1:{port}")
+        print(f"{len(urls)} candidatos: {n_dead} cerrados, {n_filtered} filtrados, 1 server al final")
+
+        url, dt = sequential(urls, "user", "pass")
+        print(f"secuencial        {dt * 1000:8.0f} ms  -> {url}")
+        for label, user in (("por etapas (any)", None), ("por etapas (auth)", "user")):
+            res = probe_first_alive(urls, user=user, password="pass")
+            print(f"{label:<17} {res['elapsed_ms']:8.0f} ms  -> {res['url']}  "
+                  f"(tcp {res['tcp_ok']}, opcua {res['opcua_ok']}, login {res['auth_ok']})")
+
+        net = ipaddress.IPv4Network(f"127.0.0.0/{prefix}")
+        for rate in (10000, 0):
+            t0 = time.perf_counter()
+            found = scan([net], port, rate=rate)
+            dt = time.perf_counter() - t0
+            print(f"scan {net} (rate {rate or 'sin tope'}): {dt * 1000:6.0f} ms  "
+                  f"{(net.num_addresses - 2) / dt:8.0f} hosts/s  -> {found}")
+    finally:
+        srv.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# bench/bench_excel_logger.py
+# Throughput del ExcelLogger (armado de filas + escritura de la hoja), sin cola ni hilo.
+#   python -m bench.bench_excel_logger [n_rows] [n_real] [n_bool] [n_dint]
+import queue, sys, tempfile, time
+from utils.excel_logger import ExcelLogger
+from bench.bench_json import make_sample
+
+def run(name, samples, n_rows, **opts):
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            lg = ExcelLogger(queue.Queue(), path_template=tmp + "/bench_{date}.xlsx",
+                             rotate_rows=0, rotate_bytes=0, **opts)
+        except TypeError as e:   # opción que esta versión no tiene
+            print(f"{name:<32} (no soportado: {e})")
+            return None
+        batch = 200
+        t0 = time.perf_counter()
+        done = 0
+        while done < n_rows:
+            chunk = [samples[(done + i) % len(samples)] for i in range(batch)]
+            lg._flush(chunk)
+            done += batch
+        dt = time.perf_counter() - t0
+        xml = lg._wb.bytes_written
+        lg._rotate("bench")
+        lg._finalizer.drain(timeout=120)
+    print(f"{name:<32} {done/dt:9.0f} filas/s  {dt/done*1e6:8.1f} us/fila  {xml/done:8.0f} B/fila (xml)")
+    return done / dt
+
+def main():
+    args = [int(a) for a in sys.argv[1:5]]
+    n_rows = args[0] if args else 20000
+    shape = args[1:] or [50, 20, 10]
+    samples = [make_sample(*shape, seq=i) for i in range(100)]
+    t = time.time()
+    for i, s in enumerate(samples):
+        s["timestamp"] = t + i * 0.02
+    print(f"{n_rows} filas, muestra = {shape[0]} REAL / {shape[1] if len(shape) > 1 else 200} BOOL / "
+          f"{shape[2] if len(shape) > 2 else 100} DINT")
+    run("default", samples, n_rows)
+    run("raw=off", samples, n_rows, raw_sheet="off")
+    run("raw=zlib", samples, n_rows, raw_sheet="zlib")
+    run("raw=off, ts=datetime", samples, n_rows, raw_sheet="off", ts_format="datetime")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+# bench/bench_historian.py
+# Throughput del historian SQLite (hilo escritor real, cola incluida).
+#   python -m bench.bench_historian [segundos_de_datos] [n_real] [n_bool] [n_dint] [hz]
+import os, sys, tempfile, time
+from historian.store import Historian
+from bench.bench_json import make_sample
+
+def main():
+    args = [int(a) for a in sys.argv[1:6]]
+    secs = args[0] if args else 20
+    shape = args[1:4] or [700, 200, 100]
+    hz = args[4] if len(args) > 4 else 50
+    samples = [make_sample(*shape, seq=i) for i in range(50)]
+    n = secs * hz
+    per_sample = sum(len(v) for v in samples[0].values() if isinstance(v, dict))
+    print(f"{n} muestras ({secs}s a {hz} Hz) x {per_sample} tags = {n * per_sample} filas")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        h = Historian(os.path.join(tmp, "h.db"), queue_max=n + 1)
+        t_base = time.time()
+        for i in range(n):   # se encola todo antes: mide al escritor, no al productor
+            s = dict(samples[i % len(samples)])
+            s["timestamp"] = t_base + i / hz
+            h.ingest(s)
+        t0 = time.perf_counter()
+        h.start()
+        h.stop()
+        h.join()
+        dt = time.perf_counter() - t0
+        st = h.status()
+    rows = st["rows_written"]
+    print(f"{rows / dt:10.0f} filas/s  {n / dt:8.0f} muestras/s  ({dt:.1f}s, x{n / hz / dt:.1f} tiempo real)  "
+          f"{st['db_bytes'] / rows:.1f} B/fila  commits={st['commits']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# bench/bench_json.py
+# Compara el camino actual (json.dumps / send_json) contra utils.fast_json.
+#   python -m bench.bench_json [n_real] [n_bool] [n_dint]
+import json, random, sys, time
+from utils.fast_json import SampleEncoder, orjson
+
+def make_sample(n_real=1000, n_bool=200, n_dint=100, seq=1):
+    rnd = random.Random(seq)
+    return {
+        "REAL":  {f"real_{i}": rnd.uniform(-1e3, 1e3) for i in range(n_real)},
+        "BOOL":  {f"bool_{i}": rnd.random() > 0.5 for i in range(n_bool)},
+        "DINT":  {f"dint_{i}": rnd.randint(-2**31, 2**31 - 1) for i in range(n_dint)},
+        "timestamp": time.time(),
+        "__seq__": seq,
+    }
+
+def bench(name, fn, samples, rounds=7):
+    best = float("inf")
+    for _ in range(rounds):
+        t0 = time.perf_counter()
+        for s in samples:
+            fn(s)
+        best = min(best, time.perf_counter() - t0)
+    per = best / len(samples) * 1e6
+    print(f"{name:<28} {per:9.1f} us/muestra  {len(samples)/best:9.0f} muestras/s")
+    return per
+
+def main():
+    args = [int(a) for a in sys.argv[1:4]]
+    samples = [make_sample(*args, seq=i) for i in range(200)]
+
+    ref = lambda s: json.dumps(s, ensure_ascii=False, separators=(",", ":"))
+    tpl = SampleEncoder(backend="template")
+    for s in samples[:5]:
+        assert json.loads(tpl.encode(s)) == json.loads(ref(s))
+
+    print(f"muestra: {len(ref(samples[0]))} bytes JSON")
+    base = bench("json.dumps (actual)", ref, samples)
+    t = bench("template (fragmentos)", tpl.encode, samples)
+    print(f"  -> x{base / t:.2f} vs actual")
+    if orjson is not None:
+        oj = SampleEncoder(backend="orjson")
+        o = bench("orjson", oj.encode, samples)
+        print(f"  -> x{base / o:.2f} vs actual")
+    else:
+        print("orjson no instalado (pip install orjson)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# bench/bench_subscription.py
+# Notificaciones/s del camino de suscripción de script_excel.py (sin red):
+# Subscription._call_datachange + SubHandler (lock por item, get_browse_name por
+# cambio) vs NotificationBatcher (alias por ClientHandle, un lock por publish).
+#   python -m bench.bench_subscription [n_items] [items_por_publish] [rtt_ms]
+# rtt_ms simula el round trip de get_browse_name() en el camino viejo (0 = cota inferior).
+import logging, sys, time
+from datetime import datetime, timezone
+from threading import Lock
+from opcua import ua
+from opcua.common.subscription import Subscription, SubscriptionItemData
+import script_excel as se
+
+class _Node:
+    def __init__(self, nodeid: ua.NodeId, rtt_s: float):
+        self.nodeid = nodeid
+        self._rtt_s = rtt_s
+
+    def get_browse_name(self):
+        if self._rtt_s:
+            time.sleep(self._rtt_s)
+        return ua.QualifiedName(self.nodeid.Identifier.rsplit(".", 1)[-1], 2)
+
+def publishes(n_items: int, per_publish: int, rounds: int):
+    out = []
+    for r in range(rounds):
+        ts = datetime.now(timezone.utc).replace(tzinfo=None)
+        notif = ua.DataChangeNotification()
+        for k in range(per_publish):
+            item = ua.MonitoredItemNotification()
+            item.ClientHandle = (r * per_publish + k) % n_items + 1
+            item.Value = ua.DataValue(ua.Variant(float(r + k), ua.VariantType.Double))
+            item.Value.SourceTimestamp = ts
+            notif.MonitoredItems.append(item)
+        out.append(notif)
+    return out
+
+def run(name, call, batches):
+    se.insert_queue.clear()
+    t0 = time.perf_counter()
+    for b in batches:
+        call(b)
+    dt = time.perf_counter() - t0
+    n = sum(len(b.MonitoredItems) for b in batches)
+    assert len(se.insert_queue) == n
+    print(f"{name:<28} {n / dt:10.0f} notif/s  {dt / n * 1e6:6.2f} us/notif  "
+          f"CPU a 10k/s: {10_000 * dt / n * 100:5.1f}%")
+
+def main():
+    args = [float(a) for a in sys.argv[1:4]]
+    n_items = int(args[0]) if args else 2000
+    per_publish = int(args[1]) if len(args) > 1 else 500
+    rtt_s = (args[2] if len(args) > 2 else 0.0) / 1000
+    rounds = max(1, 100_000 // per_publish) if not rtt_s else 4
+    logging.getLogger("opcua").setLevel(logging.ERROR)
+
+    nodeids = [ua.NodeId(f"plc/app/Application/sym/PLC_PRG.var_{i}", 2) for i in range(n_items)]
+    batches = publishes(n_items, per_publish, rounds)
+    print(f"{n_items} items, {per_publish} notificaciones por publish, {rounds} publishes")
+
+    # camino viejo: la Subscription base de python-opcua, sin server
+    legacy = Subscription.__new__(Subscription)
+    legacy.logger = logging.getLogger("opcua")
+    legacy._lock = Lock()
+    legacy._handler = se.SubHandler()
+    legacy._monitoreditems_map = {}
+    for h, nid in enumerate(nodeids, start=1):
+        d = SubscriptionItemData()
+        d.client_handle, d.node = h, _Node(nid, rtt_s)
+        legacy._monitoreditems_map[h] = d
+    run("SubHandler (por item)", legacy._call_datachange, batches)
+
+    batcher = se.NotificationBatcher({h: (nid.to_string(), nid.Identifier.rsplit(".", 1)[-1])
+                                      for h, nid in enumerate(nodeids, start=1)})
+    run("NotificationBatcher (lote)", lambda b: batcher.consume(b.MonitoredItems), batches)
+
+if __name__ == "__main__":
+    main()
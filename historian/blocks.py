@@ -0,0 +1,87 @@
+# historian/blocks.py
+import os, zlib
+import numpy as np
+
+HISTORIAN_BLOCK_S = float(os.getenv("HISTORIAN_BLOCK_S", "600"))     # ventana por bloque
+HISTORIAN_BLOCK_ZLIB = int(os.getenv("HISTORIAN_BLOCK_ZLIB", "6"))
+# resolución de tiempo en bloques (ns). 1 = sin pérdida: el crudo compactado devuelve
+# los mismos ts que el de 'samples'. Más grueso es opt-in y redondea al compactar
+# (el jitter sub-ms del reloj es lo que más pesa en delta-of-delta; 1000000 = 1 ms)
+HISTORIAN_BLOCK_TS_RES_NS = max(1, int(os.getenv("HISTORIAN_BLOCK_TS_RES_NS", "1")))
+
+# Bloques comprimidos por tag para el histórico crudo (tabla 'blocks').
+# Misma idea que Gorilla (delta-of-delta en tiempos, XOR entre floats consecutivos)
+# pero a nivel de byte en vez de bit, para que codificar y decodificar sean
+# operaciones NumPy vectorizadas:
+#   ts   : delta-of-delta -> zigzag -> bytes transpuestos (shuffle) -> zlib
+#   xor  : bits float64 XOR anterior -> shuffle -> zlib (ceros largos = comprime)
+#   rle  : corridas (valor uint8, largo uint32) -> zlib; para BOOL / escalones
+# El shuffle agrupa el byte k de todos los valores: los bytes altos casi siempre
+# son 0 y zlib los colapsa.
+
+def _shuffle(u: np.ndarray) -> bytes:
+    return np.ascontiguousarray(u.view(np.uint8).reshape(len(u), 8).T).tobytes()
+
+def _unshuffle(buf: bytes, n: int) -> np.ndarray:
+    return np.frombuffer(buf, dtype=np.uint8).reshape(8, n).T.copy().view(np.uint64).ravel()
+
+def encode_ts(ts: np.ndarray, res: int = 1) -> bytes:
+    """ts int64 (ns, ordenado) en pasos de 'res' ns. El primero va en la columna t0 del bloque."""
+    ts = ts // res
+    delta = np.diff(ts, prepend=ts[:1])
+    dod = np.diff(delta, prepend=np.int64(0))
+    zz = ((dod << 1) ^ (dod >> 63)).view(np.uint64)
+    return zlib.compress(_shuffle(zz), HISTORIAN_BLOCK_ZLIB)
+
+def decode_ts(buf: bytes, n: int, t0: int, res: int = 1) -> np.ndarray:
+    zz = _unshuffle(zlib.decompress(buf), n)
+    dod = (zz >> np.uint64(1)).view(np.int64) ^ -(zz & np.uint64(1)).view(np.int64)
+    return (np.int64(t0 // res) + np.cumsum(np.cumsum(dod))) * np.int64(res)
+
+def encode_xor(vals: np.ndarray) -> bytes:
+    bits = np.ascontiguousarray(vals, dtype=np.float64).view(np.uint64)
+    x = bits ^ np.concatenate((np.zeros(1, np.uint64), bits[:-1]))
+    return zlib.compress(_shuffle(x), HISTORIAN_BLOCK_ZLIB)
+
+def decode_xor(buf: bytes, n: int) -> np.ndarray:
+    return np.bitwise_xor.accumulate(_unshuffle(zlib.decompress(buf), n)).view(np.float64)
+
+def _runs(vals: np.ndarray):
+    code = np.where(np.isnan(vals), 2, vals != 0).astype(np.uint8)   # 0 | 1 | 2 = NULL
+    starts = np.flatnonzero(np.r_[True, code[1:] != code[:-1]])
+    lengths = np.diff(np.r_[starts, len(code)]).astype(np.uint32)
+    return code[starts], lengths
+
+def encode_rle(vals: np.ndarray) -> bytes:
+    code, lengths = _runs(vals)
+    return zlib.compress(np.uint32(len(code)).tobytes() + code.tobytes() + lengths.tobytes(),
+                         HISTORIAN_BLOCK_ZLIB)
+
+def decode_rle(buf: bytes, n: int) -> np.ndarray:
+    raw = zlib.decompress(buf)
+    k = int(np.frombuffer(raw[:4], dtype=np.uint32)[0])
+    code = np.frombuffer(raw[4:4 + k], dtype=np.uint8)
+    lengths = np.frombuffer(raw[4 + k:4 + 5 * k], dtype=np.uint32)
+    out = np.repeat(np.array([0.0, 1.0, np.nan])[code], lengths)
+    return out[:n]
+
+def _is_stepwise(vals: np.ndarray) -> bool:
+    # solo 0/1/NULL y pocas corridas (BOOL, flags): RLE gana
+    finite = vals[~np.isnan(vals)]
+    if not np.all((finite == 0) | (finite == 1)):
+        return False
+    return len(_runs(vals)[0]) * 4 < len(vals)
+
+def encode_block(ts: np.ndarray, vals: np.ndarray, res: int = HISTORIAN_BLOCK_TS_RES_NS):
+    """
+    ts int64 ordenado y vals float64 (NaN = NULL) ->
+    (codec, t0, t1, blob_ts, blob_vals); t0/t1 ya redondeados a 'res'.
+    """
+    codec = "rle" if _is_stepwise(vals) else "xor"
+    t0, t1 = int(ts[0]) // res * res, int(ts[-1]) // res * res
+    return codec, t0, t1, encode_ts(ts, res), encode_rle(vals) if codec == "rle" else encode_xor(vals)
+
+def decode_block(codec: str, n: int, t0: int, res: int, blob_ts: bytes, blob_vals: bytes):
+    ts = decode_ts(blob_ts, n, t0, res)
+    vals = decode_rle(blob_vals, n) if codec == "rle" else decode_xor(blob_vals, n)
+    return ts, vals
@@ -0,0 +1,222 @@
+# historian/excel_export.py
+import os, time, sqlite3, logging, threading
+from datetime import datetime
+from historian.store import HISTORIAN_DB, connect
+from utils.excel_logger import EXCEL_ZIP_LEVEL, _SegmentFinalizer, _first_free_index, _segment_path
+from utils.xlsx_stream import XlsxStreamWriter
+
+log = logging.getLogger("uvicorn")
+
+HISTORIAN_EXCEL = os.getenv("HISTORIAN_EXCEL", "false").lower() == "true"
+HISTORIAN_EXCEL_PATH = os.getenv("HISTORIAN_EXCEL_PATH", "logs/historian/hist_{date}.xlsx")
+HISTORIAN_EXCEL_PERIOD_S = float(os.getenv("HISTORIAN_EXCEL_PERIOD_S", "5"))
+HISTORIAN_EXCEL_FETCH = int(os.getenv("HISTORIAN_EXCEL_FETCH", "50000"))        # filas SQL por página
+HISTORIAN_EXCEL_MAX_ROWS = int(os.getenv("HISTORIAN_EXCEL_MAX_ROWS", "1000000"))  # límite Excel: 1048576
+
+_INT_TYPES = {"SINT", "BYTE", "INT", "UINT", "DINT", "UDINT", "LINT", "ULINT", "WORD", "DWORD"}
+
+class HistorianExcelExporter(threading.Thread):
+    """
+    Vuelca el historian a Excel "ancho" (timestamp + una columna por tag) en forma
+    incremental: recuerda el último rowid exportado, lee solo lo nuevo con una
+    consulta parametrizada, pivotea en streaming (las filas de una muestra son
+    contiguas en rowid) y agrega al XlsxStreamWriter abierto. Costo por pasada
+    = filas nuevas, no tamaño del archivo.
+    El .xlsx se arma al rotar (día / filas / stop) en el finalizador de segmentos,
+    y el manifest guarda el last_rowid de cada segmento para retomar tras reiniciar.
+    Cada flush deja en el journal del segmento y en historian_state (excel_rowid /
+    excel_ts) hasta dónde llegó: tras un crash el segmento se rearma hasta ahí, y la
+    compactación/retención del crudo (historian/rollup.py) no pasa de esa marca.
+    """
+    def __init__(self, db_path: str = HISTORIAN_DB, path_template: str = HISTORIAN_EXCEL_PATH,
+                 period_s: float = HISTORIAN_EXCEL_PERIOD_S, fetch: int = HISTORIAN_EXCEL_FETCH,
+                 max_rows: int = HISTORIAN_EXCEL_MAX_ROWS, zip_level: int = EXCEL_ZIP_LEVEL):
+        super().__init__(name="historian-excel", daemon=True)
+        self.db_path = db_path
+        self.path_template = path_template
+        self.period_s = period_s
+        self.fetch = max(1, fetch)
+        self.max_rows = max_rows
+        self.zip_level = zip_level
+        self._stop_evt = threading.Event()
+
+        folder = os.path.dirname(os.path.normpath(path_template.format(date="x"))) or "."
+        os.makedirs(folder, exist_ok=True)
+        self._finalizer = _SegmentFinalizer(os.path.join(folder, "manifest.json"))
+        self._finalizer.recover_open()   # segmento cortado: rearmado hasta su último flush
+        # retoma después del último segmento cerrado o recuperado; lo posterior se re-exporta
+        self.last_rowid = max((e.get("last_rowid") or 0 for e in self._finalizer.segments
+                               if e.get("status") in ("done", "recovered")), default=0)
+        self.last_ts = None               # ts (ns) de la última fila emitida
+        self._saved_rowid = None          # marca ya escrita en historian_state
+        self._wcon: sqlite3.Connection | None = None
+
+        self._con: sqlite3.Connection | None = None
+        self._tags: dict[int, tuple[str, str]] = {}   # tag_id -> (nombre, tipo)
+        self._wb = None
+        self._sheet = None
+        self._date = None
+        self._base = None
+        self._seg_idx = 0
+        self._seg_entry = None
+        self._col: dict[int, int] = {}    # tag_id -> índice en la fila (por segmento)
+        self._conv: list = [None]         # conversión por columna (bool / int / tal cual)
+        self.rows_written = 0             # filas del segmento abierto
+        self.passes = 0
+        self.last_pass_ms = None
+        self.error = None
+
+    def stop(self):
+        self._stop_evt.set()
+
+    # --- segmentos ---
+    def _open_segment(self, date: str):
+        base = os.path.normpath(self.path_template.format(date=date))
+        if base != self._base:
+            self._base = base
+            self._seg_idx = _first_free_index(base) - 1
+        self._date = date
+        self._seg_idx += 1
+        path = _segment_path(base, self._seg_idx)
+        self._wb = XlsxStreamWriter(path, compresslevel=self.zip_level)
+        self._sheet = self._wb.add_sheet("historian", table_name="tbl_historian")
+        self._sheet.header = ["timestamp"]
+        self._sheet.datetime_cols = {1}
+        self._sheet.widths = {1: 24}
+        self._col = {}
+        self._conv = [None]
+        self.rows_written = 0
+        self._seg_entry = {"index": self._seg_idx, "path": path, "date": date,
+                           "started_at": time.time(), "first_rowid": self.last_rowid + 1,
+                           "status": "open"}
+        self._finalizer.opened(self._seg_entry)
+
+    def _rotate(self, reason: str):
+        wb, self._wb = self._wb, None
+        if wb is None:
+            return
+        wb.extra["last_rowid"] = self.last_rowid
+        wb.flush()   # journal completo: si el cierre no llega a terminar, se rearma entero
+        self._finalizer.submit(wb, self._seg_entry, {
+            "ended_at": time.time(), "rows": self.rows_written, "last_rowid": self.last_rowid,
+            "xml_bytes": wb.bytes_written, "reason": reason,
+        })
+
+    def _add_col(self, tag_id: int) -> int:
+        name, typ = self._tags.get(tag_id) or self._load_tag(tag_id)
+        idx = len(self._conv)
+        self._col[tag_id] = idx
+        self._conv.append(bool if typ == "BOOL" else int if typ in _INT_TYPES else None)
+        self._sheet.header.append(name)
+        self._sheet.widths[idx + 1] = max(10, min(len(name) + 2, 40))
+        return idx
+
+    def _load_tag(self, tag_id: int) -> tuple[str, str]:
+        for tid, name, typ in self._con.execute("SELECT id, name, type FROM tags WHERE id >= ?", (tag_id,)):
+            self._tags[tid] = (name, typ or "")
+        return self._tags.setdefault(tag_id, (f"tag_{tag_id}", ""))
+
+    # --- pivot ---
+    def _emit(self, ts_ns: int, cells: list, rowid: int):
+        dt = datetime.fromtimestamp(ts_ns / 1e9)
+        date = dt.strftime("%Y-%m-%d")
+        if self._wb is not None:
+            if date != self._date:
+                self._rotate("day")
+            elif self.max_rows and self.rows_written >= self.max_rows:
+                self._rotate("rows")
+        if self._wb is None:
+            self._open_segment(date)
+
+        col, conv = self._col, self._conv
+        row = [None] * len(conv)
+        for tid, v in cells:
+            i = col.get(tid)
+            if i is None:
+                i = self._add_col(tid)
+                row.append(None)
+            if v is not None:
+                c = conv[i]
+                row[i] = v if c is None else c(v)
+        row[0] = dt
+        self._sheet.append(row)
+        self.rows_written += 1
+        self.last_rowid = rowid
+        self.last_ts = ts_ns
+
+    def _pass(self):
+        if self._con is None:
+            if not os.path.exists(self.db_path):
+                return
+            self._con = connect(self.db_path, readonly=True)
+        con = self._con
+        cur_ts, cells, cur_rowid = None, [], self.last_rowid
+        while True:
+            rows = con.execute(
+                "SELECT rowid, tag_id, ts, value FROM samples WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (cur_rowid, self.fetch)).fetchall()
+            for rowid, tid, ts, v in rows:
+                if ts != cur_ts:
+                    if cells:
+                        self._emit(cur_ts, cells, cur_rowid)
+                    cur_ts, cells = ts, []
+                cells.append((tid, v))
+                cur_rowid = rowid
+            if len(rows) < self.fetch:
+                break
+        # el historian commitea muestras enteras: al final de la pasada el grupo está completo
+        if cells:
+            self._emit(cur_ts, cells, cur_rowid)
+        if self._wb is not None:
+            self._wb.extra["last_rowid"] = self.last_rowid
+            self._wb.flush()
+            self._save_watermark()
+
+    def _save_watermark(self):
+        # después del flush: lo que marca ya es recuperable desde el journal
+        if self.last_ts is None or self.last_rowid == self._saved_rowid:
+            return
+        if self._wcon is None:
+            self._wcon = connect(self.db_path)
+        self._wcon.executemany(
+            "INSERT INTO historian_state(name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+            (("excel_rowid", self.last_rowid), ("excel_ts", self.last_ts)))
+        self._saved_rowid = self.last_rowid
+
+    def run(self):
+        while True:
+            stopping = self._stop_evt.is_set()
+            t0 = time.perf_counter()
+            try:
+                self._pass()
+                self.passes += 1
+                self.error = None
+            except Exception as e:
+                self.error = str(e)
+                log.exception("Historian Excel: error en pasada: %s", e)
+            self.last_pass_ms = round((time.perf_counter() - t0) * 1000, 1)
+            if stopping:
+                break
+            self._stop_evt.wait(self.period_s)
+        self._rotate("stop")
+        self._finalizer.drain(timeout=120)
+        for con in (self._con, self._wcon):
+            if con is not None:
+                con.close()
+
+    def segments(self) -> list[dict]:
+        with self._finalizer._lock:
+            return [dict(e) for e in self._finalizer.segments]
+
+    def status(self) -> dict:
+        return {
+            "alive": self.is_alive(),
+            "last_rowid": self.last_rowid,
+            "saved_rowid": self._saved_rowid,
+            "segment": self._seg_entry["path"] if self._wb is not None else None,
+            "segment_rows": self.rows_written,
+            "passes": self.passes,
+            "last_pass_ms": self.last_pass_ms,
+            "error": self.error,
+        }
@@ -0,0 +1,265 @@
+# historian/query.py
+import os, time, sqlite3, threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from historian.blocks import HISTORIAN_BLOCK_S, decode_block
+from historian.rollup import HISTORIAN_ROLLUP
+from historian.store import HISTORIAN_DB, TIERS, connect
+from utils.fast_json import dumps as fast_dumps
+
+HISTORIAN_QUERY_MAX_BUCKETS = int(os.getenv("HISTORIAN_QUERY_MAX_BUCKETS", "200000"))  # por tag
+HISTORIAN_QUERY_CHUNK = int(os.getenv("HISTORIAN_QUERY_CHUNK", "5000"))    # puntos por línea NDJSON
+HISTORIAN_QUERY_WORKERS = int(os.getenv("HISTORIAN_QUERY_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+AGGS = ("min", "max", "avg", "sum", "count", "first", "last")
+ROLLUP_AGGS = {"min", "max", "avg", "sum", "count", "last"}   # 'first' solo desde crudo
+
+_UNITS = {"ms": 1e-3, "s": 1.0, "m": 60.0, "h": 3600.0, "d": 86400.0}
+
+def parse_time(v, default: float) -> float:
+    """epoch en segundos (número o texto) o ISO 8601 -> epoch s."""
+    if v is None or v == "":
+        return default
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        dt = datetime.fromisoformat(str(v).strip().replace("Z", "+00:00"))
+        return dt.timestamp()
+
+def parse_bucket(v) -> float:
+    """'500ms' | '1s' | '5m' | '1h' | segundos -> segundos (0 = sin agrupar)."""
+    if v is None or v == "":
+        return 0.0
+    s = str(v).strip().lower()
+    for unit in ("ms", "s", "m", "h", "d"):
+        if s.endswith(unit) and s[:-len(unit)].replace(".", "", 1).isdigit():
+            return float(s[:-len(unit)]) * _UNITS[unit]
+    return float(s)
+
+_SLICE_NS = int(HISTORIAN_BLOCK_S * 1e9)
+
+def _agg(ts: np.ndarray, vals: np.ndarray, t0: int, step: int, aggs: tuple) -> dict:
+    """Buckets de 'step' desde t0 sobre arrays ordenados por ts (nan = NULL); sin buckets vacíos."""
+    ok = ~np.isnan(vals)
+    ts, vals = ts[ok], vals[ok]
+    if not len(ts):
+        return {"t": np.empty(0, np.int64), **{a: np.empty(0) for a in aggs}}
+    g = (ts - t0) // step
+    starts = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+    ends = np.r_[starts[1:], len(ts)]
+    out = {"t": t0 + g[starts] * step}
+    for a in aggs:
+        if a == "count":
+            out[a] = ends - starts
+        elif a == "min":
+            out[a] = np.minimum.reduceat(vals, starts)
+        elif a == "max":
+            out[a] = np.maximum.reduceat(vals, starts)
+        elif a == "sum":
+            out[a] = np.add.reduceat(vals, starts)
+        elif a == "avg":
+            out[a] = np.add.reduceat(vals, starts) / (ends - starts)
+        elif a == "first":
+            out[a] = vals[starts]
+        else:  # last
+            out[a] = vals[ends - 1]
+    return out
+
+class HistorianQuery:
+    """
+    Lecturas del historian. El crudo vive en dos lugares: 'blocks' (ventanas ya
+    compactadas, historian/blocks.py) y 'samples' (lo reciente y lo que llegó tarde).
+    Se lee por tramos de HISTORIAN_BLOCK_S: los bloques que tocan el tramo (índice
+    blocks_tag_t) se decodifican con NumPy y se mezclan con las filas de samples
+    (índice cubriente (tag_id, ts, value)), ambos en la misma transacción de lectura.
+      - agregados: reduceat de NumPy por tramo (tramo = múltiplo del bucket).
+      - sin bucket: arrays del tramo en líneas de 'chunk' puntos.
+    Tags en paralelo, una conexión de solo lectura por hilo (sqlite y zlib sueltan el GIL).
+    Con bucket se usa el rollup más grueso cuyo ancho divide al bucket (ver
+    historian/rollup.py): una sola lectura ordenada del rollup + reduceat de NumPy,
+    hasta el bucket donde está rollup_ts; de ahí en adelante (lo que el rollup
+    todavía no vio) sale del crudo. Sin rollups activos o sin datos agregados, todo crudo.
+    """
+    def __init__(self, db_path: str = HISTORIAN_DB, workers: int = HISTORIAN_QUERY_WORKERS):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max(1, workers), thread_name_prefix="historian-q")
+
+    def _con(self) -> sqlite3.Connection:
+        con = getattr(self._local, "con", None)
+        if con is None:
+            if not os.path.exists(self.db_path):
+                raise FileNotFoundError(f"historian sin datos todavía ({self.db_path})")
+            con = self._local.con = connect(self.db_path, readonly=True)
+        return con
+
+    def tag_ids(self, names: list[str]) -> dict[str, int]:
+        con = self._con()
+        marks = ",".join("?" * len(names))
+        found = dict(con.execute(f"SELECT name, id FROM tags WHERE name IN ({marks})", names).fetchall())
+        missing = [n for n in names if n not in found]
+        if missing:
+            raise KeyError(", ".join(missing))
+        return found
+
+    # --- por tag (corre en el pool) ---
+    @staticmethod
+    def _raw_arrays(con: sqlite3.Connection, tag_id: int, a: int, b: int):
+        """(ts, vals) ordenados de [a, b): bloques + samples, en un mismo snapshot."""
+        con.execute("BEGIN")   # bloque nuevo + DELETE de sus filas son atómicos: ni doble ni nada
+        try:
+            blocks = con.execute(
+                "SELECT n, t0, res, codec, ts, vals FROM blocks WHERE tag_id = ? AND t0 < ? AND t1 >= ?",
+                (tag_id, b, a)).fetchall()
+            rows = con.execute(
+                "SELECT ts, value FROM samples WHERE tag_id = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                (tag_id, a, b)).fetchall()
+        finally:
+            con.execute("COMMIT")
+        parts_t, parts_v = [], []
+        for n, bt0, res, codec, blob_ts, blob_vals in blocks:
+            ts, vals = decode_block(codec, n, bt0, res, blob_ts, blob_vals)
+            lo, hi = np.searchsorted(ts, (a, b))
+            parts_t.append(ts[lo:hi]); parts_v.append(vals[lo:hi])
+        if rows:
+            parts_t.append(np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows)))
+            parts_v.append(np.array([r[1] for r in rows], dtype=np.float64))
+        if not parts_t:
+            return np.empty(0, np.int64), np.empty(0)
+        ts, vals = np.concatenate(parts_t), np.concatenate(parts_v)
+        if len(parts_t) > 1:
+            order = np.argsort(ts, kind="stable")
+            ts, vals = ts[order], vals[order]
+        return ts, vals
+
+    def _buckets(self, tag_id: int, t0: int, t1: int, step: int, aggs: tuple) -> dict:
+        con = self._con()
+        span = max(1, _SLICE_NS // step) * step   # tramo = múltiplo del bucket: ningún bucket queda partido
+        parts = []
+        for a in range(t0, t1, span):
+            ts, vals = self._raw_arrays(con, tag_id, a, min(a + span, t1))
+            if len(ts):
+                parts.append(_agg(ts, vals, t0, step, aggs))
+        if not parts:
+            return {"t": [], **{a: [] for a in aggs}}
+        out = {"t": (np.concatenate([p["t"] for p in parts]) // 1_000_000).tolist()}   # inicio del bucket, epoch ms
+        for a in aggs:
+            out[a] = np.concatenate([p[a] for p in parts]).tolist()
+        return out
+
+    def _raw(self, tag_id: int, t0: int, t1: int, chunk: int):
+        # conexión propia: el generador avanza en hilos distintos del threadpool
+        con = connect(self.db_path, readonly=True)
+        try:
+            for a in range(t0, t1, _SLICE_NS):
+                ts, vals = self._raw_arrays(con, tag_id, a, min(a + _SLICE_NS, t1))
+                for i in range(0, len(ts), chunk):
+                    v = vals[i:i + chunk]
+                    yield {"t": (ts[i:i + chunk] / 1e6).tolist(),
+                           "v": np.where(np.isnan(v), None, v).tolist()}
+        finally:
+            con.close()
+
+    def _buckets_tier(self, tag_id: int, t0: int, t1: int, step: int, aggs: tuple, tier: str) -> dict:
+        rows = self._con().execute(
+            f"SELECT bucket, cnt, mn, mx, total, last FROM rollup_{tier} "
+            "WHERE tag_id = ? AND bucket >= ? AND bucket < ? AND cnt > 0 ORDER BY bucket",
+            (tag_id, t0, t1)).fetchall()
+        if not rows:
+            return {"t": [], **{a: [] for a in aggs}}
+        arr = np.array(rows, dtype=np.float64)    # NULL -> nan
+        b = np.array([r[0] for r in rows], dtype=np.int64)
+        g = (b - t0) // step
+        starts = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+        cnt = np.add.reduceat(arr[:, 1], starts)
+        out = {"t": ((t0 + g[starts] * step) // 1_000_000).tolist()}
+        for a in aggs:
+            if a == "count":
+                out[a] = cnt.astype(np.int64).tolist()
+            elif a == "min":
+                out[a] = np.fmin.reduceat(arr[:, 2], starts).tolist()
+            elif a == "max":
+                out[a] = np.fmax.reduceat(arr[:, 3], starts).tolist()
+            elif a == "sum":
+                out[a] = np.add.reduceat(arr[:, 4], starts).tolist()
+            elif a == "avg":
+                out[a] = (np.add.reduceat(arr[:, 4], starts) / cnt).tolist()
+            elif a == "last":
+                # última fila con last no nulo dentro de cada grupo
+                pos = np.where(np.isnan(arr[:, 5]), -1, np.arange(len(rows)))
+                idx = np.maximum.reduceat(pos, starts)
+                out[a] = [None if i < 0 else v for i, v in zip(idx.tolist(), arr[idx, 5].tolist())]
+        return out
+
+    def _buckets_split(self, tag_id: int, t0: int, t1: int, step: int, aggs: tuple,
+                       tier: str, split: int) -> dict:
+        # [t0, split) del rollup, [split, t1) del crudo; split es múltiplo de step
+        out = self._buckets_tier(tag_id, t0, split, step, aggs, tier) if split > t0 else None
+        tail = self._buckets(tag_id, split, t1, step, aggs) if split < t1 else None
+        if out is None or tail is None:
+            return out or tail
+        return {k: out[k] + tail[k] for k in out}
+
+    def rollup_ts(self) -> int | None:
+        row = self._con().execute("SELECT value FROM historian_state WHERE name = 'rollup_ts'").fetchone()
+        return row[0] if row else None
+
+    # --- API ---
+    def stream(self, tags: list[str], t_from: float, t_to: float, bucket_s: float = 0.0,
+               aggs: tuple = ("min", "max", "avg", "last"), chunk: int = HISTORIAN_QUERY_CHUNK):
+        """
+        Generador NDJSON: 1ra línea = meta; después {"tag", "t", <agg>...} por tramo de
+        'chunk' puntos (o {"tag", "t", "v"} sin bucket). t = epoch ms.
+        Valida todo antes de devolver el generador (errores -> ValueError / KeyError).
+        """
+        if not tags:
+            raise ValueError("tags vacío")
+        if t_to <= t_from:
+            raise ValueError("'to' debe ser mayor que 'from'")
+        bad = [a for a in aggs if a not in AGGS]
+        if bad:
+            raise ValueError(f"agg inválido: {', '.join(bad)} (usa {', '.join(AGGS)})")
+        t0, t1 = int(t_from * 1e9), int(t_to * 1e9)
+        step = int(bucket_s * 1e9)
+        if step and (t1 - t0) / step > HISTORIAN_QUERY_MAX_BUCKETS:
+            raise ValueError(f"demasiados buckets (máx {HISTORIAN_QUERY_MAX_BUCKETS} por tag); usa un bucket mayor")
+        ids = self.tag_ids(tags)
+        tier, split = None, t1
+        if step:
+            t0 -= t0 % step   # buckets alineados a múltiplos del ancho (como los rollups)
+            if HISTORIAN_ROLLUP and set(aggs) <= ROLLUP_AGGS:
+                tier = next((name for name, w in TIERS if step % w == 0), None)
+            rts = self.rollup_ts() if tier else None
+            if rts is None:
+                tier = None   # rollups apagados o todavía vacíos: todo del crudo
+            else:
+                # el bucket donde cae rollup_ts (y lo posterior) se arma del crudo
+                split = min(max(rts - rts % step, t0), t1)
+        meta = {"tags": tags, "from": t0 / 1e9, "to": t_to, "bucket_s": bucket_s,
+                "agg": list(aggs) if step else None, "tier": tier or "raw"}
+        if tier:
+            meta["rollup_ts"] = rts
+            meta["raw_from"] = split / 1e9 if split < t1 else None
+
+        def gen():
+            started = time.perf_counter()
+            yield fast_dumps(meta) + "\n"
+            if step:
+                if tier:
+                    futs = [self._pool.submit(self._buckets_split, ids[t], t0, t1, step, aggs, tier, split)
+                            for t in tags]
+                else:
+                    futs = [self._pool.submit(self._buckets, ids[t], t0, t1, step, aggs) for t in tags]
+                for tag, fut in zip(tags, futs):
+                    res = fut.result()
+                    n = len(res["t"])
+                    for i in range(0, max(n, 1), chunk):
+                        part = {k: v[i:i + chunk] for k, v in res.items()}
+                        yield fast_dumps({"tag": tag, **part}) + "\n"
+            else:
+                for tag in tags:
+                    for part in self._raw(ids[tag], t0, t1, chunk):
+                        yield fast_dumps({"tag": tag, **part}) + "\n"
+            yield fast_dumps({"done": True, "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}) + "\n"
+        return gen()
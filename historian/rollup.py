@@ -0,0 +1,365 @@
+# historian/rollup.py
+import os, time, logging, sqlite3, threading
+import numpy as np
+from historian.blocks import HISTORIAN_BLOCK_S, HISTORIAN_BLOCK_TS_RES_NS, encode_block
+from historian.store import HISTORIAN_DB, TIERS, connect, ensure_schema
+from historian.excel_export import HISTORIAN_EXCEL
+
+log = logging.getLogger("uvicorn")
+
+HISTORIAN_ROLLUP = os.getenv("HISTORIAN_ROLLUP", "true").lower() == "true"
+HISTORIAN_ROLLUP_S = float(os.getenv("HISTORIAN_ROLLUP_S", "2"))               # cada cuánto se agrega
+HISTORIAN_ROLLUP_BATCH = int(os.getenv("HISTORIAN_ROLLUP_BATCH", "250000"))    # filas crudas por paso
+HISTORIAN_RETENTION_S = float(os.getenv("HISTORIAN_RETENTION_S", "60"))        # cada cuánto se purga
+HISTORIAN_DELETE_CHUNK = int(os.getenv("HISTORIAN_DELETE_CHUNK", "50000"))     # filas por transacción
+HISTORIAN_VACUUM_PAGES = int(os.getenv("HISTORIAN_VACUUM_PAGES", "2000"))      # páginas libres por pasada
+HISTORIAN_BLOCKS = os.getenv("HISTORIAN_BLOCKS", "true").lower() == "true"     # compactar crudo en bloques
+HISTORIAN_BLOCK_AFTER_S = float(os.getenv("HISTORIAN_BLOCK_AFTER_S", "300"))   # crudo "vivo" antes de compactar
+HISTORIAN_BLOCK_TAGS = int(os.getenv("HISTORIAN_BLOCK_TAGS", "50"))            # tags por paso
+
+# retención por nivel, en horas (0 = sin límite)
+RETENTION_H = {
+    "raw": float(os.getenv("HISTORIAN_RETAIN_RAW_H", "48")),
+    "1s": float(os.getenv("HISTORIAN_RETAIN_1S_H", str(14 * 24))),
+    "1m": float(os.getenv("HISTORIAN_RETAIN_1M_H", str(365 * 24))),
+    "1h": float(os.getenv("HISTORIAN_RETAIN_1H_H", "0")),
+}
+
+_S = 10**9
+
+class HistorianMaintenance(threading.Thread):
+    """
+    Mantenimiento del historian en su propia conexión, sin frenar al escritor:
+      • Rollups continuos: toma las filas crudas nuevas (cursor por rowid), arma
+        parciales por (tag, segundo) en tablas TEMP (lectura pura, sin lock de
+        escritura) y los mezcla con UPSERT en rollup_1s/1m/1h. min/max/suma/cuenta
+        y last (por last_ts) son asociativos: datos tardíos se mezclan bien.
+        El lock de escritura solo se toma para los UPSERT (pocas filas por tag).
+      • Compactación: las ventanas de HISTORIAN_BLOCK_S ya agregadas y con más de
+        HISTORIAN_BLOCK_AFTER_S de antigüedad pasan de 'samples' a 'blocks' (un
+        bloque comprimido por tag, historian/blocks.py); bloque nuevo y borrado de
+        las filas van en la misma transacción. Filas tardías quedan en 'samples'
+        y las consultas mezclan ambas.
+      • Retención por nivel: borra en tramos chicos (una transacción por tramo)
+        y devuelve páginas con incremental_vacuum.
+      • Con el export a Excel (HISTORIAN_EXCEL), que lee solo 'samples': ni la
+        compactación ni la retención del crudo pasan de su marca (excel_rowid /
+        excel_ts en historian_state). Exportador caído = el crudo espera en 'samples'.
+    """
+    def __init__(self, db_path: str = HISTORIAN_DB, rollup_s: float = HISTORIAN_ROLLUP_S,
+                 batch: int = HISTORIAN_ROLLUP_BATCH, retention_s: float = HISTORIAN_RETENTION_S,
+                 retention_h: dict | None = None, blocks: bool = HISTORIAN_BLOCKS,
+                 block_s: float = HISTORIAN_BLOCK_S, block_after_s: float = HISTORIAN_BLOCK_AFTER_S,
+                 excel: bool = HISTORIAN_EXCEL):
+        super().__init__(name="historian-maint", daemon=True)
+        self.db_path = db_path
+        self.rollup_s = rollup_s
+        self.batch = max(1, batch)
+        self.retention_s = retention_s
+        self.retention_h = dict(RETENTION_H, **(retention_h or {}))
+        self.blocks = blocks
+        self.block_ns = int(block_s * _S)
+        self.block_after_ns = int(block_after_s * _S)
+        self.excel = excel
+        self._stop_evt = threading.Event()
+        self._con: sqlite3.Connection | None = None
+
+        self.cursor = 0          # último rowid crudo ya agregado
+        self.rollup_ts = None    # ts (ns) más nuevo ya agregado
+        self.rolled_rows = 0
+        self.last_step_ms = None
+        self.block_ts = None     # inicio de la ventana pendiente de compactar (ns)
+        self._block_tag = 0      # último tag ya compactado en esa ventana
+        self.excel_rowid = None  # marca del export a Excel (None = sin export)
+        self.excel_ts = None
+        self.compacted_rows = 0
+        self.blocks_written = 0
+        self.block_bytes = 0
+        self.deleted = {k: 0 for k in self.retention_h}
+        self.deleted_blocks = 0
+        self.vacuumed_pages = 0
+        self.last_retention = None
+        self.error = None
+
+    def stop(self):
+        self._stop_evt.set()
+
+    # --- estado persistente ---
+    def _get_state(self, name: str, default: int = 0) -> int:
+        row = self._con.execute("SELECT value FROM historian_state WHERE name = ?", (name,)).fetchone()
+        return default if row is None or row[0] is None else row[0]
+
+    def _set_state(self, name: str, value: int):
+        self._con.execute("INSERT INTO historian_state(name, value) VALUES (?, ?) "
+                          "ON CONFLICT(name) DO UPDATE SET value = excluded.value", (name, value))
+
+    def _raw_limit(self) -> int:
+        """Último rowid que se puede sacar de 'samples': agregado y, con export a Excel, ya exportado."""
+        if not self.excel:
+            return self.cursor
+        self.excel_rowid = self._get_state("excel_rowid")
+        self.excel_ts = self._get_state("excel_ts", None)
+        return min(self.cursor, self.excel_rowid)
+
+    def _open(self):
+        con = connect(self.db_path)
+        ensure_schema(con)
+        con.executescript("""
+            CREATE TEMP TABLE IF NOT EXISTS delta(tag_id INTEGER, b INTEGER, mn REAL, mx REAL, total REAL, cnt INTEGER);
+            CREATE TEMP TABLE IF NOT EXISTS dlast(tag_id INTEGER, b INTEGER, last_ts INTEGER, last REAL);
+        """)
+        self._con = con
+        self.cursor = self._get_state("rollup_rowid")
+        self.rollup_ts = self._get_state("rollup_ts", None)
+        self.block_ts = self._get_state("block_ts", None)
+
+    # --- rollups ---
+    def rollup_step(self) -> int:
+        """Agrega hasta 'batch' filas crudas nuevas; devuelve cuántas procesó."""
+        con = self._con
+        hi = con.execute("SELECT MAX(rowid) FROM samples").fetchone()[0] or 0
+        if hi <= self.cursor:
+            return 0
+        lo, hi = self.cursor, min(hi, self.cursor + self.batch)
+        t0 = time.perf_counter()
+
+        # parciales por (tag, segundo): solo escribe en TEMP, no bloquea al escritor
+        con.execute("DELETE FROM temp.delta")
+        con.execute("DELETE FROM temp.dlast")
+        con.execute(f"""
+            INSERT INTO temp.delta
+            SELECT tag_id, ts - ts % {_S}, MIN(value), MAX(value), TOTAL(value), COUNT(value)
+            FROM samples WHERE rowid > ? AND rowid <= ? GROUP BY 1, 2""", (lo, hi))
+        # columna "suelta" con MAX(): value sale de la fila con el ts más nuevo
+        con.execute(f"""
+            INSERT INTO temp.dlast
+            SELECT tag_id, ts - ts % {_S}, MAX(ts), value
+            FROM samples WHERE rowid > ? AND rowid <= ? AND value IS NOT NULL GROUP BY 1, 2""", (lo, hi))
+        newest = con.execute("SELECT MAX(last_ts) FROM temp.dlast").fetchone()[0]
+
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            for name, width in TIERS:
+                t = f"rollup_{name}"
+                con.execute(f"""
+                    INSERT INTO {t}(tag_id, bucket, mn, mx, total, cnt)
+                    SELECT tag_id, b - b % {width}, MIN(mn), MAX(mx), TOTAL(total), SUM(cnt)
+                    FROM temp.delta WHERE true GROUP BY 1, 2
+                    ON CONFLICT(tag_id, bucket) DO UPDATE SET
+                        mn = CASE WHEN mn IS NULL OR excluded.mn < mn THEN excluded.mn ELSE mn END,
+                        mx = CASE WHEN mx IS NULL OR excluded.mx > mx THEN excluded.mx ELSE mx END,
+                        total = total + excluded.total,
+                        cnt = cnt + excluded.cnt""")
+                con.execute(f"""
+                    INSERT INTO {t}(tag_id, bucket, last_ts, last)
+                    SELECT tag_id, b - b % {width}, MAX(last_ts), last
+                    FROM temp.dlast WHERE true GROUP BY 1, 2
+                    ON CONFLICT(tag_id, bucket) DO UPDATE SET
+                        last = CASE WHEN last_ts IS NULL OR excluded.last_ts >= last_ts
+                                    THEN excluded.last ELSE last END,
+                        last_ts = CASE WHEN last_ts IS NULL OR excluded.last_ts >= last_ts
+                                       THEN excluded.last_ts ELSE last_ts END""")
+            self._set_state("rollup_rowid", hi)
+            if newest is not None and (self.rollup_ts is None or newest > self.rollup_ts):
+                self._set_state("rollup_ts", newest)
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        self.cursor = hi
+        if newest is not None and (self.rollup_ts is None or newest > self.rollup_ts):
+            self.rollup_ts = newest
+        self.rolled_rows += hi - lo
+        self.last_step_ms = round((time.perf_counter() - t0) * 1000, 1)
+        return hi - lo
+
+    # --- bloques comprimidos ---
+    def compact_step(self) -> int:
+        """Compacta hasta HISTORIAN_BLOCK_TAGS tags de la ventana pendiente; devuelve filas movidas."""
+        con = self._con
+        if self.block_ts is None:
+            row = con.execute("SELECT ts FROM samples ORDER BY rowid LIMIT 1").fetchone()
+            if row is None:
+                return 0
+            self.block_ts = row[0] - row[0] % self.block_ns
+        w0 = self.block_ts
+        w1 = w0 + self.block_ns
+        # solo ventanas ya agregadas y con margen para datos que llegan tarde
+        if self.rollup_ts is None or w1 > self.rollup_ts - self.block_after_ns:
+            return 0
+        limit = self._raw_limit()
+        if self.excel and (self.excel_ts is None or w1 > self.excel_ts):
+            return 0   # el export a Excel todavía no pasó esta ventana
+        tags = con.execute("SELECT id FROM tags WHERE id > ? ORDER BY id LIMIT ?",
+                           (self._block_tag, HISTORIAN_BLOCK_TAGS)).fetchall()
+        moved = 0
+        for (tid,) in tags:
+            # rowid <= limit: lo que aún no entró en los rollups (o al Excel) se queda en samples
+            rows = con.execute(
+                "SELECT ts, value FROM samples WHERE tag_id = ? AND ts >= ? AND ts < ? AND rowid <= ? ORDER BY ts",
+                (tid, w0, w1, limit)).fetchall()
+            self._block_tag = tid
+            if not rows:
+                continue
+            ts = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+            vals = np.array([r[1] for r in rows], dtype=np.float64)   # NULL -> nan
+            codec, b0, b1, blob_ts, blob_vals = encode_block(ts, vals)
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                con.execute("INSERT INTO blocks(tag_id, t0, t1, n, codec, res, ts, vals) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (tid, b0, b1, len(rows), codec, HISTORIAN_BLOCK_TS_RES_NS, blob_ts, blob_vals))
+                con.execute("DELETE FROM samples WHERE tag_id = ? AND ts >= ? AND ts < ? AND rowid <= ?",
+                            (tid, w0, w1, limit))
+                con.execute("COMMIT")
+            except Exception:
+                con.execute("ROLLBACK")
+                raise
+            moved += len(rows)
+            self.blocks_written += 1
+            self.block_bytes += len(blob_ts) + len(blob_vals)
+        if len(tags) < HISTORIAN_BLOCK_TAGS:
+            # ventana completa: la próxima (si se corta antes, rehacerla solo repasa tags ya vacíos)
+            self._set_state("block_ts", w1)
+            self.block_ts = w1
+            self._block_tag = 0
+        self.compacted_rows += moved
+        return moved
+
+    def _pending_compact(self) -> bool:
+        if not (self.blocks and self.block_ts is not None and self.rollup_ts is not None):
+            return False
+        w1 = self.block_ts + self.block_ns
+        if self.excel and (self.excel_ts is None or w1 > self.excel_ts):
+            return False
+        return w1 <= self.rollup_ts - self.block_after_ns
+
+    # --- retención ---
+    def _delete_raw(self, cutoff: int) -> int:
+        # rowid crece con el tiempo: se borra del principio, por tramos de rowid,
+        # y nunca más allá de lo que ya entró en los rollups (ni al Excel)
+        con = self._con
+        total = 0
+        limit = self._raw_limit()
+        while not self._stop_evt.is_set():
+            lo = con.execute("SELECT MIN(rowid) FROM samples").fetchone()[0]
+            if lo is None:
+                break
+            hi = min(lo + HISTORIAN_DELETE_CHUNK, limit + 1)
+            if hi <= lo:
+                break
+            con.execute("BEGIN IMMEDIATE")
+            n = con.execute("DELETE FROM samples WHERE rowid >= ? AND rowid < ? AND ts < ?",
+                            (lo, hi, cutoff)).rowcount
+            con.execute("COMMIT")
+            total += n
+            # con bloques el rango de rowid tiene huecos: se corta cuando sobrevive
+            # alguna fila del tramo (ya dentro de la retención)
+            nxt = con.execute("SELECT MIN(rowid) FROM samples").fetchone()[0]
+            if nxt is None or nxt < hi:
+                break
+            time.sleep(0.01)  # deja pasar al escritor entre tramos
+        return total
+
+    def _delete_blocks(self, cutoff: int) -> int:
+        con = self._con
+        total = 0
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            for (tid,) in con.execute("SELECT id FROM tags").fetchall():
+                total += con.execute("DELETE FROM blocks WHERE tag_id = ? AND t0 < ? AND t1 < ?",
+                                     (tid, cutoff, cutoff)).rowcount
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return total
+
+    def _delete_tier(self, name: str, width: int, cutoff: int) -> int:
+        con = self._con
+        t = f"rollup_{name}"
+        span = HISTORIAN_DELETE_CHUNK * width   # tope por tag y transacción
+        total = 0
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            for (tid,) in con.execute("SELECT id FROM tags").fetchall():
+                first = con.execute(f"SELECT MIN(bucket) FROM {t} WHERE tag_id = ?", (tid,)).fetchone()[0]
+                if first is None or first >= cutoff:
+                    continue
+                total += con.execute(f"DELETE FROM {t} WHERE tag_id = ? AND bucket < ?",
+                                     (tid, min(cutoff, first + span))).rowcount
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return total
+
+    def retention_step(self):
+        now = time.time_ns()
+        for name, hours in self.retention_h.items():
+            if not hours:
+                continue
+            cutoff = now - int(hours * 3600 * _S)
+            if name == "raw":
+                n = self._delete_raw(cutoff)
+                self.deleted_blocks += self._delete_blocks(cutoff)
+            else:
+                n = self._delete_tier(name, dict(TIERS)[name], cutoff)
+            self.deleted[name] += n
+        if HISTORIAN_VACUUM_PAGES > 0:
+            free = self._con.execute("PRAGMA freelist_count").fetchone()[0]
+            if free:
+                self._con.execute(f"PRAGMA incremental_vacuum({HISTORIAN_VACUUM_PAGES})")
+                self.vacuumed_pages += min(free, HISTORIAN_VACUUM_PAGES)
+        self.last_retention = time.time()
+
+    def run(self):
+        while self._con is None and not self._stop_evt.is_set():
+            try:
+                self._open()
+            except Exception as e:
+                self.error = str(e)
+                self._stop_evt.wait(5.0)
+        next_retention = time.monotonic() + self.retention_s
+        while not self._stop_evt.is_set():
+            busy = False
+            try:
+                busy = self.rollup_step() >= self.batch   # atrasado: sigue sin esperar
+                if self.blocks:
+                    self.compact_step()
+                    busy = busy or self._pending_compact()
+                if time.monotonic() >= next_retention:
+                    self.retention_step()
+                    next_retention = time.monotonic() + self.retention_s
+                self.error = None
+            except Exception as e:
+                self.error = str(e)
+                log.exception("Historian maint: %s", e)
+            self._stop_evt.wait(0.05 if busy else self.rollup_s)
+        if self._con is not None:
+            try:
+                self.rollup_step()   # lo último antes de apagar
+            except Exception:
+                pass
+            self._con.close()
+
+    def status(self) -> dict:
+        return {
+            "alive": self.is_alive(),
+            "rollup_rowid": self.cursor,
+            "rollup_ts": self.rollup_ts,
+            "rolled_rows": self.rolled_rows,
+            "last_step_ms": self.last_step_ms,
+            "blocks": self.blocks,
+            "block_ts": self.block_ts,
+            "excel_rowid": self.excel_rowid,
+            "excel_ts": self.excel_ts,
+            "compacted_rows": self.compacted_rows,
+            "blocks_written": self.blocks_written,
+            "block_bytes": self.block_bytes,
+            "retention_h": self.retention_h,
+            "deleted": self.deleted,
+            "deleted_blocks": self.deleted_blocks,
+            "vacuumed_pages": self.vacuumed_pages,
+            "last_retention": self.last_retention,
+            "error": self.error,
+        }
@@ -0,0 +1,286 @@
+# historian/store.py
+import os, time, queue, logging, sqlite3, threading
+
+log = logging.getLogger("uvicorn")
+
+HISTORIAN_ENABLED = os.getenv("HISTORIAN_ENABLED", "false").lower() == "true"
+HISTORIAN_DB = os.getenv("HISTORIAN_DB", "logs/historian.db")
+HISTORIAN_SYNC = os.getenv("HISTORIAN_SYNC", "NORMAL").upper()          # OFF | NORMAL | FULL
+HISTORIAN_QUEUE_MAX = int(os.getenv("HISTORIAN_QUEUE_MAX", "5000"))     # muestras en espera
+HISTORIAN_BATCH_ROWS = int(os.getenv("HISTORIAN_BATCH_ROWS", "100000")) # filas por transacción
+HISTORIAN_COMMIT_S = float(os.getenv("HISTORIAN_COMMIT_S", "1.0"))      # commit al menos cada N s
+HISTORIAN_CACHE_MB = int(os.getenv("HISTORIAN_CACHE_MB", "16"))
+HISTORIAN_BUSY_MS = int(os.getenv("HISTORIAN_BUSY_MS", "10000"))     # espera por el lock de escritura
+
+_SYNC_MODES = ("OFF", "NORMAL", "FULL")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags(
+    id   INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    type TEXT
+);
+-- id AUTOINCREMENT: nunca se reusa aunque la retención vacíe la tabla; los cursores
+-- de rollup, compactación y export a Excel avanzan por id (= rowid)
+CREATE TABLE IF NOT EXISTS samples(
+    id     INTEGER PRIMARY KEY AUTOINCREMENT,
+    tag_id INTEGER NOT NULL,
+    ts     INTEGER NOT NULL,   -- epoch en ns
+    value  REAL
+);
+-- cubriente: los rangos por tag se leen solo del índice (ver historian/query.py)
+CREATE INDEX IF NOT EXISTS samples_tag_ts ON samples(tag_id, ts, value);
+-- crudo comprimido por tag y ventana (historian/blocks.py, compactado en historian/rollup.py)
+CREATE TABLE IF NOT EXISTS blocks(
+    tag_id INTEGER NOT NULL,
+    t0     INTEGER NOT NULL,   -- primer / último ts del bloque, epoch ns
+    t1     INTEGER NOT NULL,
+    n      INTEGER NOT NULL,
+    codec  TEXT NOT NULL,      -- 'xor' | 'rle'
+    res    INTEGER NOT NULL,   -- resolución de los ts, ns
+    ts     BLOB NOT NULL,
+    vals   BLOB NOT NULL
+);
+-- índice de bloques: qué bloques de un tag tocan un rango
+CREATE INDEX IF NOT EXISTS blocks_tag_t ON blocks(tag_id, t0, t1);
+CREATE TABLE IF NOT EXISTS historian_state(
+    name  TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+# rollups continuos (historian/rollup.py), del más grueso al más fino: (nombre, ancho en ns)
+TIERS = (("1h", 3600 * 10**9), ("1m", 60 * 10**9), ("1s", 10**9))
+
+_ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup_{name}(
+    tag_id  INTEGER NOT NULL,
+    bucket  INTEGER NOT NULL,  -- inicio del bucket, epoch ns (múltiplo del ancho)
+    mn      REAL,
+    mx      REAL,
+    total   REAL NOT NULL DEFAULT 0,
+    cnt     INTEGER NOT NULL DEFAULT 0,
+    last    REAL,
+    last_ts INTEGER,
+    PRIMARY KEY(tag_id, bucket)
+) WITHOUT ROWID;
+"""
+
+def ensure_schema(con: sqlite3.Connection):
+    con.executescript(_SCHEMA + "".join(_ROLLUP_SCHEMA.format(name=n) for n, _ in TIERS))
+
+def connect(path: str = HISTORIAN_DB, readonly: bool = False) -> sqlite3.Connection:
+    """Conexión con los PRAGMA del historian (WAL); readonly para lectores en otros hilos."""
+    if readonly:
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    else:
+        con = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        # antes que WAL: incremental solo aplica a una base nueva; en una vieja no cambia nada
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(f"PRAGMA synchronous={HISTORIAN_SYNC if HISTORIAN_SYNC in _SYNC_MODES else 'NORMAL'}")
+        con.execute(f"PRAGMA busy_timeout={HISTORIAN_BUSY_MS}")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute(f"PRAGMA cache_size={-HISTORIAN_CACHE_MB * 1024}")
+    return con
+
+class Historian(threading.Thread):
+    """
+    Historian SQLite: ingest() (hot path) solo encola la muestra; este hilo tiene
+    UNA conexión abierta, traduce 'GRUPO.tag' -> id entero (tabla tags) y baja
+    filas (tag_id, ts_ns, value) con executemany en transacciones grandes.
+    Solo valores numéricos (BOOL -> 0/1); texto y None se saltean.
+    """
+    def __init__(self, path: str = HISTORIAN_DB, batch_rows: int = HISTORIAN_BATCH_ROWS,
+                 commit_s: float = HISTORIAN_COMMIT_S, queue_max: int = HISTORIAN_QUEUE_MAX):
+        super().__init__(name="historian", daemon=True)
+        self.path = path
+        self.batch_rows = max(1, batch_rows)
+        self.commit_s = commit_s
+        self._q: queue.Queue = queue.Queue(maxsize=queue_max)
+        self._stop_evt = threading.Event()
+        self._ids: dict[str, dict[str, int]] = {}   # grupo -> {nombre: id}
+        self._con: sqlite3.Connection | None = None
+        self._in_tx = False
+
+        self.samples = 0
+        self.rows_written = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.commits = 0
+        self.last_commit_ms = None
+        self.last_ts = None
+        self.error = None
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    # --- hot path (hilo de adquisición) ---
+    def ingest(self, sample: dict):
+        try:
+            self._q.put_nowait(sample)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        self._stop_evt.set()
+
+    # --- hilo del historian ---
+    def _open(self):
+        con = connect(self.path)
+        ensure_schema(con)
+        for tid, name in con.execute("SELECT id, name FROM tags"):
+            group, _, tname = name.partition(".")
+            self._ids.setdefault(group, {})[tname] = tid
+        self._con = con
+
+    def _tag_id(self, group: str, name: str, ids: dict) -> int:
+        # tag nuevo: se da de alta dentro de la transacción abierta
+        cur = self._con.execute("INSERT OR IGNORE INTO tags(name, type) VALUES (?, ?)",
+                                (f"{group}.{name}", group))
+        tid = cur.lastrowid if cur.rowcount else self._con.execute(
+            "SELECT id FROM tags WHERE name = ?", (f"{group}.{name}",)).fetchone()[0]
+        ids[name] = tid
+        return tid
+
+    def _rows(self, sample: dict, out: list):
+        ts = sample.get("timestamp")
+        if not isinstance(ts, (int, float)):
+            ts = time.time()
+        ts_ns = int(ts * 1_000_000_000)
+        self.last_ts = ts
+        skipped = 0
+        for group, vals in sample.items():
+            if type(vals) is not dict:
+                continue
+            ids = self._ids.get(group)
+            if ids is None:
+                ids = self._ids[group] = {}
+            for name, v in vals.items():
+                t = type(v)
+                if t is float:
+                    if v != v:   # NaN: SQLite lo guardaría como NULL igual
+                        v = None
+                elif t is int:
+                    # la columna es REAL igual; como int, un ULINT/LWORD > 2**63-1 es
+                    # OverflowError en executemany y tira abajo el lote entero
+                    v = float(v)
+                elif t is bool:
+                    v = int(v)
+                else:
+                    if t is dict:  # subestructura: 'GRUPO.a.b'
+                        for k, sv in _flat_items(v, name):
+                            if isinstance(sv, (int, float)) and sv == sv:
+                                tid = ids.get(k) or self._tag_id(group, k, ids)
+                                out.append((tid, ts_ns, float(sv)))
+                            else:
+                                skipped += 1
+                        continue
+                    skipped += 1
+                    continue
+                tid = ids.get(name)
+                if tid is None:
+                    tid = self._tag_id(group, name, ids)
+                out.append((tid, ts_ns, v))
+        self.skipped += skipped
+
+    def _commit(self, rows: list):
+        t0 = time.perf_counter()
+        con = self._con
+        try:
+            con.executemany("INSERT INTO samples(tag_id, ts, value) VALUES (?, ?, ?)", rows)
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            # las altas de tags de esta transacción también se perdieron
+            self._ids.clear()
+            for tid, name in con.execute("SELECT id, name FROM tags"):
+                group, _, tname = name.partition(".")
+                self._ids.setdefault(group, {})[tname] = tid
+            raise
+        finally:
+            self._in_tx = False
+        self.rows_written += len(rows)
+        self.commits += 1
+        self.last_commit_ms = round((time.perf_counter() - t0) * 1000, 1)
+
+    def run(self):
+        try:
+            self._open()
+        except Exception as e:
+            self.error = str(e)
+            log.exception("Historian: no pude abrir %s: %s", self.path, e)
+            return
+        rows: list = []
+        last_commit = time.monotonic()
+        while True:
+            stopping = self._stop_evt.is_set()
+            try:
+                sample = self._q.get(timeout=0.2)
+            except queue.Empty:
+                sample = None
+            try:
+                while sample is not None:
+                    if isinstance(sample, dict):
+                        if not self._in_tx:
+                            # altas de tags nuevos + filas: una sola transacción por lote
+                            self._con.execute("BEGIN")
+                            self._in_tx = True
+                        self._rows(sample, rows)
+                        self.samples += 1
+                    if len(rows) >= self.batch_rows:
+                        break
+                    try:
+                        sample = self._q.get_nowait()
+                    except queue.Empty:
+                        sample = None
+                if self._in_tx and (len(rows) >= self.batch_rows or stopping
+                                    or time.monotonic() - last_commit >= self.commit_s):
+                    self._commit(rows)
+                    rows = []
+                    last_commit = time.monotonic()
+            except Exception as e:
+                self.error = str(e)
+                log.exception("Historian: error escribiendo lote (%d filas): %s", len(rows), e)
+                if self._in_tx:
+                    try:
+                        self._con.execute("ROLLBACK")
+                    except Exception:
+                        pass
+                    self._in_tx = False
+                rows = []
+            if stopping and self._q.empty() and not self._in_tx:
+                break
+        self._con.close()
+        log.info("Historian cerrado: %d filas en %s", self.rows_written, self.path)
+
+    def status(self) -> dict:
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = None
+        return {
+            "path": self.path,
+            "alive": self.is_alive(),
+            "tags": sum(len(v) for v in self._ids.values()),
+            "samples": self.samples,
+            "rows_written": self.rows_written,
+            "skipped": self.skipped,
+            "dropped": self.dropped,
+            "queued": self._q.qsize(),
+            "commits": self.commits,
+            "last_commit_ms": self.last_commit_ms,
+            "last_ts": self.last_ts,
+            "db_bytes": size,
+            "synchronous": HISTORIAN_SYNC,
+            "error": self.error,
+        }
+
+def _flat_items(obj: dict, prefix: str):
+    for k, v in obj.items():
+        key = f"{prefix}.{k}"
+        if isinstance(v, dict):
+            yield from _flat_items(v, key)
+        else:
+            yield key, v
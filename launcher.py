@@ -94,6 +94,8 @@ def run_server():
         port=port,
         log_level="info",
         log_config=_safe_uvicorn_log_config(),
+        # permessage-deflate del transporte; apágalo si usas WS_COMPRESS (ws/compression.py)
+        ws_per_message_deflate=os.getenv("WS_PERMESSAGE_DEFLATE", "true").lower() == "true",
     )
 
 def run_gui():
@@ -6,17 +6,29 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from ws.ws_endpoint import websocket_endpoint
 from ws.ws_write_endpoint import websocket_write_endpoint
+from ws.hub import hub as ws_hub
+from ws.sse_endpoint import sse_stream, latest_longpoll
+from ws import compression as ws_compression
 from plc.opc_client import PLCReader
+from plc.session_pool import opc_pool, parse_write_items, write_scheduler
 from plc.buffer import data_buffer
-from plc.discovery import discover_opcua_urls, pick_first_alive_auth, pick_first_alive_any, _probe_tcp_host
+from plc.discovery import discover_opcua_urls, probe_first_alive, pick_first_alive_any, _probe_tcp_host
+from plc.scanner import probe as probe_tcp_many
 import logging
 from pydantic import BaseModel
 from fastapi import HTTPException
 from fastapi.responses import JSONResponse
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi import APIRouter
-from fastapi import Body
+from fastapi import Body, Query
 from utils.rt_export_manager import RtExportManager
+from utils.export_sinks import SnapshotUnavailable, read_prefix
+from utils.capture_manager import CaptureManager
+from historian.store import HISTORIAN_ENABLED, Historian
+from historian.excel_export import HISTORIAN_EXCEL, HistorianExcelExporter
+from historian.query import HistorianQuery, parse_bucket, parse_time
+from historian.rollup import HISTORIAN_ROLLUP, HistorianMaintenance
 import os
 from fastapi import Request
 from opcua import Client
@@ -28,10 +40,10 @@ except ImportError:
     ExcelLogger = None
 import time
 import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 LOG_TO_EXCEL = os.getenv("LOG_TO_EXCEL", "true").lower() == "false"
-export_mgr = RtExportManager(out_dir="exports", checkpoint_s=1.5)
+export_mgr = RtExportManager(out_dir="exports", checkpoint_s=1.5, buffer=data_buffer)
+capture_mgr = CaptureManager(out_dir=os.path.join("exports", "captures"), checkpoint_s=1.5)
 
 def _parse_opcua_urls(val: str) -> list[str]:
     if not val:
@@ -71,46 +83,20 @@ def _normalize_to_ip(url: str) -> str:
     except Exception:
         return url
     
-def _probe_tcp_fast(host: str, port: int, timeout: float = 0.12) -> bool:
-    try:
-        with socket.create_connection((host, port), timeout=timeout):
-            return True
-    except Exception:
-        return False
-
-def _tcp_ok_host_or_ip(host: str, port: int) -> tuple[bool, str | None]:
-    ip = None
-    try:
-        ip = socket.gethostbyname(host)
-    except Exception:
-        ip = None
-
-    ok = _probe_tcp_fast(host, port)
-    if not ok and ip:
-        ok = _probe_tcp_fast(ip, port)
-    return bool(ok), ip
-    
 def push_to_log(sample: dict):
-    logging.getLogger("uvicorn").info(
-        "push_to_log llamado | active=%s | sample_keys=%s",
-        export_mgr.active,
-        list(sample.keys())[:10] if isinstance(sample, dict) else type(sample)
-        )
-    try:
-        log_queue.put_nowait(sample)
-    except queue.Full:
-        pass
-
-    try:
-        data_buffer.append(sample)
-    except Exception:
-        pass
+    # on_sample de PLCReader (hilo de adquisición): solo encolar, nunca bloquear.
+    # data_buffer ya lo llena PLCReader; el export escribe en su propio hilo.
+    if excel_logger is not None:
+        try:
+            log_queue.put_nowait(sample)
+        except queue.Full:
+            pass
 
     # ✅ EXPORT RT
-    try:
-        export_mgr.ingest(sample)
-    except Exception as e:
-        logging.getLogger("uvicorn").exception("Error en export_mgr.ingest: %s", e)
+    export_mgr.ingest(sample)
+    capture_mgr.ingest(sample)
+    if historian is not None:
+        historian.ingest(sample)
 
 IS_EMBEDDED = os.getenv("PSI_EMBEDDED", "false").lower() == "true"
 
@@ -180,6 +166,21 @@ if ExcelLogger and LOG_TO_EXCEL:
                                flush_every=20, flush_interval=0.5)
     excel_logger.start()
 
+historian = None
+if HISTORIAN_ENABLED:
+    historian = Historian()
+    historian.start()
+app.state.historian = historian
+
+historian_maint = None
+if HISTORIAN_ENABLED and HISTORIAN_ROLLUP:
+    historian_maint = HistorianMaintenance()
+    historian_maint.start()
+historian_query = HistorianQuery()
+historian_excel = None
+if HISTORIAN_ENABLED and HISTORIAN_EXCEL:
+    historian_excel = HistorianExcelExporter()
+    historian_excel.start()
 
 
 @app.on_event("startup")
@@ -219,7 +220,8 @@ def _startup():
 
                 if url:
                     log.info("OPC UA elegido: %s", url)
-                    _plc = PLCReader(url, user, password, data_buffer, buffer_size=100)
+                    _plc = PLCReader(url, user, password, data_buffer, buffer_size=100,
+                                     on_sample=push_to_log)
                     _plc.start()
                     plc = _plc
                     backoff = 1.0
@@ -239,6 +241,19 @@ def _shutdown():
     try:
         if excel_logger:
             excel_logger.stop()
+            excel_logger.join(timeout=30)  # cierra el segmento abierto
+    except Exception:
+        pass
+    try:
+        if historian:
+            historian.stop()
+            historian.join(timeout=30)  # commit de lo encolado
+        if historian_maint:
+            historian_maint.stop()
+            historian_maint.join(timeout=30)
+        if historian_excel:
+            historian_excel.stop()
+            historian_excel.join(timeout=150)  # última pasada + cierre del segmento
     except Exception:
         pass
     try:
@@ -246,6 +261,13 @@ def _shutdown():
             plc.stop()  # si tu clase tiene stop(); si no, ignora
     except Exception:
         pass
+    try:
+        write_scheduler.stop()
+        if write_scheduler.is_alive():
+            write_scheduler.join(timeout=5)   # flush final de lo pendiente
+        opc_pool.close_all()
+    except Exception:
+        pass
 
 
 @router.get("/api/opcua/discover", response_model=list[OpcuaDiscoverItem])
@@ -305,35 +327,23 @@ def opcua_discover(request: Request, max_results: int = 20, deep: int = 0):
         seen.add(u)
         ordered.append((u, src))
 
-    # 3) probe TCP en paralelo (esto lo vuelve rápido)
+    # 3) probe TCP en paralelo: connects no bloqueantes en un event loop (plc/scanner.py)
     def split_host_port(url: str) -> tuple[str,int]:
         hp = url.split("://",1)[-1].split("/",1)[0]
         host = hp.split(":",1)[0]
         prt = int(hp.split(":",1)[1]) if ":" in hp else port
         return host, prt
 
-    items = []
-    with ThreadPoolExecutor(max_workers=24) as ex:
-        futs = {}
-        for url, src in ordered[:200]:  # límite duro, no te mates
-            host, prt = split_host_port(url)
-            futs[ex.submit(_tcp_ok_host_or_ip, host, prt)] = (url, host, prt, src)
-
-        for fut in as_completed(futs):
-            url, host, prt, src = futs[fut]
-            try:
-                ok, ip = fut.result()
-            except Exception:
-                ok, ip = False, None
-
-            items.append({
-                "url": url,
-                "host": host,
-                "ip": ip,
-                "port": prt,
-                "tcp_ok": bool(ok),
-                "source": src,
-            })
+    targets = [(url, src, *split_host_port(url)) for url, src in ordered[:200]]  # límite duro, no te mates
+    results = probe_tcp_many([(host, prt) for _, _, host, prt in targets])
+    items = [{
+        "url": url,
+        "host": host,
+        "ip": ip,
+        "port": prt,
+        "tcp_ok": bool(ok),
+        "source": src,
+    } for (url, src, host, prt), (ok, ip) in zip(targets, results)]
 
     # 4) ordenar: primero tcp_ok=True y luego por source
     prio = {"ui-host":0, "env":1, "known-hostname":2, "arp":3, "loopback":4, "deep-discovery":5}
@@ -355,7 +365,8 @@ def opcua_login(body: OpcuaLoginIn, request: Request):
         chosen = body.url.strip()
         expanded = _unique([chosen, _normalize_to_ip(chosen)])
 
-        winner = pick_first_alive_auth(u, p, expanded)
+        probe = probe_first_alive(expanded, user=u, password=p)
+        winner = probe["url"]
         if not winner:
             raise HTTPException(
                 status_code=401,
@@ -365,6 +376,7 @@ def opcua_login(body: OpcuaLoginIn, request: Request):
         CURRENT_OPCUA_USER = u
         CURRENT_OPCUA_PASS = p
         CURRENT_OPCUA_URL  = winner
+        opc_pool.configure(winner, u, p)
 
         try:
             if plc:
@@ -373,7 +385,7 @@ def opcua_login(body: OpcuaLoginIn, request: Request):
         except Exception:
             pass
 
-        return {"ok": True, "url": winner}
+        return {"ok": True, "url": winner, "probe_ms": probe["elapsed_ms"]}
 
     # 👇 SOLO si NO eligió nada recién haces discovery/fallback
     candidates = []
@@ -395,13 +407,15 @@ def opcua_login(body: OpcuaLoginIn, request: Request):
             expanded.append(u_ip)
     expanded = _unique(expanded)
 
-    winner = pick_first_alive_auth(u, p, expanded)
+    probe = probe_first_alive(expanded, user=u, password=p)
+    winner = probe["url"]
     if not winner:
         raise HTTPException(status_code=401, detail={"error": "No pude autenticar.", "tried": expanded[:30]})
 
     CURRENT_OPCUA_USER = u
     CURRENT_OPCUA_PASS = p
     CURRENT_OPCUA_URL  = winner
+    opc_pool.configure(winner, u, p)
 
     try:
         if plc:
@@ -410,7 +424,7 @@ def opcua_login(body: OpcuaLoginIn, request: Request):
     except Exception:
         pass
 
-    return {"ok": True, "url": winner}
+    return {"ok": True, "url": winner, "probe_ms": probe["elapsed_ms"]}
 
 @router.get("/api/opcua/endpoints")
 def opcua_endpoints(url: str | None = None):
@@ -490,11 +504,60 @@ async def ws(websocket: WebSocket):
 async def ws_write(websocket: WebSocket):
     await websocket_write_endpoint(websocket)
 
+@router.post("/api/opcua/write")
+def opcua_write(payload: dict = Body(...)):
+    # {"writes":[{"variable":..,"value":..},..]} -> un solo Write, status por item + RTT
+    session = opc_pool.current()
+    if session is None:
+        raise HTTPException(400, "Primero haz login en /api/opcua/login")
+    try:
+        items = parse_write_items(payload.get("writes"))
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    if not items:
+        raise HTTPException(400, "writes vacío")
+    try:
+        return session.write_many(items)
+    except Exception as e:
+        raise HTTPException(502, f"Write OPC UA falló: {e}")
+
+@router.get("/api/opcua/write/stats")
+def opcua_write_stats():
+    # latencia de escritura (p50/p95/max) por sesión + coalescing del scheduler
+    return {"sessions": opc_pool.status(), "scheduler": write_scheduler.stats()}
+
+@router.get("/api/ws/clients")
+def ws_clients():
+    # lag / drops / cola por cliente del fan-out de /ws
+    return ws_hub.status()
+
+@router.get("/api/ws/compression")
+def ws_compression_status():
+    # ratio y CPU de compresión por websocket (/ws y /ws_write)
+    return {
+        "default": ws_compression.COMPRESS_DEFAULT,
+        "level": ws_compression.COMPRESS_LEVEL,
+        "min_bytes": ws_compression.COMPRESS_MIN_BYTES,
+        "context_takeover": ws_compression.COMPRESS_CONTEXT,
+        "clients": ws_compression.status(),
+    }
+
+@router.get("/api/stream")
+async def api_stream(request: Request):
+    # SSE para paneles/proxies que no sostienen WebSocket
+    return await sse_stream(request)
+
+@router.get("/api/latest")
+async def api_latest(request: Request):
+    # long-poll con ETag = seq
+    return await latest_longpoll(request)
+
 @router.post("/api/export/start")
 def export_start(payload: dict = Body(...)):
     tags = payload.get("tags") or []
+    fmt = payload.get("format") or "xlsx"   # xlsx | csv | parquet | arrow
     try:
-        st = export_mgr.start(tags)
+        st = export_mgr.start(tags, fmt, payload.get("rate_hz"), payload.get("pre_seconds"))
         return {"ok": True, "status": st}
     except Exception as e:
         raise HTTPException(400, f"No pude iniciar export: {e}")
@@ -508,18 +571,201 @@ def export_stop():
 def export_status():
     return export_mgr.status()
 
-@router.get("/api/export/download")
-def export_download():
-    st = export_mgr.status()
+def _export_file(st: dict):
     path = st.get("path")
-    if not path or not os.path.exists(path):
+    if st.get("active") or not path or not os.path.exists(path):
         raise HTTPException(404, "No hay archivo para descargar todavía.")
     return FileResponse(
         path,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        media_type=st.get("media_type") or "application/octet-stream",
         filename=os.path.basename(path),
     )
 
+def _unlink_quiet(path: str):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def _export_live(sid: str | None):
+    """
+    Descarga durante la grabación: vista consistente de lo escrito hasta ahora.
+    La grabación solo se frena lo que dura un flush; el armado va en este request.
+    """
+    try:
+        s, snap = export_mgr.snapshot(sid)
+    except KeyError:
+        raise HTTPException(404, f"Export {sid} no existe")
+    except SnapshotUnavailable as e:
+        raise HTTPException(409, f"{e}; detené la grabación para descargar el archivo final.")
+    if snap is None:  # cerró mientras tanto: archivo final
+        return _export_file(s.status())
+
+    root, ext = os.path.splitext(os.path.basename(s.path))
+    filename = f"{root}_parcial{ext}"
+    headers = {"X-Export-Rows": str(snap["rows"])}
+    tmp = os.path.join(os.path.dirname(s.path), f".{root}_{time.time_ns()}{ext}")
+    try:
+        if snap["kind"] == "prefix":
+            # copia y suelta el .part enseguida: un descriptor abierto durante todo el
+            # download bloquea en Windows el rename final del stop()
+            with snap["file"], open(tmp, "wb") as out:
+                for data in read_prefix(snap["file"], snap["bytes"], snap["suffix"], chunk=1 << 20):
+                    out.write(data)
+        else:
+            snap["sink"].write_snapshot(tmp, snap)
+    except OSError:
+        # la sesión cerró y borró sus temporales a mitad del armado
+        _unlink_quiet(tmp)
+        st = s.status()
+        if st.get("active"):
+            raise HTTPException(503, "No pude armar la vista parcial, reintentá.")
+        return _export_file(st)
+    return FileResponse(
+        tmp,
+        media_type=s.status()["media_type"],
+        filename=filename,
+        headers=headers,
+        background=BackgroundTask(_unlink_quiet, tmp),
+    )
+
+@router.get("/api/export/download")
+def export_download():
+    st = export_mgr.status()
+    if st.get("active"):
+        return _export_live(st["id"])
+    return _export_file(st)
+
+@router.get("/api/logger/segments")
+def logger_segments():
+    # manifest de segmentos del ExcelLogger (si está habilitado)
+    if excel_logger is None:
+        return {"enabled": False, "segments": []}
+    return {"enabled": True, "segments": excel_logger.segments()}
+
+@router.get("/api/historian/status")
+def historian_status():
+    if historian is None:
+        return {"enabled": False}
+    st = {"enabled": True, **historian.status()}
+    st["excel"] = historian_excel.status() if historian_excel else None
+    st["maintenance"] = historian_maint.status() if historian_maint else None
+    return st
+
+@router.get("/api/historian/query")
+def historian_query_range(tags: str, start: str | None = Query(None, alias="from"),
+                          end: str | None = Query(None, alias="to"), bucket: str | None = None,
+                          agg: str = "min,max,avg,last"):
+    # tags=REAL.a,BOOL.b  from/to = epoch s o ISO  bucket = 1s | 5m | 1h ...  -> NDJSON en tramos
+    try:
+        t_to = parse_time(end, time.time())
+        t_from = parse_time(start, t_to - 3600)
+        lines = historian_query.stream(
+            [t.strip() for t in tags.split(",") if t.strip()], t_from, t_to, parse_bucket(bucket),
+            tuple(a.strip().lower() for a in agg.split(",") if a.strip()))
+    except FileNotFoundError as e:
+        raise HTTPException(404, str(e))
+    except KeyError as e:
+        raise HTTPException(404, f"Tags desconocidos: {e.args[0]}")
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+@router.get("/api/historian/excel/segments")
+def historian_excel_segments():
+    if historian_excel is None:
+        return {"enabled": False, "segments": []}
+    return {"enabled": True, "segments": historian_excel.segments()}
+
+# --- sesiones por id (varias grabaciones a la vez) ---
+@router.get("/api/export/sessions")
+def export_sessions():
+    return {"sessions": export_mgr.list()}
+
+def _export_session_status(sid: str) -> dict:
+    try:
+        return export_mgr.status(sid)
+    except KeyError:
+        raise HTTPException(404, f"Export {sid} no existe")
+
+@router.get("/api/export/{sid}/status")
+def export_session_status(sid: str):
+    return _export_session_status(sid)
+
+@router.post("/api/export/{sid}/stop")
+def export_session_stop(sid: str):
+    try:
+        st = export_mgr.stop(sid)
+    except KeyError:
+        raise HTTPException(404, f"Export {sid} no existe")
+    return {"ok": True, "status": st}
+
+@router.get("/api/export/{sid}/download")
+def export_session_download(sid: str):
+    st = _export_session_status(sid)
+    if st.get("active"):
+        return _export_live(sid)
+    return _export_file(st)
+
+# --- capturas por condición (flanco/umbral + ventanas pre/post) ---
+@router.post("/api/capture")
+def capture_create(payload: dict = Body(...)):
+    try:
+        st = capture_mgr.create(
+            payload.get("trigger") or "",
+            payload.get("tags") or [],
+            edge=(payload.get("edge") or "rising").lower(),
+            threshold=payload.get("threshold"),
+            hysteresis=payload.get("hysteresis") or 0.0,
+            pre_seconds=float(payload.get("pre_seconds", 5.0)),
+            post_seconds=float(payload.get("post_seconds", 5.0)),
+            fmt=(payload.get("format") or "xlsx").lower(),
+            rearm=bool(payload.get("rearm", True)),
+            holdoff_s=payload.get("holdoff_s") or 0.0,
+            max_triggers=payload.get("max_triggers"),
+            name=payload.get("name"),
+        )
+        return {"ok": True, "job": st}
+    except Exception as e:
+        raise HTTPException(400, f"No pude crear la captura: {e}")
+
+@router.get("/api/capture")
+def capture_list():
+    return capture_mgr.status()
+
+@router.get("/api/capture/{jid}")
+def capture_status(jid: str):
+    try:
+        return capture_mgr.get(jid).status()
+    except KeyError:
+        raise HTTPException(404, f"Captura {jid} no existe")
+
+@router.post("/api/capture/{jid}/disarm")
+def capture_disarm(jid: str):
+    try:
+        return {"ok": True, "job": capture_mgr.disarm(jid)}
+    except KeyError:
+        raise HTTPException(404, f"Captura {jid} no existe")
+
+@router.delete("/api/capture/{jid}")
+def capture_delete(jid: str):
+    try:
+        return {"ok": True, "job": capture_mgr.delete(jid)}
+    except KeyError:
+        raise HTTPException(404, f"Captura {jid} no existe")
+
+@router.get("/api/capture/{jid}/download")
+def capture_download(jid: str, n: int | None = None):
+    # n = número de disparo; sin n, la última captura terminada
+    try:
+        caps = capture_mgr.get(jid).status()["captures"]
+    except KeyError:
+        raise HTTPException(404, f"Captura {jid} no existe")
+    cap = next((c for c in reversed(caps) if n is None or c["n"] == n), None)
+    if cap is None:
+        raise HTTPException(404, "No hay captura terminada para descargar.")
+    return _export_file({"path": cap["path"], "media_type": cap["media_type"]})
+
 
 
 BASE_DIR = Path(getattr(sys, "_MEIPASS", Path(__file__).resolve().parent))
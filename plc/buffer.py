@@ -1,9 +1,14 @@
 # plc/buffer.py
-import threading
+import os, threading
+from bisect import bisect_left
 from collections import deque
+from itertools import islice
+
+# ~100 s a 50 Hz con el default; es también la ventana máxima de pre_seconds en exports
+DATA_BUFFER_MAXLEN = int(os.getenv("DATA_BUFFER_MAXLEN", "5000"))
 
 class DataBuffer:
-    def __init__(self, maxlen=5000):
+    def __init__(self, maxlen=DATA_BUFFER_MAXLEN):
         self._lock = threading.Lock()
         self._dq = deque(maxlen=maxlen)
         self._seq = 0
@@ -20,11 +25,32 @@ class DataBuffer:
         with self._lock:
             return self._dq[-1] if self._dq else None
 
-    def after(self, last_seq: int | None) -> list[dict]:
+    def after(self, last_seq: int | None, limit: int | None = None) -> list[dict]:
+        # los __seq__ son consecutivos dentro del deque -> posición directa, sin escanear
         with self._lock:
+            if not self._dq:
+                return []
             if last_seq is None:
-                return list(self._dq)
-            return [s for s in self._dq if s.get("__seq__", 0) > last_seq]
+                start = 0
+            else:
+                start = max(0, last_seq - self._dq[0]["__seq__"] + 1)
+            stop = None if limit is None else start + max(0, limit)
+            return list(islice(self._dq, start, stop))
+
+    def since(self, ts: float) -> list[dict]:
+        """Muestras con timestamp >= ts: bisect sobre el deque y copia solo de la cola."""
+        with self._lock:
+            dq = self._dq
+            i = bisect_left(dq, ts, key=lambda s: s.get("timestamp", 0.0))
+            tail = list(islice(reversed(dq), len(dq) - i))  # recorre solo la cola
+        tail.reverse()
+        return tail
+
+    def seq_range(self) -> tuple[int | None, int]:
+        """(seq más antiguo retenido o None si vacío, último seq emitido)."""
+        with self._lock:
+            oldest = self._dq[0]["__seq__"] if self._dq else None
+            return oldest, self._seq
 
     def __len__(self):
         with self._lock:
@@ -34,4 +60,4 @@ class DataBuffer:
         with self._lock:
             self._dq.clear()
 
-data_buffer = DataBuffer(maxlen=5000)
+data_buffer = DataBuffer()
@@ -1,14 +1,20 @@
 from __future__ import annotations
-import os, re, socket, ipaddress, logging, subprocess, sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os, re, socket, struct, time, ipaddress, logging, subprocess, sys
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import Iterable, List, Tuple, Literal
+from plc.scanner import net_hosts, scan
 
 log = logging.getLogger("psi.discovery")
 
 PORT = int(os.getenv("DISCOVERY_PORT", "4840"))
 TCP_TMO  = float(os.getenv("DISCOVERY_TCP_TIMEOUT_S", "0.25"))
 OPC_TMO  = float(os.getenv("DISCOVERY_OPC_TIMEOUT_S", "2.5"))
-MAX_PER_NET = int(os.getenv("DISCOVERY_MAX_HOSTS_PER_NET", "256"))
+MAX_PER_NET = int(os.getenv("DISCOVERY_MAX_HOSTS_PER_NET", "256"))    # solo sin scan (lista sin probar)
+SCAN_ENABLED = os.getenv("DISCOVERY_SCAN", "true").lower() == "true"   # subredes con plc/scanner.py
+HEL_TMO  = float(os.getenv("DISCOVERY_HEL_TIMEOUT_S", "1.0"))     # espera del ACK al Hello
+PROBE_WORKERS = int(os.getenv("DISCOVERY_PROBE_WORKERS", "64"))   # TCP + Hello en paralelo
+AUTH_WORKERS  = int(os.getenv("DISCOVERY_AUTH_WORKERS", "2"))     # logins en paralelo (credenciales)
+PROBE_DEADLINE_S = float(os.getenv("DISCOVERY_PROBE_DEADLINE_S", "30"))
 
 ProbeStatus = Literal["OK", "AUTH_INVALID", "DOWN"]
 
@@ -29,6 +35,42 @@ def _probe_tcp_host(host: str, port: int = PORT, timeout: float = TCP_TMO) -> bo
     except Exception:
         return False
 
+def _split_url(url: str) -> Tuple[str, int]:
+    hp = url.split("://", 1)[-1].split("/", 1)[0]
+    host, _, prt = hp.partition(":")
+    try:
+        return host, int(prt) if prt else PORT
+    except ValueError:
+        return host, PORT
+
+def _hello(url: str) -> bytes:
+    # OPC UA Part 6: HEL + 'F' + tamaño, versión 0, buffers 64 KiB, sin límites, EndpointUrl
+    ep = url.encode("utf-8")
+    body = struct.pack("<5Ii", 0, 65536, 65536, 0, 0, len(ep)) + ep
+    return b"HELF" + struct.pack("<I", 8 + len(body)) + body
+
+def _probe_hel(url: str, tcp_timeout: float = TCP_TMO, hel_timeout: float = HEL_TMO) -> Tuple[bool, bool]:
+    """(tcp_ok, opcua_ok): conecta y manda un Hello; un ACK prueba que es un server OPC UA."""
+    host, port = _split_url(url)
+    try:
+        s = socket.create_connection((host, port), timeout=tcp_timeout)
+    except Exception:
+        return False, False
+    try:
+        s.settimeout(hel_timeout)
+        s.sendall(_hello(url))
+        head = b""
+        while len(head) < 8:
+            part = s.recv(8 - len(head))
+            if not part:
+                break
+            head += part
+        return True, head[:3] == b"ACK"
+    except Exception:
+        return True, False
+    finally:
+        s.close()
+
 def _probe_opcua(url: str, user="", password="", timeout=OPC_TMO) -> Tuple[ProbeStatus, str]:
     from opcua import Client
     try:
@@ -130,17 +172,8 @@ def _mdns_discover(timeout: float = 1.5) -> List[str]:
     return _unique(urls)
 
 def _limit_hosts(net: ipaddress.IPv4Network) -> Iterable[str]:
-    # samplea sin convertir toda la red a lista (evita reventar en /16, /8, etc.)
-    total = net.num_addresses - 2 if net.prefixlen <= 30 else net.num_addresses
-    if total <= 0:
-        return []
-
-    step = max(1, total // MAX_PER_NET)
-    i = 0
-    for host in net.hosts():
-        if i % step == 0:
-            yield str(host)
-        i += 1
+    # muestreo parejo por aritmética (no recorre la red: un /16 ya no son 65k vueltas)
+    return net_hosts(net, MAX_PER_NET)
 
 def _hostname_candidates() -> List[str]:
     # “comunes”, pero no dependes de ellos
@@ -172,58 +205,81 @@ def discover_opcua_urls(extra_candidates: Iterable[str] = ()) -> List[str]:
     for ip in _neighbors_arp():
         candidates.append(f"opc.tcp://{ip}:{PORT}")
 
-    # 5) scan subredes locales, pero limitado
-    for net in _local_networks():
-        for host in _limit_hosts(net):
-            candidates.append(f"opc.tcp://{host}:{PORT}")
+    # 5) subredes locales: con scan vuelven solo los hosts con el puerto abierto
+    nets = _local_networks()
+    if SCAN_ENABLED and nets:
+        hosts = scan(nets, PORT)
+    else:
+        hosts = [h for net in nets for h in _limit_hosts(net)]
+    for host in hosts:
+        candidates.append(f"opc.tcp://{host}:{PORT}")
 
     return _unique(candidates)
 
-def pick_first_alive_any(urls: Iterable[str]) -> str | None:
-    urls = list(_unique(urls))
-    # filtro TCP rápido
-    fast = []
-    for u in urls:
-        host = u.split("://",1)[-1].split(":",1)[0].split("/",1)[0]
-
-        ok = _probe_tcp_host(host)
-        if not ok:
-            try:
-                ip = socket.gethostbyname(host)
-                ok = _probe_tcp_host(ip)
-            except Exception:
-                ok = False
-
-        if ok:
-            fast.append(u)
-
-    for u in fast:
-        st, _ = _probe_opcua(u)
-        if st in ("OK", "AUTH_INVALID"):
-            return u
-    return None
+def probe_first_alive(urls: Iterable[str], user: str | None = None, password: str = "",
+                      deadline_s: float = PROBE_DEADLINE_S) -> dict:
+    """
+    Prueba todos los candidatos a la vez, por etapas: TCP -> Hello/ACK de OPC UA
+    (mismo socket) -> login (solo si hay 'user', en un pool chico para no regar
+    credenciales). El orden de 'urls' es la prioridad: gana el primero que pasa
+    todas las etapas una vez que todos los anteriores fallaron; en ese momento
+    se cancela lo pendiente. Al vencer 'deadline_s' gana el mejor que ya pasó.
+    """
+    urls = _unique(urls)
+    t0 = time.perf_counter()
+    n = len(urls)
+    state = [None] * n          # None = pendiente | True = pasó | False = descartado
+    stats = {"tried": n, "tcp_ok": 0, "opcua_ok": 0, "auth_ok": 0}
+    first_ok_ms = None
+    winner, head = None, 0
+    net = ThreadPoolExecutor(max(1, min(PROBE_WORKERS, n)), thread_name_prefix="discovery")
+    auth = ThreadPoolExecutor(max(1, AUTH_WORKERS), thread_name_prefix="discovery-auth")
+    try:
+        futs = {net.submit(_probe_hel, u): (i, "hel") for i, u in enumerate(urls)}
+        end = time.monotonic() + deadline_s
+        while futs and winner is None:
+            done, _ = wait(futs, timeout=max(0.0, end - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break   # deadline
+            for f in done:
+                i, stage = futs.pop(f)
+                if stage == "hel":
+                    try:
+                        tcp_ok, ok = f.result()
+                    except Exception:
+                        tcp_ok, ok = False, False
+                    stats["tcp_ok"] += tcp_ok
+                    stats["opcua_ok"] += ok
+                    if ok and user:
+                        futs[auth.submit(_probe_opcua, urls[i], user, password)] = (i, "auth")
+                        continue
+                else:
+                    try:
+                        ok = f.result()[0] == "OK"
+                    except Exception:
+                        ok = False
+                    stats["auth_ok"] += ok
+                state[i] = ok
+                if ok and first_ok_ms is None:
+                    first_ok_ms = round((time.perf_counter() - t0) * 1000, 1)
+            while head < n and state[head] is False:
+                head += 1
+            if head < n and state[head]:
+                winner = urls[head]
+        if winner is None:
+            winner = next((u for u, ok in zip(urls, state) if ok), None)
+    finally:
+        net.shutdown(wait=False, cancel_futures=True)
+        auth.shutdown(wait=False, cancel_futures=True)
+    elapsed_ms = round((time.perf_counter() - t0) * 1000, 1)
+    log.info("discovery: %s en %.0f ms (%d candidatos, tcp %d, opcua %d%s)",
+             winner or "ninguno", elapsed_ms, n, stats["tcp_ok"], stats["opcua_ok"],
+             f", login {stats['auth_ok']}" if user else "")
+    return {"url": winner, "elapsed_ms": elapsed_ms, "first_ok_ms": first_ok_ms, **stats}
 
+def pick_first_alive_any(urls: Iterable[str]) -> str | None:
+    # un ACK al Hello ya prueba el server (el login lo valida quien se conecte)
+    return probe_first_alive(urls)["url"]
 
 def pick_first_alive_auth(user: str, password: str, urls: Iterable[str]) -> str | None:
-    urls = list(_unique(urls))
-
-    fast = []
-    for u in urls:
-        host = u.split("://",1)[-1].split(":",1)[0].split("/",1)[0]
-
-        ok = _probe_tcp_host(host)
-        if not ok:
-            try:
-                ip = socket.gethostbyname(host)
-                ok = _probe_tcp_host(ip)
-            except Exception:
-                ok = False
-
-        if ok:
-            fast.append(u)
-
-    for u in fast:
-        st, _ = _probe_opcua(u, user=user, password=password)
-        if st == "OK":
-            return u
-    return None
+    return probe_first_alive(urls, user=user, password=password)["url"]
@@ -237,10 +237,13 @@ class PLCReader:
                         except Exception:
                             pass
 
-                    self.buffer.append(vars_by_type)
+                    seq = self.buffer.append(vars_by_type)
                     if self.on_sample:
                         try:
-                            self.on_sample(dict(vars_by_type))
+                            sample = dict(vars_by_type)
+                            if isinstance(seq, int):
+                                sample["__seq__"] = seq  # mismo seq que en data_buffer
+                            self.on_sample(sample)
                         except Exception:
                             pass
 
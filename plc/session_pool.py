@@ -0,0 +1,285 @@
+# plc/session_pool.py
+import logging, math, threading, time
+from collections import deque
+from opcua import ua
+from plc.opc_client import PLCReader
+from plc.write_scheduler import WriteScheduler
+
+log = logging.getLogger("psi.session_pool")
+
+PLC_PRG_PATH = ("Objects", "Datalayer", "plc", "app", "Application", "sym", "PLC_PRG")
+
+_INT_RANGES = {
+    ua.VariantType.SByte:  (-2**7,  2**7 - 1),
+    ua.VariantType.Byte:   (0,      2**8 - 1),
+    ua.VariantType.Int16:  (-2**15, 2**15 - 1),
+    ua.VariantType.UInt16: (0,      2**16 - 1),
+    ua.VariantType.Int32:  (-2**31, 2**31 - 1),
+    ua.VariantType.UInt32: (0,      2**32 - 1),
+    ua.VariantType.Int64:  (-2**63, 2**63 - 1),
+    ua.VariantType.UInt64: (0,      2**64 - 1),
+}
+_FLOAT32_MAX = 3.4028234663852886e38
+
+def coerce_value(value, vt: ua.VariantType | None):
+    """Convierte el valor JSON al tipo del tag (BOOL, INT/DINT/.., REAL/LREAL, STRING)."""
+    if vt is None:
+        raise ValueError("DataType del tag desconocido")
+    if vt == ua.VariantType.Boolean:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, (int, float)) and value in (0, 1):
+            return bool(value)
+        if isinstance(value, str) and value.strip().lower() in ("true", "false", "1", "0"):
+            return value.strip().lower() in ("true", "1")
+        raise ValueError(f"{value!r} no es BOOL")
+    if vt in _INT_RANGES:
+        if isinstance(value, bool):
+            v = int(value)
+        elif isinstance(value, int):
+            v = value
+        elif isinstance(value, float) and value.is_integer():
+            v = int(value)
+        elif isinstance(value, str):
+            v = int(value.strip(), 0)
+        else:
+            raise ValueError(f"{value!r} no es entero")
+        lo, hi = _INT_RANGES[vt]
+        if not lo <= v <= hi:
+            raise ValueError(f"{v} fuera de rango para {vt.name} [{lo}, {hi}]")
+        return v
+    if vt in (ua.VariantType.Float, ua.VariantType.Double):
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError(f"{value!r} no es numérico")
+        v = float(value)
+        if vt == ua.VariantType.Float and math.isfinite(v) and abs(v) > _FLOAT32_MAX:
+            raise ValueError(f"{v} fuera de rango para REAL")
+        return v
+    if vt == ua.VariantType.String:
+        return value if isinstance(value, str) else str(value)
+    return value
+
+class OpcSession:
+    """
+    Una conexión OPC UA autenticada (la misma elección de endpoint que PLCReader)
+    + índice nombre -> (NodeId, VariantType) armado UNA vez al conectar.
+    Con eso una escritura es un solo Write al servidor, sin browse por escritura.
+    """
+    def __init__(self, url: str, user: str, password: str):
+        self.url, self.user, self.password = url, user, password
+        self._lock = threading.Lock()
+        self._cli = None
+        self.index: dict[str, tuple[ua.NodeId, ua.VariantType | None]] = {}
+        self.connected_at = None
+
+        self.writes = 0
+        self.write_errors = 0
+        self.reconnects = 0
+        self._lat_ms = deque(maxlen=512)
+
+    # --- conexión + índice ---
+    def _connect(self):
+        reader = PLCReader(self.url, self.user, self.password, None)
+        cli = reader._connect_with_best_endpoint()
+        try:
+            plc_prg = reader.browse_by_names(cli.get_root_node(), *PLC_PRG_PATH)
+            if plc_prg is None:
+                raise RuntimeError("No encuentro PLC_PRG en el Data Layer")
+            self.index = self._build_index(cli, plc_prg)
+        except Exception:
+            try:
+                cli.disconnect()
+            except Exception:
+                pass
+            raise
+        self._cli = cli
+        if self.connected_at is not None:   # la primera conexión no es reconexión
+            self.reconnects += 1
+        self.connected_at = time.time()
+        log.info("OPC session %s lista: %d variables indexadas", self.url, len(self.index))
+
+    @staticmethod
+    def _build_index(cli, plc_prg) -> dict:
+        # 1 Browse (nombre + NodeId de todos los hijos) + 1 Read (DataType de todos)
+        refs = plc_prg.get_children_descriptions()
+        nodeids = [r.NodeId for r in refs]
+        rvs = []
+        for nid in nodeids:
+            rv = ua.ReadValueId()
+            rv.NodeId = nid
+            rv.AttributeId = ua.AttributeIds.DataType
+            rvs.append(rv)
+        params = ua.ReadParameters()
+        params.NodesToRead = rvs
+        results = cli.uaclient.read(params) if rvs else []
+
+        index = {}
+        for ref, res in zip(refs, results):
+            vt = None
+            try:
+                dt = res.Value.Value
+                # tipos base (ns=0, 1..25) comparten número con VariantType
+                if dt is not None and dt.NamespaceIndex == 0 and isinstance(dt.Identifier, int):
+                    vt = ua.VariantType(dt.Identifier)
+            except Exception:
+                vt = None
+            index[ref.BrowseName.Name] = (ref.NodeId, vt)
+        return index
+
+    def ensure(self):
+        with self._lock:
+            if self._cli is None:
+                self._connect()
+
+    def close(self):
+        with self._lock:
+            self._drop()
+
+    def _drop(self):
+        cli, self._cli = self._cli, None
+        if cli is not None:
+            try:
+                cli.disconnect()
+            except Exception:
+                pass
+
+    # --- escritura ---
+    def write_many(self, items: list[tuple[str, object]]) -> dict:
+        """
+        Escribe muchas variables en UN solo Write. Cada valor se convierte al
+        DataType real del tag (índice del browse), no al tipo Python.
+        Devuelve {"ok", "ms", "results": [{variable, status, code, msg?}]}.
+        """
+        with self._lock:
+            if self._cli is None:
+                self._connect()
+
+            results: list[dict] = []
+            to_write = []   # (idx en results, WriteValue)
+            for name, value in items:
+                res = {"variable": name, "status": "error", "code": None}
+                results.append(res)
+                entry = self.index.get(name)
+                if entry is None:
+                    res["code"], res["msg"] = "BadNodeIdUnknown", "Variable no encontrada"
+                    continue
+                nodeid, vt = entry
+                try:
+                    variant = ua.Variant(coerce_value(value, vt), vt)
+                except (TypeError, ValueError) as e:
+                    res["code"], res["msg"] = "BadTypeMismatch", str(e)
+                    continue
+                wv = ua.WriteValue()
+                wv.NodeId = nodeid
+                wv.AttributeId = ua.AttributeIds.Value
+                wv.Value = ua.DataValue(variant)
+                to_write.append((len(results) - 1, wv))
+
+            ms = 0.0
+            if to_write:
+                params = ua.WriteParameters()
+                params.NodesToWrite = [wv for _, wv in to_write]
+                t0 = time.perf_counter()
+                try:
+                    codes = self._cli.uaclient.write(params)
+                except Exception:
+                    # conexión caída: la próxima escritura reconecta
+                    self.write_errors += len(to_write)
+                    self._drop()
+                    raise
+                ms = (time.perf_counter() - t0) * 1000.0
+                self._lat_ms.append(ms)
+                for (i, _), sc in zip(to_write, codes):
+                    results[i]["code"] = sc.name
+                    if sc.is_good():
+                        results[i]["status"] = "ok"
+                        self.writes += 1
+                    else:
+                        self.write_errors += 1
+
+            return {
+                "ok": all(r["status"] == "ok" for r in results),
+                "ms": round(ms, 2),
+                "results": results,
+            }
+
+    def write(self, name: str, value) -> float:
+        """Escribe un solo tag; devuelve la latencia en ms. Lanza KeyError/ValueError/ua.UaError."""
+        out = self.write_many([(name, value)])
+        r = out["results"][0]
+        if r["status"] != "ok":
+            if r["code"] == "BadNodeIdUnknown":
+                raise KeyError(name)
+            if r["code"] == "BadTypeMismatch" and r.get("msg"):
+                raise ValueError(r["msg"])
+            raise ua.UaError(r["code"])
+        return out["ms"]
+
+    def stats(self) -> dict:
+        lat = sorted(self._lat_ms)
+        pct = lambda p: round(lat[min(len(lat) - 1, int(p * len(lat)))], 2) if lat else None
+        return {
+            "url": self.url,
+            "user": self.user,
+            "connected": self._cli is not None,
+            "connected_at": self.connected_at,
+            "variables": len(self.index),
+            "writes": self.writes,
+            "write_errors": self.write_errors,
+            "reconnects": self.reconnects,
+            "write_ms_last": round(self._lat_ms[-1], 2) if self._lat_ms else None,
+            "write_ms_p50": pct(0.50),
+            "write_ms_p95": pct(0.95),
+            "write_ms_max": round(lat[-1], 2) if lat else None,
+        }
+
+def parse_write_items(writes) -> list[tuple[str, object]]:
+    """[{"variable": .., "value": ..}, ..] (o {"nombre": valor}) -> [(nombre, valor)]."""
+    if isinstance(writes, dict):
+        return [(str(k), v) for k, v in writes.items()]
+    items = []
+    for w in writes or []:
+        if not isinstance(w, dict) or not w.get("variable"):
+            raise ValueError("cada write necesita 'variable' y 'value'")
+        items.append((str(w["variable"]), w.get("value")))
+    return items
+
+class SessionPool:
+    """Sesiones compartidas por (url, user); la 'actual' es la del último /api/opcua/login."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions: dict[tuple[str, str], OpcSession] = {}
+        self._current: tuple[str, str, str] | None = None
+
+    def configure(self, url: str, user: str, password: str):
+        with self._lock:
+            self._current = (url, user, password)
+            stale = [k for k, s in self._sessions.items()
+                     if k != (url, user) or s.password != password]
+            for k in stale:
+                self._sessions.pop(k).close()
+
+    def get(self, url: str, user: str, password: str) -> OpcSession:
+        with self._lock:
+            s = self._sessions.get((url, user))
+            if s is None or s.password != password:
+                s = OpcSession(url, user, password)
+                self._sessions[(url, user)] = s
+            return s
+
+    def current(self) -> OpcSession | None:
+        cur = self._current
+        return self.get(*cur) if cur else None
+
+    def close_all(self):
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for s in sessions:
+            s.close()
+
+    def status(self) -> list[dict]:
+        with self._lock:
+            return [s.stats() for s in self._sessions.values()]
+
+opc_pool = SessionPool()
+write_scheduler = WriteScheduler(opc_pool)
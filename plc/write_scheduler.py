@@ -0,0 +1,163 @@
+# plc/write_scheduler.py
+import logging, os, threading, time
+from collections import deque
+
+log = logging.getLogger("psi.write_scheduler")
+
+WRITE_MAX_HZ = float(os.getenv("WRITE_MAX_HZ", "20"))   # máx. Write/s hacia el PLC
+WRITE_MAX_RETRIES = int(os.getenv("WRITE_MAX_RETRIES", "5"))              # reintentos por valor fallido
+WRITE_RETRY_BACKOFF_S = float(os.getenv("WRITE_RETRY_BACKOFF_S", "0.25"))  # 1er reintento; se duplica
+WRITE_RETRY_MAX_S = float(os.getenv("WRITE_RETRY_MAX_S", "5"))            # tope del backoff
+
+# rechazos del servidor (o nuestros) que no se arreglan reintentando el mismo valor
+PERMANENT_CODES = {
+    "BadNodeIdUnknown", "BadTypeMismatch", "BadNotWritable", "BadUserAccessDenied",
+    "BadOutOfRange", "BadWriteNotSupported", "BadAttributeIdInvalid", "BadIndexRangeInvalid",
+}
+
+class WriteScheduler(threading.Thread):
+    """
+    Coalescing de setpoints (slider arrastrado = decenas de writes/s):
+      • submit() guarda el último valor por tag (latest wins) y vuelve enseguida
+      • un hilo vacía lo pendiente como UN write_many, a lo sumo WRITE_MAX_HZ veces/s
+    El PLC ve el mismo estado final con muchos menos Writes.
+    Un valor que falla (sin sesión, excepción o status Bad transitorio) vuelve a
+    pendientes salvo que ya haya uno más nuevo del mismo tag; como mucho
+    'max_retries' veces, con backoff exponencial entre intentos.
+    """
+    def __init__(self, pool, max_hz: float = WRITE_MAX_HZ, max_retries: int = WRITE_MAX_RETRIES,
+                 backoff_s: float = WRITE_RETRY_BACKOFF_S):
+        super().__init__(daemon=True)
+        self.pool = pool
+        self.min_period = 1.0 / max(0.1, max_hz)
+        self.max_retries = max(0, max_retries)
+        self.backoff_s = max(0.0, backoff_s)
+        self._lock = threading.Lock()
+        self._pending: dict[str, object] = {}
+        self._tries: dict[str, int] = {}   # reintentos ya hechos del valor pendiente de cada tag
+        self._retry_at = 0.0               # monotonic: no volver a escribir antes (backoff)
+        self._event = threading.Event()
+        self._stop_evt = threading.Event()   # no pisar Thread._stop (is_alive/join lo llaman)
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.flushes = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.last_flush_ms = None
+        self.last_errors = deque(maxlen=20)
+
+    def submit(self, name: str, value):
+        with self._lock:
+            if name in self._pending:
+                self.coalesced += 1
+            self._pending[name] = value
+            self._tries.pop(name, None)   # valor nuevo: sus reintentos arrancan de cero
+            self.submitted += 1
+        self._event.set()
+        if not self.is_alive() and not self._stop_evt.is_set():
+            try:
+                self.start()
+            except RuntimeError:
+                pass  # otro hilo lo arrancó primero
+
+    def stop(self):
+        self._stop_evt.set()
+        self._event.set()
+
+    def run(self):
+        last = 0.0
+        while not self._stop_evt.is_set():
+            self._event.wait(timeout=1.0)
+            now = time.monotonic()
+            wait = max(self.min_period - (now - last), self._retry_at - now)
+            if wait > 0:
+                # lo que llegue mientras tanto se sigue coalesciendo; stop() corta la espera
+                self._stop_evt.wait(wait)
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                tries, self._tries = self._tries, {}
+                self._event.clear()
+            if not batch:
+                continue
+            last = time.monotonic()
+            self._flush(batch, tries)
+        # último setpoint de un arrastre que quedó coalesciendo al apagar (un intento;
+        # si falla queda en pendientes, visible en stats())
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            tries, self._tries = self._tries, {}
+        if batch:
+            self._flush(batch, tries)
+
+    def _flush(self, batch: dict, tries: dict):
+        session = self.pool.current()
+        if session is None:
+            self._failed(batch, tries, "sin sesión OPC UA (login)")
+            return
+        try:
+            out = session.write_many(list(batch.items()))
+        except Exception as e:
+            log.warning("WriteScheduler flush falló (%d tags): %s", len(batch), e)
+            self._failed(batch, tries, str(e))
+            return
+        self.flushes += 1
+        self.last_flush_ms = out["ms"]
+        retry = {}
+        for r in out["results"]:
+            if r["status"] == "ok":
+                self.sent += 1
+                continue
+            self.last_errors.append({"t": time.time(), "variable": r["variable"],
+                                     "code": r["code"], "msg": r.get("msg")})
+            if r["code"] in PERMANENT_CODES:
+                self.failed += 1
+                self.dropped += 1
+            else:
+                retry[r["variable"]] = batch[r["variable"]]
+        if retry:
+            self._failed(retry, tries, None)
+
+    def _failed(self, batch: dict, tries: dict, msg: str | None):
+        """Devuelve a pendientes lo fallido (si no llegó algo más nuevo) y agenda el backoff."""
+        self.failed += len(batch)
+        if msg is not None:
+            self.last_errors.append({"t": time.time(), "msg": msg})
+        requeued, worst = 0, 0
+        with self._lock:
+            for name, value in batch.items():
+                if name in self._pending:
+                    continue   # llegó un valor más nuevo: ese manda
+                n = tries.get(name, 0) + 1
+                if n > self.max_retries:
+                    self.dropped += 1
+                    log.warning("WriteScheduler: %s=%r descartado tras %d reintentos", name, value, n - 1)
+                    continue
+                self._pending[name] = value
+                self._tries[name] = n
+                requeued += 1
+                worst = max(worst, n)
+            if requeued:
+                self.retried += requeued
+                delay = min(WRITE_RETRY_MAX_S, self.backoff_s * 2 ** (worst - 1))
+                self._retry_at = time.monotonic() + delay
+                self._event.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "max_hz": round(1.0 / self.min_period, 2),
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "pending": pending,
+            "last_flush_ms": self.last_flush_ms,
+            "last_errors": list(self.last_errors),
+        }
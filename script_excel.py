@@ -4,9 +4,11 @@ from typing import Dict, Any, List, Tuple
 from threading import Lock
 
 from opcua import Client, ua
+from opcua.common.subscription import Subscription
 import aiosqlite
-import pandas as pd
 from fastapi import FastAPI, WebSocket
+from utils.excel_logger import _first_free_index, _segment_path
+from utils.xlsx_stream import XlsxStreamWriter, recover_dir
 
 # ===== OPC UA =====
 OPCUA_URL     = "opc.tcp://192.168.17.60:4840"
@@ -23,6 +25,7 @@ PUBLISHING_MS = 50
 QUEUE_SIZE    = 20000
 BATCH_FLUSH   = 200
 EXCEL_PERIOD  = 5          # seg entre volcados a Excel
+EXCEL_FETCH   = 20000      # filas SQLite por página en cada volcado
 WS_SEND_MS    = 100        # periodo de envío por WebSocket (ms)
 CHUNK_CREATE  = 500        # crea MonitoredItems por tandas
 
@@ -73,8 +76,10 @@ async def writer_task():
 
 # ---------------- Excel incremental (encabezados por alias) ----------------
 
+XLSX_PREFIX = "OPC_"
+
 def _daily_xlsx_path() -> str:
-    return f"logs/OPC_{datetime.now().strftime('%Y-%m-%d')}.xlsx"
+    return f"logs/{XLSX_PREFIX}{datetime.now().strftime('%Y-%m-%d')}.xlsx"
 
 def _ordered_aliases() -> List[str]:
     with LOCK:
@@ -83,82 +88,111 @@ def _ordered_aliases() -> List[str]:
     pairs.sort(key=lambda x: x[0].lower())
     return [p[0] for p in pairs]  # solo alias ordenados
 
+def _cell(sval):
+    # values vienen como TEXT: número / bool vuelven a su tipo, el resto queda texto
+    if sval is None:
+        return None
+    if sval in ("True", "False"):
+        return sval == "True"
+    try:
+        return float(sval)
+    except ValueError:
+        return sval
+
+def _open_daily_writer():
+    path = _daily_xlsx_path()
+    if os.path.exists(path):  # reinicio en el mismo día: segmento nuevo, no se reabre el zip
+        path = _segment_path(path, _first_free_index(path))
+    wb = XlsxStreamWriter(path)
+    sheet = wb.add_sheet("data", table_name="tbl_data")
+    cols = {a: i for i, a in enumerate(_ordered_aliases(), start=1)}
+    sheet.header = ["ts"] + list(cols)
+    return wb, sheet, cols
+
+def _export_increment(con, last_id: int, state: dict) -> int:
+    """
+    Lee solo filas con id > last_id (paginado) y las agrega al writer abierto.
+    El grupo del ts más nuevo queda en state["carry"]: writer_task commitea de a
+    BATCH_FLUSH filas y el resto de ese ts puede llegar en la pasada siguiente.
+    """
+    by_ts: Dict[str, list] = state.pop("carry", {})
+    fetched = 0
+    while True:
+        rows = con.execute(
+            "SELECT id, ts, node, value FROM samples WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, EXCEL_FETCH)).fetchall()
+        if not rows:
+            break
+        with LOCK:
+            aliases = {nid: alias_map.get(nid, nid) for nid in {r[2] for r in rows}}
+        cols, sheet = state["cols"], state["sheet"]
+        for _id, ts, node, value in rows:
+            alias = aliases[node]
+            i = cols.get(alias)
+            if i is None:  # variable nueva: columna al final
+                i = cols[alias] = len(sheet.header)
+                sheet.header.append(alias)
+            row = by_ts.get(ts)
+            if row is None:
+                row = by_ts[ts] = [ts]
+            if len(row) <= i:
+                row.extend([None] * (i + 1 - len(row)))
+            row[i] = _cell(value)  # "last" por ts, como el pivot de antes
+        last_id = rows[-1][0]
+        fetched += len(rows)
+        if len(rows) < EXCEL_FETCH:
+            break
+    if fetched and by_ts:
+        # pasada sin filas nuevas: el grupo retenido ya está completo
+        newest = max(by_ts)
+        state["carry"] = {newest: by_ts.pop(newest)}
+    for ts in sorted(by_ts):
+        state["sheet"].append(by_ts[ts])
+    state["wb"].flush()
+    return last_id
+
+def _close_daily(state: dict):
+    for ts, row in sorted(state.pop("carry", {}).items()):
+        state["sheet"].append(row)
+    state["wb"].close()
+
 async def excel_exporter_task():
     """
     Toma filas nuevas de SQLite y las vuelca a un Excel “ancho”:
     columnas = ['ts'] + alias1 + alias2 + ...
-    cada ejecución agrega filas debajo con los valores más recientes por ts.
+    Incremental: recuerda el último id, consulta parametrizada y agrega en
+    streaming (XlsxStreamWriter); el .xlsx del día se arma al cambiar de día o al
+    apagar, sin recargar el libro en cada pasada.
     """
+    import sqlite3
+    # libro del día que quedó a medias (crash/kill): se arma hasta su último flush.
+    # Solo los OPC_*: en logs/ también escribe el ExcelLogger de main.py (con su manifest)
+    await asyncio.to_thread(recover_dir, "logs", prefix=XLSX_PREFIX)
     last_id = 0
-    wrote_header_for_today = False
-    last_day = datetime.now().day
-
-    while True:
-        try:
-            # Detecta cambio de día (nuevo archivo y nuevo header)
-            today = datetime.now().day
-            if today != last_day:
-                wrote_header_for_today = False
-                last_day = today
-
-            # lee incremento
-            import sqlite3
-            con = sqlite3.connect(DB_PATH)
-            df = pd.read_sql_query(
-                f"SELECT * FROM samples WHERE id>{last_id} ORDER BY id",
-                con
-            )
+    state: Dict[str, Any] = {}
+    con = None
+    try:
+        while True:
+            try:
+                if state and state["day"] != datetime.now().day:
+                    await asyncio.to_thread(_close_daily, state)
+                    state = {}
+                if not state:
+                    wb, sheet, cols = _open_daily_writer()
+                    state = {"wb": wb, "sheet": sheet, "cols": cols, "day": datetime.now().day}
+                if con is None:
+                    con = sqlite3.connect(DB_PATH, check_same_thread=False)
+                last_id = await asyncio.to_thread(_export_increment, con, last_id, state)
+            except Exception as e:
+                print("Exporter warn:", e)
+
+            await asyncio.sleep(EXCEL_PERIOD)
+    finally:
+        if state:
+            _close_daily(state)
+        if con is not None:
             con.close()
 
-            if not df.empty:
-                last_id = int(df["id"].iloc[-1])
-
-                # mapea node -> alias para columnas “bonitas”
-                with LOCK:
-                    # crea columna 'alias' usando alias_map; fallback al nodeid si no existe
-                    df["alias"] = df["node"].map(lambda nid: alias_map.get(nid, nid))
-
-                # pivot por alias para tener 1 fila por ts y columnas por variable
-                piv = df.pivot_table(index="ts", columns="alias", values="value",
-                                     aggfunc="last").reset_index()
-
-                # orden de columnas fijo
-                cols = ["ts"] + _ordered_aliases()
-                # incluye columnas nuevas si aparecieron
-                for c in piv.columns:
-                    if c not in cols:
-                        cols.append(c)
-                piv = piv.reindex(columns=cols, fill_value=None)
-
-                xlsx = _daily_xlsx_path()
-                if not os.path.exists(xlsx):
-                    # primer archivo del día -> escribe encabezado
-                    with pd.ExcelWriter(xlsx, engine="openpyxl") as xw:
-                        piv.to_excel(xw, sheet_name="data", index=False)
-                    wrote_header_for_today = True
-                else:
-                    # agrega sin repetir encabezado
-                    from openpyxl import load_workbook
-                    wb = load_workbook(xlsx)
-                    if "data" not in wb.sheetnames:
-                        with pd.ExcelWriter(xlsx, engine="openpyxl", mode="a") as xw:
-                            piv.to_excel(xw, sheet_name="data", index=False)
-                        wrote_header_for_today = True
-                    else:
-                        ws = wb["data"]
-                        start_row = ws.max_row + (0 if ws.max_row == 1 else 1)
-                        with pd.ExcelWriter(xlsx, engine="openpyxl", mode="a", if_sheet_exists="overlay") as xw:
-                            piv.to_excel(
-                                xw, sheet_name="data", index=False,
-                                header=not wrote_header_for_today,
-                                startrow=ws.max_row
-                            )
-                        wrote_header_for_today = True
-        except Exception as e:
-            print("Exporter warn:", e)
-
-        await asyncio.sleep(EXCEL_PERIOD)
-
 # ---------------- OPC UA ----------------
 
 def browse_all_variables(session: Client, start_nodeid_str: str):
@@ -191,17 +225,23 @@ def make_readvalueid(nodeid: ua.NodeId) -> ua.ReadValueId:
 def status_to_int(sc) -> int:
     if sc is None:
         return 0
+    v = getattr(sc, "value", None)   # ua.StatusCode: int() no lo acepta
+    if v is not None:
+        return int(v)
     try:
         return int(sc)
     except Exception:
-        return int(getattr(sc, "value", 0))
+        return 0
+
+def _iso_ts(src_ts) -> str:
+    return (src_ts or datetime.now(timezone.utc)).astimezone().isoformat()
 
 class SubHandler:
     def datachange_notification(self, node, val, data):
         # timestamp
         src_ts = getattr(getattr(data, "monitored_item", None), "Value", None)
         src_ts = getattr(src_ts, "SourceTimestamp", None)
-        ts = (src_ts or datetime.now(timezone.utc)).astimezone().isoformat()
+        ts = _iso_ts(src_ts)
 
         nodeid = node.nodeid.to_string()
         sc_obj = getattr(getattr(data, "monitored_item", None), "Value", None)
@@ -223,6 +263,68 @@ class SubHandler:
             last_snapshot[alias] = val
             last_snapshot["_timestamp"] = ts
 
+class NotificationBatcher:
+    """
+    Consumidor de notificaciones por lote (un DataChangeNotification = un publish):
+    el alias sale de la tabla ClientHandle -> (nodeid, alias) armada al crear los
+    MonitoredItems (SubHandler pedía get_browse_name() al server en cada cambio),
+    el lote se arma sin lock y se vuelca con UNA toma de LOCK.
+    """
+    def __init__(self, handles: Dict[int, Tuple[str, str]]):
+        self.handles = handles
+        self.notifications = 0
+        self.batches = 0
+        self.unknown = 0
+
+    def consume(self, items) -> int:
+        handles = self.handles
+        rows, snap, ts_cache = [], {}, {}
+        ts = None
+        for item in items:
+            h = handles.get(item.ClientHandle)
+            if h is None:
+                self.unknown += 1
+                continue
+            nodeid, alias = h
+            dv = item.Value
+            src = dv.SourceTimestamp
+            ts = ts_cache.get(src)   # los items de un publish suelen compartir timestamp
+            if ts is None:
+                ts = ts_cache[src] = _iso_ts(src)
+            val = dv.Value.Value
+            rows.append((ts, nodeid, str(val), status_to_int(dv.StatusCode)))
+            snap[alias] = val
+        if rows:
+            with LOCK:
+                insert_queue.extend(rows)
+                last_snapshot.update(snap)
+                last_snapshot["_timestamp"] = ts
+        self.notifications += len(rows)
+        self.batches += 1
+        return len(rows)
+
+class BatchedSubscription(Subscription):
+    """Subscription de python-opcua que entrega cada publish entero a un NotificationBatcher."""
+    def __init__(self, client: Client, period_ms: float, batcher: NotificationBatcher):
+        # mismos parámetros que Client.create_subscription(period, handler)
+        params = ua.CreateSubscriptionParameters()
+        params.RequestedPublishingInterval = period_ms
+        params.RequestedLifetimeCount = 10000
+        params.RequestedMaxKeepAliveCount = 3000
+        params.MaxNotificationsPerPublish = 10000
+        params.PublishingEnabled = True
+        params.Priority = 0
+        self.batcher = batcher
+        super().__init__(client.uaclient, params, SubHandler())
+
+    def _call_datachange(self, datachange):
+        try:
+            self.batcher.consume(datachange.MonitoredItems)
+        except Exception:
+            self.logger.exception("Exception processing data change batch")
+        if self.batcher.unknown:
+            self.has_unknown_handlers = True
+
 async def opc_task():
     while True:
         client = None
@@ -239,15 +341,20 @@ async def opc_task():
             variables = browse_all_variables(client, START_NODE_ID)
             print(f"[OPC] Variables encontradas: {len(variables)}")
 
-            # llena alias_map desde el browse para encabezados desde inicio
+            # alias por ClientHandle (= índice del browse): encabezados desde el inicio
+            # y la tabla que usa el NotificationBatcher (sin ir al server por cambio)
+            handles: Dict[int, Tuple[str, str]] = {}
+            for i, v in enumerate(variables, start=1):
+                nodeid = v.nodeid.to_string()
+                try:
+                    alias = v.get_browse_name().Name
+                except Exception:
+                    alias = nodeid
+                handles[i] = (nodeid, alias)
             with LOCK:
-                for v in variables:
-                    try:
-                        alias_map[v.nodeid.to_string()] = v.get_browse_name().Name
-                    except Exception:
-                        alias_map[v.nodeid.to_string()] = v.nodeid.to_string()
+                alias_map.update(dict(handles.values()))
 
-            sub = client.create_subscription(PUBLISHING_MS, SubHandler())
+            sub = BatchedSubscription(client, PUBLISHING_MS, NotificationBatcher(handles))
 
             # Prepara requests (sin Filter para máxima compatibilidad)
             reqs = []
@@ -0,0 +1,313 @@
+# utils/capture_manager.py
+import os, queue, re, logging, threading, time, uuid
+from collections import deque
+from utils.export_sinks import FORMATS, recover_parts
+from utils.rt_export_manager import EXPORT_QUEUE_MAX, ExportSession, flatten, sample_dt, rss_mb
+
+log = logging.getLogger("uvicorn")
+
+CAPTURE_MAX_PRE_S = float(os.getenv("CAPTURE_MAX_PRE_S", "300"))
+CAPTURE_MAX_POST_S = float(os.getenv("CAPTURE_MAX_POST_S", "3600"))
+CAPTURE_KEEP_FILES = int(os.getenv("CAPTURE_KEEP_FILES", "100"))   # capturas recordadas por job
+CAPTURE_STALL_S = float(os.getenv("CAPTURE_STALL_S", "5"))        # sin muestras: cierra post_seconds + esto después
+
+EDGES = ("rising", "falling", "both")
+
+def _lookup(group: str, name: str):
+    # acceso directo sample[grupo][tag], sin aplanar la muestra
+    def get(sample: dict):
+        g = sample.get(group)
+        return g.get(name) if type(g) is dict else None
+    return get
+
+class CaptureJob:
+    """
+    Captura tipo osciloscopio sobre un tag:
+      ARMED     -> guarda un anillo con los últimos pre_seconds; evalúa la condición
+      RECORDING -> escribe anillo + lo que llega hasta trigger + post_seconds
+      (re-arm)  -> vuelve a ARMED tras holdoff_s, o DONE si rearm=False / max_triggers
+    Condición: nivel del tag (BOOL, o valor >= threshold con histéresis) y se
+    dispara en el flanco pedido (rising | falling | both).
+    """
+    def __init__(self, out_dir: str, checkpoint_s: float, trigger_tag: str, tags: list[str],
+                 edge: str = "rising", threshold: float | None = None, hysteresis: float = 0.0,
+                 pre_seconds: float = 5.0, post_seconds: float = 5.0, fmt: str = "xlsx",
+                 rearm: bool = True, holdoff_s: float = 0.0, max_triggers: int | None = None,
+                 name: str | None = None):
+        group, _, tname = trigger_tag.partition(".")
+        if not group or not tname:
+            raise ValueError("trigger tag debe ser 'GRUPO.nombre'")
+        if edge not in EDGES:
+            raise ValueError(f"edge inválido: {edge!r} (usa {', '.join(EDGES)})")
+        if fmt not in FORMATS:
+            raise ValueError(f"format inválido: {fmt!r} (usa {', '.join(FORMATS)})")
+        if not 0 <= pre_seconds <= CAPTURE_MAX_PRE_S:
+            raise ValueError(f"pre_seconds fuera de rango [0, {CAPTURE_MAX_PRE_S}]")
+        if not 0 < post_seconds <= CAPTURE_MAX_POST_S:
+            raise ValueError(f"post_seconds fuera de rango (0, {CAPTURE_MAX_POST_S}]")
+        if max_triggers is not None:
+            if isinstance(max_triggers, bool) or not isinstance(max_triggers, (int, str)) \
+                    or not str(max_triggers).strip().isdigit() or int(max_triggers) < 1:
+                raise ValueError("max_triggers debe ser un entero positivo")
+            max_triggers = int(max_triggers)
+
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name or self.id
+        self.out_dir = out_dir
+        self.checkpoint_s = checkpoint_s
+        self.trigger_tag = trigger_tag
+        self.tags = tags if trigger_tag in tags else [trigger_tag] + tags
+        self.edge = edge
+        self.threshold = None if threshold is None else float(threshold)
+        self.hysteresis = abs(float(hysteresis or 0.0))
+        self.pre_seconds = float(pre_seconds)
+        self.post_seconds = float(post_seconds)
+        self.format = fmt
+        self.rearm = bool(rearm)
+        self.holdoff_s = max(0.0, float(holdoff_s or 0.0))
+        self.max_triggers = max_triggers
+        self._prefix = "capture_" + (re.sub(r"[^A-Za-z0-9_-]+", "_", self.name)[:40] or self.id)
+
+        self._get = _lookup(group, tname)
+        self._level = None            # nivel actual de la condición (None = sin dato aún)
+        self._ring: deque = deque()   # (ts, muestra) de los últimos pre_seconds
+        self._session: ExportSession | None = None
+        self._end_t = 0.0
+        self._end_wall = 0.0          # tope en reloj local por si dejan de llegar muestras
+        self._armed_at = 0.0
+        self._done: list = []         # sesiones cerradas a finalizar fuera del lock del manager
+
+        self.state = "armed"
+        self.created_at = time.time()
+        self.triggers = 0
+        self.last_trigger = None
+        self.captures: deque = deque(maxlen=CAPTURE_KEEP_FILES)
+
+    # --- condición (nivel con histéresis; el flanco lo decide on_sample) ---
+    def _eval_level(self, v) -> bool | None:
+        if v is None or isinstance(v, str):
+            return self._level
+        if self.threshold is None:
+            return bool(v)
+        if self._level:
+            return v >= self.threshold - self.hysteresis
+        return v >= self.threshold
+
+    def _fired(self, prev: bool | None, cur: bool | None) -> bool:
+        if prev is None or cur is None or prev == cur:
+            return False
+        return self.edge == "both" or (cur if self.edge == "rising" else not cur)
+
+    # --- llamado desde el hilo de capturas, una vez por muestra ---
+    def on_sample(self, sample: dict, ts: float):
+        if self.state == "done":
+            return
+        prev, self._level = self._level, self._eval_level(self._get(sample))
+
+        if self.state == "recording":
+            if ts > self._end_t:
+                self._close(ts)
+            else:
+                self._write(sample)
+                return
+
+        if self.state != "armed":
+            return
+        ring = self._ring
+        ring.append((ts, sample))
+        lim = ts - self.pre_seconds
+        while ring and ring[0][0] < lim:
+            ring.popleft()
+
+        if ts >= self._armed_at and self._fired(prev, self._level):
+            self._trigger(ts)
+
+    def _trigger(self, ts: float):
+        self.triggers += 1
+        self.last_trigger = ts
+        self._session = ExportSession(self.out_dir, self.tags, self.format, None,
+                                      self.checkpoint_s, prefix=self._prefix)
+        self._end_t = ts + self.post_seconds
+        self._end_wall = time.monotonic() + self.post_seconds + CAPTURE_STALL_S
+        self.state = "recording"
+        ring, self._ring = self._ring, deque()
+        for _, s in ring:   # ventana pre-trigger (incluye la muestra del disparo)
+            self._write(s)
+        log.info("Captura %s: disparo #%d (%s %s)", self.name, self.triggers, self.trigger_tag, self.edge)
+
+    def _write(self, sample: dict):
+        flat = flatten(sample)
+        self._session.write(flat, sample_dt(sample, flat))
+
+    def _close(self, ts: float | None = None):
+        # solo desengancha la sesión; el archivo lo cierra finalize_done() sin el lock
+        s, self._session = self._session, None
+        if s is not None:
+            s.active = False
+            s.stopped_at = time.time()
+            self._done.append((self.triggers, self.last_trigger, s))
+        if self.state == "disarmed":
+            return
+        if self.rearm and (self.max_triggers is None or self.triggers < self.max_triggers):
+            self.state = "armed"
+            self._armed_at = (ts or time.time()) + self.holdoff_s
+        else:
+            self.state = "done"
+
+    def checkpoint(self):
+        if self._session is not None:
+            self._session.checkpoint()
+
+    def check_stall(self):
+        # la ventana post se cierra con la muestra siguiente; si la adquisición se
+        # cortó (PLC desconectado) se cierra por reloj local
+        if self.state == "recording" and time.monotonic() > self._end_wall:
+            log.warning("Captura %s: sin muestras, cierro la ventana post-trigger por tiempo", self.name)
+            self._close()
+
+    def take_done(self) -> list:
+        done, self._done = self._done, []
+        return done
+
+    def finalize_done(self, done: list):
+        for n, trigger_ts, s in done:
+            try:
+                s.finalize()
+            except Exception as e:
+                log.exception("Captura %s: no pude cerrar %s: %s", self.name, s.path, e)
+                continue
+            self.captures.append({
+                "n": n, "trigger_ts": trigger_ts, "path": s.path,
+                "rows": s.rows_written, "bytes": s.bytes_written, "media_type": s.status()["media_type"],
+            })
+
+    def disarm(self):
+        self.state = "disarmed"
+        self._close()
+
+    def status(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "state": self.state,
+            "trigger": {"tag": self.trigger_tag, "edge": self.edge, "threshold": self.threshold,
+                        "hysteresis": self.hysteresis},
+            "tags": self.tags,
+            "pre_seconds": self.pre_seconds,
+            "post_seconds": self.post_seconds,
+            "format": self.format,
+            "rearm": self.rearm,
+            "holdoff_s": self.holdoff_s,
+            "max_triggers": self.max_triggers,
+            "triggers": self.triggers,
+            "last_trigger": self.last_trigger,
+            "recording_rows": self._session.rows_written if self._session else None,
+            "captures": list(self.captures),
+        }
+
+class CaptureManager(threading.Thread):
+    """
+    Jobs de captura por condición. ingest() (hot path) solo encola si hay jobs;
+    las condiciones se evalúan en este hilo, muestra por muestra y en orden.
+    """
+    def __init__(self, out_dir="exports/captures", checkpoint_s=1.5):
+        super().__init__(name="capture-manager", daemon=True)
+        self.out_dir = out_dir
+        self.checkpoint_s = checkpoint_s
+        os.makedirs(out_dir, exist_ok=True)
+        self.recovered = recover_parts(out_dir)   # capturas cortadas por un crash
+        self._lock = threading.Lock()
+        self._jobs: dict[str, CaptureJob] = {}
+        self._live: tuple[CaptureJob, ...] = ()   # copy-on-write para el hot path
+        self._q: queue.Queue = queue.Queue(maxsize=EXPORT_QUEUE_MAX)
+        self.dropped = 0
+
+    def _refresh(self):
+        self._live = tuple(j for j in self._jobs.values() if j.state not in ("done", "disarmed"))
+
+    def create(self, trigger_tag: str, tags: list[str] | None = None, **opts) -> dict:
+        tags = [t for t in (tags or []) if isinstance(t, str) and t.strip()]
+        job = CaptureJob(self.out_dir, self.checkpoint_s, trigger_tag, tags, **opts)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._refresh()
+        if not self.is_alive():
+            try:
+                self.start()
+            except RuntimeError:
+                pass  # ya arrancado
+        return job.status()
+
+    def ingest(self, sample: dict):
+        if not self._live:
+            return
+        try:
+            self._q.put_nowait(sample)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            try:
+                items = [self._q.get(timeout=0.5)]
+            except queue.Empty:
+                items = []
+            while items and len(items) < 1000:
+                try:
+                    items.append(self._q.get_nowait())
+                except queue.Empty:
+                    break
+            with self._lock:
+                jobs = self._live
+                for sample in items:
+                    if not isinstance(sample, dict):
+                        continue
+                    ts = sample.get("timestamp")
+                    if not isinstance(ts, (int, float)):
+                        ts = time.time()
+                    for job in jobs:
+                        try:
+                            job.on_sample(sample, ts)
+                        except Exception as e:
+                            log.exception("Captura %s: error: %s", job.name, e)
+                for job in jobs:
+                    job.check_stall()
+                    job.checkpoint()
+                done = [(job, job.take_done()) for job in jobs]
+                self._refresh()
+            self._finalize(done)
+
+    def _finalize(self, done: list):
+        # armar el archivo final (xlsx: zip entero) no frena la API ni la próxima tanda
+        for job, sessions in done:
+            if sessions:
+                job.finalize_done(sessions)
+
+    def get(self, job_id: str) -> CaptureJob:
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        return job
+
+    def disarm(self, job_id: str) -> dict:
+        with self._lock:
+            job = self.get(job_id)
+            job.disarm()
+            done = job.take_done()
+            self._refresh()
+        self._finalize([(job, done)])
+        return job.status()
+
+    def delete(self, job_id: str) -> dict:
+        st = self.disarm(job_id)
+        with self._lock:
+            self._jobs.pop(job_id, None)
+        return st
+
+    def list(self) -> list[dict]:
+        with self._lock:
+            return [j.status() for j in self._jobs.values()]
+
+    def status(self) -> dict:
+        return {"jobs": self.list(), "queued": self._q.qsize(), "dropped": self.dropped,
+                "rss_mb": rss_mb()}
@@ -1,9 +1,8 @@
 # utils/excel_logger.py
-import os, json, time, queue, threading
+import os, re, json, time, zlib, base64, queue, threading
 from datetime import datetime
-from openpyxl import Workbook
-from openpyxl.worksheet.table import Table, TableStyleInfo
-from openpyxl.utils import get_column_letter
+from utils.fast_json import dumps as fast_dumps
+from utils.xlsx_stream import XlsxStreamWriter, journal_for, recover_dir, recover_journal
 
 def _flatten(obj, prefix="", out=None):
     if out is None: out = {}
@@ -21,24 +20,161 @@ def _beautify(col: str) -> str:
     # "REAL.fast_1" -> "fast_1", "UDINT.tri_half" -> "tri_half"
     return col.split(".", 1)[-1] if "." in col else col
 
-def _next_indexed_path(path_base: str) -> str:
-    # si existe rt_2025-09-10.xlsx, crea rt_2025-09-10_02.xlsx, etc.
-    if not os.path.exists(path_base):
+EXCEL_ROTATE_ROWS = int(os.getenv("EXCEL_ROTATE_ROWS", "500000"))      # 0 = sin límite
+EXCEL_ROTATE_BYTES = int(os.getenv("EXCEL_ROTATE_BYTES", str(256 * 2**20)))  # XML sin comprimir
+EXCEL_ROTATE_S = float(os.getenv("EXCEL_ROTATE_S", "0"))               # 0 = solo por día
+EXCEL_ZIP_LEVEL = int(os.getenv("EXCEL_ZIP_LEVEL", "6"))                # 0 = sin comprimir (rápido)
+EXCEL_RAW_SHEET = os.getenv("EXCEL_RAW_SHEET", "sheet").lower()        # sheet | zlib | off
+EXCEL_TS_FORMAT = os.getenv("EXCEL_TS_FORMAT", "text").lower()         # text | datetime (nativo Excel)
+EXCEL_AUTOSIZE_EVERY = int(os.getenv("EXCEL_AUTOSIZE_EVERY", "100"))   # mide anchos 1 de cada N filas
+EXCEL_MANIFEST_MAX = int(os.getenv("EXCEL_MANIFEST_MAX", "500"))       # entradas del manifest (0 = todas)
+
+_SEG_RE = re.compile(r"^(?P<root>.+?)(?:_(?P<idx>\d{2,}))?(?P<ext>\.xlsx)$")
+
+def _first_free_index(path_base: str) -> int:
+    """
+    Índice del próximo segmento para 'path_base' con UN listdir (no un exists() por
+    candidato): 1 = rt_2025-09-10.xlsx, 2 = rt_2025-09-10_02.xlsx, ...
+    """
+    folder, name = os.path.split(path_base)
+    root = os.path.splitext(name)[0]
+    used = 0
+    try:
+        names = os.listdir(folder or ".")
+    except OSError:
+        return 1
+    for n in names:
+        m = _SEG_RE.match(n)
+        if m and m.group("root") == root:
+            used = max(used, int(m.group("idx") or 1))
+    return used + 1
+
+def _segment_path(path_base: str, idx: int) -> str:
+    if idx <= 1:
         return path_base
     root, ext = os.path.splitext(path_base)
-    idx = 2
-    while True:
-        cand = f"{root}_{idx:02d}{ext}"
-        if not os.path.exists(cand):
-            return cand
-        idx += 1
+    return f"{root}_{idx:02d}{ext}"
+
+class _SegmentFinalizer(threading.Thread):
+    """
+    Cierra segmentos en segundo plano (header, tabla, anchos, zip) mientras el
+    siguiente ya recibe filas, y mantiene el manifest JSON de segmentos (solo las
+    max_entries más nuevas; los abiertos o cerrándose no se podan).
+    """
+    def __init__(self, manifest_path: str, max_entries: int = EXCEL_MANIFEST_MAX):
+        super().__init__(daemon=True)
+        self.manifest_path = manifest_path
+        self.max_entries = max_entries
+        self._q: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.segments: list[dict] = self._load()
+
+    def _load(self) -> list[dict]:
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f).get("segments", [])
+        except Exception:
+            return []
+
+    def _prune(self):
+        extra = len(self.segments) - self.max_entries
+        if self.max_entries <= 0 or extra <= 0:
+            return
+        keep = []
+        for e in self.segments:   # en orden de apertura: se van los más viejos
+            if extra > 0 and e.get("status") not in ("open", "finalizing"):
+                extra -= 1
+                continue
+            keep.append(e)
+        self.segments = keep
+
+    def recover_open(self, rebuild: bool = True) -> list[dict]:
+        """
+        Al arrancar, antes de abrir segmentos: los que quedaron "open"/"finalizing"
+        (crash o kill) se rearman desde su journal hasta el último checkpoint
+        (status "recovered", más el 'extra' que el dueño guardó en el journal); sin
+        journal o con rebuild=False (el dueño re-exporta esos datos) se borran sus
+        temporales y quedan "lost". Después barre los temporales huérfanos de la carpeta.
+        """
+        with self._lock:
+            stale = [e for e in self.segments if e.get("status") in ("open", "finalizing")]
+            for e in stale:
+                upd = {"status": "lost", "recovered_at": time.time()}
+                jp = journal_for(e["path"])
+                try:
+                    out, extra = None, {}
+                    if os.path.exists(jp):
+                        with open(jp, encoding="utf-8") as f:
+                            extra = json.load(f).get("extra") or {}
+                        out = recover_journal(jp, rebuild)
+                    if out:
+                        upd.update(extra, status="recovered", bytes=os.path.getsize(out))
+                        if out != os.path.abspath(e["path"]):
+                            upd["recovered_path"] = out
+                except Exception as ex:
+                    upd.update(status="error", error=str(ex))
+                e.update(upd)
+            if stale:
+                self._save()
+        recover_dir(os.path.dirname(os.path.abspath(self.manifest_path)))
+        return stale
+
+    def _save(self):
+        self._prune()
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"segments": self.segments}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def opened(self, entry: dict):
+        with self._lock:
+            self.segments.append(entry)
+            self._save()
+
+    def submit(self, writer, entry: dict, info: dict):
+        with self._lock:
+            entry.update(info, status="finalizing")
+            self._save()
+        self._q.put((writer, entry))
+        if not self.is_alive():
+            try:
+                self.start()
+            except RuntimeError:
+                pass
+
+    def drain(self, timeout: float | None = None):
+        self._q.put(None)
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while True:
+            item = self._q.get()
+            if item is None:
+                return
+            writer, entry = item
+            t0 = time.time()
+            upd = {"status": "done"}
+            try:
+                writer.close()
+                upd["bytes"] = os.path.getsize(writer.path)
+            except Exception as e:
+                upd = {"status": "error", "error": str(e)}
+            upd["finalize_s"] = round(time.time() - t0, 3)
+            with self._lock:
+                entry.update(upd)
+                self._save()
 
 class ExcelLogger(threading.Thread):
     """
     Escritor RT para Excel:
       • Hoja 'rt' primero: timestamp + columnas seleccionadas (cabeceras bonitas).
       • Hoja 'raw' segundo: timestamp + json crudo (por si acaso).
-      • No guarda en disco en cada flush: checkpoint periódico.
+      • Filas en streaming a disco (XlsxStreamWriter); el checkpoint es solo un flush
+        (el .xlsx existe al cerrar el segmento). Tras un crash, el segmento que quedó
+        abierto se rearma al arrancar hasta su último checkpoint (manifest: "recovered").
+      • Rota por día, filas, bytes o duración; el cierre del segmento (tabla,
+        anchos, zip) lo hace un hilo aparte y queda registrado en manifest.json.
     """
     def __init__(self, q: queue.Queue,
                  path_template: str = "exports/rt_{date}.xlsx",
@@ -49,7 +185,14 @@ class ExcelLogger(threading.Thread):
                  long_format: bool = False,      # dejamos wide (cada tag es columna)
                  with_table: bool = True,
                  autosize: bool = True,
-                 save_checkpoint_s: float = 2.0  # guarda a disco cada X s
+                 save_checkpoint_s: float = 2.0, # flush a disco cada X s
+                 rotate_rows: int = EXCEL_ROTATE_ROWS,
+                 rotate_bytes: int = EXCEL_ROTATE_BYTES,
+                 rotate_s: float = EXCEL_ROTATE_S,
+                 zip_level: int = EXCEL_ZIP_LEVEL,
+                 raw_sheet: str = EXCEL_RAW_SHEET,     # sheet | zlib (base64) | off
+                 ts_format: str = EXCEL_TS_FORMAT,     # text | datetime
+                 autosize_every: int = EXCEL_AUTOSIZE_EVERY,
                  ):
         super().__init__(daemon=True)
         self.q = q
@@ -62,72 +205,131 @@ class ExcelLogger(threading.Thread):
         self.with_table = with_table
         self.autosize = autosize
         self.save_checkpoint_s = save_checkpoint_s
+        self.rotate_rows = rotate_rows
+        self.rotate_bytes = rotate_bytes
+        self.rotate_s = rotate_s
+        self.zip_level = zip_level
+        if raw_sheet not in ("sheet", "zlib", "off"):
+            raise ValueError(f"raw_sheet inválido: {raw_sheet!r}")
+        if ts_format not in ("text", "datetime"):
+            raise ValueError(f"ts_format inválido: {ts_format!r}")
+        self.raw_sheet = raw_sheet
+        self.ts_format = ts_format
+        self.autosize_every = max(1, autosize_every)
 
-        self._stop = threading.Event()
-        self._wb = None
+        self._stop_evt = threading.Event()
+        self._wb = None        # XlsxStreamWriter del segmento abierto
+        self._rt = None
+        self._raw = None
         self._path = None
+        self._date = None
+        self._base = None
+        self._seg_idx = 0
+        self._seg_entry = None
+        self._seg_started = 0.0
+        folder = os.path.dirname(os.path.normpath(path_template.format(date="x"))) or "."
+        os.makedirs(folder, exist_ok=True)
+        self._finalizer = _SegmentFinalizer(os.path.join(folder, "manifest.json"))
+        self._finalizer.recover_open()
         self._header = []      # orden de columnas para 'rt'
+        self._cols = {}        # clave aplanada -> índice en la fila (O(1))
+        self._gidx = {}        # grupo -> {tag: índice}: sin aplanar ni concatenar por muestra
         self._maxlen = {}      # autosize
+        self._ts_sec = None    # cache del prefijo "YYYY-mm-dd HH:MM:SS" por segundo
+        self._ts_prefix = ""
+        self._ts_off = 0
         self._last_save = 0.0
         self.rows_written = 0  # expuesto para UI
         self.drops = 0         # (por si lo quieres usar)
 
     def stop(self):
-        self._stop.set()
+        self._stop_evt.set()
 
     def _ensure_workbook(self):
         date = datetime.now().strftime("%Y-%m-%d")
-        base = self.path_template.format(date=date)
-        base = os.path.normpath(base)
+        if self._wb is not None:
+            reason = "day" if date != self._date else self._rotate_reason()
+            if reason:
+                self._rotate(reason)
+        if self._wb is not None:
+            return
+
+        base = os.path.normpath(self.path_template.format(date=date))
         os.makedirs(os.path.dirname(base), exist_ok=True)
+        if base != self._base:
+            # un listdir por día/arranque; después el índice sigue en memoria
+            self._base = base
+            self._seg_idx = _first_free_index(base) - 1
+        self._date = date
+        self._seg_idx += 1
+        self._path = _segment_path(base, self._seg_idx)
 
-        if self._wb is None:
-            # SIEMPRE crea un libro nuevo con índice incremental
-            self._path = _next_indexed_path(base)
-            self._wb = Workbook()
+        self._wb = XlsxStreamWriter(self._path, compresslevel=self.zip_level)
+        # 1) Hoja RT primero
+        self._rt = self._wb.add_sheet(self.sheet_name, table_name="tbl_rt" if self.with_table else None)
+        self._header = ["timestamp"]
+        self._cols = {"timestamp": 0}
+        self._gidx = {}
+        if self.ts_format == "datetime":
+            self._rt.datetime_cols = {1}
+        # 2) Hoja RAW segundo (opcional)
+        self._raw = None
+        if self.raw_sheet != "off":
+            self._raw = self._wb.add_sheet("raw")
+            self._raw.header = ["timestamp", "json" if self.raw_sheet == "sheet" else "json_zlib_b64"]
 
-            # 1) Hoja RT primero
-            ws_rt = self._wb.active
-            ws_rt.title = self.sheet_name
-            self._header = ["timestamp"]
-            ws_rt.append(self._header)
+        self._last_save = time.time()
+        self._seg_started = time.time()
+        self.rows_written = 0
+        self._maxlen = {1: 23 if self.ts_format == "text" else 24}  # "YYYY-mm-dd HH:MM:SS.fff"
+        self._seg_entry = {"index": self._seg_idx, "path": self._path, "date": date,
+                           "started_at": self._seg_started, "status": "open"}
+        self._finalizer.opened(self._seg_entry)
 
-            # 2) Hoja RAW segundo
-            ws_raw = self._wb.create_sheet("raw")
-            ws_raw.append(["timestamp", "json"])
+    def _rotate_reason(self) -> str | None:
+        if self.rotate_rows and self.rows_written >= self.rotate_rows:
+            return "rows"
+        if self.rotate_bytes and self._wb.bytes_written >= self.rotate_bytes:
+            return "bytes"
+        if self.rotate_s and (time.time() - self._seg_started) >= self.rotate_s:
+            return "duration"
+        return None
 
-            self._last_save = 0.0
-            self.rows_written = 0
-            self._maxlen = {1: len("timestamp")}
+    def _rotate(self, reason: str):
+        """Entrega el segmento al finalizador y deja que el próximo _flush abra otro."""
+        wb, self._wb = self._wb, None
+        if wb is None:
+            return
+        self._apply_layout()
+        self._finalizer.submit(wb, self._seg_entry, {
+            "ended_at": time.time(), "rows": self.rows_written,
+            "xml_bytes": wb.bytes_written, "reason": reason,
+        })
+
+    def _apply_layout(self):
+        # header (bonito si corresponde) y anchos: se emiten al cerrar el segmento
+        self._rt.header = [
+            _beautify(k) if (self.pretty_headers and k != "timestamp") else k for k in self._header
+        ]
+        if self.autosize:
+            self._rt.widths = {
+                idx: max(10, min(50, self._maxlen.get(idx, 12))) for idx in range(1, len(self._header) + 1)
+            }
 
     def _checkpoint_save(self):
-        if (time.time() - self._last_save) >= self.save_checkpoint_s:
-            # ajusta tabla y ancho columnas antes de guardar
-            ws_rt = self._wb[self.sheet_name]
-            last_col = get_column_letter(len(self._header))
-            last_row = ws_rt.max_row
-            if self.with_table:
-                name = "tbl_rt"
-                if name in ws_rt.tables:
-                    tbl = ws_rt.tables[name]
-                    tbl.ref = f"A1:{last_col}{last_row}"
-                else:
-                    tbl = Table(displayName=name, ref=f"A1:{last_col}{last_row}")
-                    style = TableStyleInfo(name="TableStyleMedium2", showRowStripes=True)
-                    tbl.tableStyleInfo = style
-                    ws_rt.add_table(tbl)
-            if self.autosize:
-                for idx in range(1, len(self._header) + 1):
-                    col_letter = get_column_letter(idx)
-                    ws_rt.column_dimensions[col_letter].width = max(10, min(50, self._maxlen.get(idx, 12)))
-
-            self._wb.save(self._path)
+        if self._wb is not None and (time.time() - self._last_save) >= self.save_checkpoint_s:
+            self._apply_layout()   # header/anchos al día en el journal (recuperación)
+            self._wb.flush()
             self._last_save = time.time()
 
+    def segments(self) -> list[dict]:
+        with self._finalizer._lock:
+            return [dict(e) for e in self._finalizer.segments]
+
     def run(self):
         batch = []
         last = time.time()
-        while not self._stop.is_set():
+        while not self._stop_evt.is_set():
             try:
                 item = self.q.get(timeout=0.2)
                 batch.append(item)
@@ -142,55 +344,96 @@ class ExcelLogger(threading.Thread):
                     self._flush(batch)
                     batch.clear()
                     last = time.time()
-                    self._checkpoint_save()
+                # en pausa también: lo ya escrito queda recuperable
+                self._checkpoint_save()
 
-        # salida limpia
+        # salida limpia: cierra el segmento abierto y espera al finalizador
         if batch:
             self._flush(batch)
-        self._checkpoint_save()
+        self._rotate("stop")
+        self._finalizer.drain(timeout=60)
 
     # --- internos ---
+    def _add_col(self, key: str) -> int:
+        i = self._cols.get(key)
+        if i is None:
+            i = len(self._header)
+            self._header.append(key)
+            self._cols[key] = i
+            text = _beautify(key) if self.pretty_headers else key
+            self._maxlen[i + 1] = max(self._maxlen.get(i + 1, 0), len(text))
+        return i
+
+    def _ts_cell(self, ts: float):
+        sec = int(ts // 1)
+        if sec != self._ts_sec:
+            self._ts_sec = sec
+            self._ts_prefix = datetime.fromtimestamp(sec).strftime("%Y-%m-%d %H:%M:%S")
+            self._ts_off = time.localtime(sec).tm_gmtoff
+        if self.ts_format == "datetime":
+            return (ts + self._ts_off) / 86400.0 + 25569.0   # serie Excel, hora local
+        ms = min(999, round((ts - sec) * 1e6) // 1000)
+        return f"{self._ts_prefix}.{ms:03d}"
+
+    def _build_row(self, sample: dict, ts: float) -> list:
+        row = [None] * len(self._header)
+        for k, v in sample.items():
+            if type(v) is dict:
+                gi = self._gidx.get(k)
+                if gi is None:
+                    gi = self._gidx[k] = {}
+                for name, val in v.items():
+                    i = gi.get(name)
+                    if i is None:
+                        if type(val) is dict:   # anidado más profundo: camino genérico
+                            for fk, fv in _flatten(val, f"{k}.{name}").items():
+                                j = self._add_col(fk)
+                                if j >= len(row):
+                                    row.extend([None] * (j + 1 - len(row)))
+                                row[j] = fv
+                            continue
+                        i = gi[name] = self._add_col(f"{k}.{name}")
+                        if i >= len(row):
+                            row.extend([None] * (i + 1 - len(row)))
+                    row[i] = val
+            elif k != "timestamp":
+                i = self._cols.get(k)
+                if i is None:
+                    i = self._add_col(k)
+                    row.extend([None] * (i + 1 - len(row)))
+                row[i] = v
+        row[0] = self._ts_cell(ts)
+        return row
+
     def _flush(self, batch):
         self._ensure_workbook()
-        ws_rt = self._wb[self.sheet_name]
-        ws_raw = self._wb["raw"]
-
-        header_changed = False
+        ws_rt = self._rt
+        ws_raw = self._raw
 
         for sample in batch:
-            # 1) hoja RAW
-            ts = sample.get("timestamp", time.time())
-            ws_raw.append([ts, json.dumps(sample, ensure_ascii=False, separators=(",", ":"))])
+            ts = sample.get("timestamp")
+            if not isinstance(ts, (int, float)):
+                ts = time.time()
+            if "__seq__" in sample:   # interno del buffer/WS, no va al Excel
+                sample = {k: v for k, v in sample.items() if k != "__seq__"}
+
+            # 1) hoja RAW (opcional / comprimida)
+            if ws_raw is not None:
+                raw = fast_dumps(sample)
+                if self.raw_sheet == "zlib":
+                    raw = base64.b64encode(zlib.compress(raw.encode("utf-8"), 1)).decode("ascii")
+                ws_raw.append([ts, raw])
 
             # 2) hoja RT (wide)
-            flat = _flatten(sample)
-            # agrega columnas nuevas si aparecen
-            for key in flat.keys():
-                if key not in self._header:
-                    self._header.append(key)
-                    header_changed = True
-
-            if header_changed:
-                # reescribe header (fila 1), bonito si corresponde
-                for idx, key in enumerate(self._header, start=1):
-                    text = _beautify(key) if (self.pretty_headers and key != "timestamp") else key
-                    ws_rt.cell(row=1, column=idx, value=text)
-                    self._maxlen[idx] = max(self._maxlen.get(idx, 0), len(str(text)))
-                header_changed = False
-
-            # arma fila
-            row = []
-            for idx, col in enumerate(self._header, start=1):
-                if col == "timestamp":
-                    # escribe fecha/hora legible con milisegundo
-                    dt = datetime.fromtimestamp(ts)
-                    text = dt.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-                    row.append(text)
-                    self._maxlen[idx] = max(self._maxlen.get(idx, 0), len(text))
-                else:
-                    val = flat.get(col, None)
-                    row.append(val)
-                    self._maxlen[idx] = max(self._maxlen.get(idx, 0), len(str(val)))
+            row = self._build_row(sample, ts)
+
+            # autosize por muestreo: medir cada celda de cada fila no cambia el resultado
+            if self.autosize and self.rows_written % self.autosize_every == 0:
+                ml = self._maxlen
+                for idx, val in enumerate(row[1:], start=2):
+                    n = len(str(val))
+                    if n > ml.get(idx, 0):
+                        ml[idx] = n
 
             ws_rt.append(row)
             self.rows_written += 1
@@ -0,0 +1,446 @@
+# utils/export_sinks.py
+import csv, os, time, logging
+from datetime import datetime
+from utils.xlsx_stream import XlsxStreamWriter, recover_dir
+
+log = logging.getLogger("uvicorn")
+
+try:
+    import pyarrow as pa          # opcional: parquet / arrow
+    import pyarrow.parquet as pq
+except Exception:
+    pa = None
+    pq = None
+
+# filas por lote en disco (CSV / record batch Arrow) y por row group Parquet
+EXPORT_CSV_CHUNK = int(os.getenv("EXPORT_CSV_CHUNK", "500"))
+EXPORT_ARROW_BATCH = int(os.getenv("EXPORT_ARROW_BATCH", "1000"))
+EXPORT_PARQUET_ROW_GROUP = int(os.getenv("EXPORT_PARQUET_ROW_GROUP", "50000"))
+EXPORT_PARQUET_GROUP_S = float(os.getenv("EXPORT_PARQUET_GROUP_S", "60"))   # row group en el checkpoint pasado este tiempo
+
+FORMATS = ("xlsx", "csv", "parquet", "arrow")
+
+MEDIA_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+EXTENSIONS = {"xlsx": ".xlsx", "csv": ".csv", "parquet": ".parquet", "arrow": ".arrows"}
+
+PARQUET_CHUNK_SUFFIX = ".rg.parquet"   # pedazos de ParquetSink mientras graba
+# os.replace del archivo final: en Windows falla si otro lo tiene abierto (download en curso)
+EXPORT_PUBLISH_RETRY_S = float(os.getenv("EXPORT_PUBLISH_RETRY_S", "30"))
+
+# fin de stream Arrow IPC (continuation + longitud 0): cierra un prefijo servido en vivo
+ARROW_EOS = b"\xff\xff\xff\xff\x00\x00\x00\x00"
+
+class SnapshotUnavailable(RuntimeError):
+    """El formato no permite leer la grabación hasta cerrarla."""
+
+def _ts_str(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+def arrow_type(tag: str):
+    """Tipo Arrow según el grupo del tag ('REAL.x' -> float32, ...); desconocido -> string."""
+    group = tag.partition(".")[0]
+    return {
+        "BOOL": pa.bool_(),
+        "SINT": pa.int8(), "BYTE": pa.uint8(),
+        "INT": pa.int16(), "UINT": pa.uint16(),
+        "DINT": pa.int32(), "UDINT": pa.uint32(),
+        "LINT": pa.int64(), "ULINT": pa.uint64(),
+        "REAL": pa.float32(), "LREAL": pa.float64(),
+        "STRING": pa.string(),
+    }.get(group, pa.string())
+
+class ExportSink:
+    """
+    Destino de una grabación. Filas = [datetime, v1, v2, ...] en el orden de 'tags'.
+      append(row) -> se acumula y se baja a disco por lotes
+      flush()     -> checkpoint (lo que el formato permita)
+      snapshot()  -> vista consistente de lo grabado hasta ahora (tras flush)
+      close()     -> cierra y publica el archivo final (temp + rename atómico)
+    Mientras graba, el archivo vive como '<path>.part': 'path' solo existe completo.
+    """
+    fmt = ""
+
+    def __init__(self, path: str, tags: list[str]):
+        self.path = path
+        self.part_path = path + ".part"
+        self.tags = tags
+        self.bytes_written = 0
+
+    def _publish(self):
+        deadline = time.monotonic() + EXPORT_PUBLISH_RETRY_S
+        delay = 0.05
+        while True:
+            try:
+                os.replace(self.part_path, self.path)
+                return
+            except PermissionError:
+                # Windows: un lector abierto bloquea el rename; esperar a que suelte
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+    def snapshot(self) -> dict:
+        """
+        {"kind": "prefix", "path", "bytes", "suffix"}: los primeros 'bytes' de 'path'
+        (+ suffix) forman un archivo válido. Llamar con las escrituras frenadas y
+        después de flush(); el prefijo no se reescribe, se puede leer sin lock.
+        """
+        raise SnapshotUnavailable(f"{self.fmt}: no hay vista parcial mientras graba")
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.fmt]
+
+    def append(self, row: list): raise NotImplementedError
+    def flush(self): pass
+    def close(self): raise NotImplementedError
+    def discard(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+        for p in (self.part_path, self.path):
+            try:
+                os.unlink(p)
+            except OSError:
+                pass
+
+class XlsxSink(ExportSink):
+    fmt = "xlsx"
+
+    def __init__(self, path: str, tags: list[str]):
+        super().__init__(path, tags)
+        self._writer = XlsxStreamWriter(path)
+        self._sheet = self._writer.add_sheet("rt", table_name="tbl_rt")
+        # header + ancho básico (se emiten al finalizar)
+        self._sheet.header = ["timestamp"] + tags
+        self._sheet.widths = {i: 24 for i in range(1, 2 + len(tags))}
+
+    def append(self, row: list):
+        row[0] = _ts_str(row[0])
+        self._sheet.append(row)
+        self.bytes_written = self._sheet.bytes_written
+
+    def flush(self):
+        self._writer.flush()
+
+    def snapshot(self) -> dict:
+        # el zip se arma después, fuera del lock (write_snapshot)
+        return {"kind": "xlsx", "states": self._writer.snapshot_state(), "rows": self._sheet.rows}
+
+    def write_snapshot(self, target: str, snap: dict):
+        self._writer.snapshot(target, snap["states"])
+
+    def close(self):
+        self._writer.close()  # header, anchos, tabla y zip (temp + rename)
+
+    def discard(self):
+        self._writer.discard()
+
+class CsvSink(ExportSink):
+    fmt = "csv"
+
+    def __init__(self, path: str, tags: list[str], chunk: int = EXPORT_CSV_CHUNK):
+        super().__init__(path, tags)
+        self.chunk = max(1, chunk)
+        self._f = open(self.part_path, "w", newline="", encoding="utf-8")
+        self._w = csv.writer(self._f)
+        self._w.writerow(["timestamp"] + tags)
+        self._rows: list[list] = []
+
+    def append(self, row: list):
+        row[0] = _ts_str(row[0])
+        self._rows.append(row)
+        if len(self._rows) >= self.chunk:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        if self._rows:
+            self._w.writerows(self._rows)
+            self._rows = []
+
+    def flush(self):
+        self._write_chunk()
+        self._f.flush()
+        self.bytes_written = self._f.tell()
+
+    def snapshot(self) -> dict:
+        # tras flush() el archivo termina en fin de fila
+        return {"kind": "prefix", "path": self.part_path, "bytes": self.bytes_written, "suffix": b""}
+
+    def close(self):
+        if not self._f.closed:
+            self.flush()
+            self._f.close()
+            self._publish()
+
+class _ArrowBase(ExportSink):
+    """Acumula columnas y arma RecordBatch tipados (timestamp[ms] + tipo del grupo PLC)."""
+    def __init__(self, path: str, tags: list[str], batch_rows: int):
+        if pa is None:
+            raise ValueError(f"formato {self.fmt} requiere pyarrow (pip install pyarrow)")
+        super().__init__(path, tags)
+        self.batch_rows = max(1, batch_rows)
+        fields = [pa.field("timestamp", pa.timestamp("ms"))]
+        fields += [pa.field(t, arrow_type(t)) for t in tags]
+        self.schema = pa.schema(fields)
+        self._cols: list[list] = [[] for _ in fields]
+
+    def append(self, row: list):
+        for col, v in zip(self._cols, row):
+            col.append(v)
+        if len(self._cols[0]) >= self.batch_rows:
+            self._write_batch()
+
+    def _column(self, values: list, typ):
+        try:
+            return pa.array(values, type=typ)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError, OverflowError):
+            # valor suelto con otro tipo (p.ej. texto de error): se convierte o queda null
+            out = []
+            for v in values:
+                try:
+                    out.append(pa.scalar(v, type=typ).as_py())
+                except Exception:
+                    out.append(str(v) if pa.types.is_string(typ) and v is not None else None)
+            return pa.array(out, type=typ)
+
+    def _peek_batch(self):
+        if not self._cols[0]:
+            return None
+        arrays = [self._column(c, f.type) for c, f in zip(self._cols, self.schema)]
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def _take_batch(self):
+        rb = self._peek_batch()
+        if rb is not None:
+            self._cols = [[] for _ in self._cols]
+        return rb
+
+    def _write_batch(self): raise NotImplementedError
+
+class ArrowSink(_ArrowBase):
+    fmt = "arrow"
+
+    def __init__(self, path: str, tags: list[str], batch_rows: int = EXPORT_ARROW_BATCH):
+        super().__init__(path, tags, batch_rows)
+        self._sink = pa.OSFile(self.part_path, "wb")
+        self._w = pa.ipc.new_stream(self._sink, self.schema)
+        self._closed = False
+
+    def _write_batch(self):
+        rb = self._take_batch()
+        if rb is not None:
+            self._w.write_batch(rb)
+            self.bytes_written = self._sink.tell()
+
+    def flush(self):
+        # en el stream IPC cada checkpoint es un record batch más
+        self._write_batch()
+        self._sink.flush()
+        self.bytes_written = self._sink.tell()
+
+    def snapshot(self) -> dict:
+        # prefijo en borde de record batch + marcador de fin = stream válido
+        return {"kind": "prefix", "path": self.part_path, "bytes": self.bytes_written, "suffix": ARROW_EOS}
+
+    def close(self):
+        if not self._closed:
+            self._write_batch()
+            self._w.close()
+            self._sink.close()
+            self._closed = True
+            self._publish()
+
+class ParquetSink(_ArrowBase):
+    """
+    Cada row group se escribe como un parquet chico y cerrado ('.<archivo>.NNNNN.rg.parquet'):
+    con su footer, se puede leer ya (snapshot en vivo, recuperación tras un crash).
+    close() los une en el archivo final, un row group por pedazo.
+    """
+    fmt = "parquet"
+
+    def __init__(self, path: str, tags: list[str], row_group: int = EXPORT_PARQUET_ROW_GROUP,
+                 group_s: float = EXPORT_PARQUET_GROUP_S):
+        super().__init__(path, tags, row_group)
+        self.group_s = group_s
+        self._group_t0 = 0.0   # monotonic de la primera fila del lote en memoria
+        self._chunk_prefix = os.path.join(os.path.dirname(os.path.abspath(path)),
+                                          f".{os.path.basename(path)}.")
+        self._chunks: list[str] = []
+        self._closed = False
+
+    def append(self, row: list):
+        if not self._cols[0]:
+            self._group_t0 = time.monotonic()
+        super().append(row)
+
+    def flush(self):
+        # row group por filas o por tiempo: a 50 Hz, 50k filas serían ~17 min solo en
+        # memoria; un checkpoint no parte el lote en pedazos chicos antes de group_s
+        if self._cols[0] and time.monotonic() - self._group_t0 >= self.group_s:
+            self._write_batch()
+
+    def _write_batch(self):
+        rb = self._take_batch()
+        if rb is not None:
+            chunk = f"{self._chunk_prefix}{len(self._chunks):05d}{PARQUET_CHUNK_SUFFIX}"
+            pq.write_table(pa.Table.from_batches([rb]), chunk, compression="zstd")
+            self._chunks.append(chunk)
+            self.bytes_written += os.path.getsize(chunk)
+
+    def snapshot(self) -> dict:
+        # pedazos ya cerrados + copia del lote en memoria; el armado va en write_snapshot
+        return {"kind": "parquet", "chunks": list(self._chunks), "tail": self._peek_batch()}
+
+    def write_snapshot(self, target: str, snap: dict):
+        merge_parquet(target, self.schema, snap["chunks"], snap["tail"])
+
+    def close(self):
+        if not self._closed:
+            self._write_batch()
+            merge_parquet(self.part_path, self.schema, self._chunks)
+            self._closed = True
+            self._publish()
+            self._drop_chunks()
+
+    def discard(self):
+        self._closed = True
+        self._drop_chunks()
+        super().discard()
+
+    def _drop_chunks(self):
+        for c in self._chunks:
+            try:
+                os.unlink(c)
+            except OSError:
+                pass   # Windows: un snapshot lo tiene abierto; lo barre recover_parts()
+        self._chunks = []
+
+def merge_parquet(target: str, schema, chunks: list[str], tail=None):
+    """Une pedazos de ParquetSink (+ un RecordBatch suelto) en 'target' sin releer todo a memoria."""
+    tmp = target + ".tmp"
+    try:
+        with pq.ParquetWriter(tmp, schema, compression="zstd") as w:
+            for c in chunks:
+                w.write_table(pq.read_table(c, schema=schema))
+            if tail is not None:
+                w.write_batch(tail)
+        os.replace(tmp, target)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+_SINKS = {"xlsx": XlsxSink, "csv": CsvSink, "parquet": ParquetSink, "arrow": ArrowSink}
+
+def read_prefix(f, nbytes: int, suffix: bytes = b"", chunk: int = 1 << 16):
+    """
+    Generador: primeros nbytes de 'f' (abierto en "rb") + suffix. Se pasa el archivo
+    ya abierto: si la grabación cierra y renombra el .part mientras tanto, el
+    descriptor sigue leyendo el mismo contenido (en Windows el rename espera, ver
+    _publish: copiar el prefijo a un temporal en vez de servirlo directo).
+    """
+    with f:
+        left = nbytes
+        while left > 0:
+            data = f.read(min(chunk, left))
+            if not data:
+                break
+            left -= len(data)
+            yield data
+    if suffix:
+        yield suffix
+
+def _recover_csv(part: str) -> bool:
+    # prefijo legible: hasta el último fin de línea (una fila a medio escribir se descarta)
+    with open(part, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        f.truncate(end)
+    return end > 0
+
+def _recover_arrow(part: str) -> bool:
+    # record batches enteros + fin de stream; el último a medio escribir se pierde
+    if pa is None:
+        return False
+    tmp = part + ".tmp"
+    with pa.OSFile(part, "rb") as src:
+        reader = pa.ipc.open_stream(src)
+        with pa.OSFile(tmp, "wb") as dst, pa.ipc.new_stream(dst, reader.schema) as w:
+            while True:
+                try:
+                    w.write_batch(reader.read_next_batch())
+                except (StopIteration, pa.ArrowInvalid, OSError):
+                    break
+    os.replace(tmp, part)
+    return True
+
+def recover_parts(folder: str) -> list[str]:
+    """
+    Al arrancar (antes de abrir grabaciones): publica lo que dejó una grabación cortada
+    por crash/kill, hasta su último checkpoint. xlsx se rearma desde su journal
+    (recover_dir); csv/arrow son prefijos legibles y se renombran al nombre final;
+    parquet se une desde sus pedazos ya cerrados. Devuelve los archivos publicados.
+    """
+    out = recover_dir(folder)
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return out
+    for name in names:
+        if name.startswith(".") or not name.endswith(".part"):
+            continue
+        part = os.path.join(folder, name)
+        final = part[:-len(".part")]
+        try:
+            if final.endswith(EXTENSIONS["parquet"]):
+                # los datos están en los pedazos (más abajo); el .part sin footer no sirve
+                os.unlink(part)
+                continue
+            if final.endswith(EXTENSIONS["csv"]):
+                ok = _recover_csv(part)
+            elif final.endswith(EXTENSIONS["arrow"]):
+                ok = _recover_arrow(part)
+            else:
+                continue
+            if ok and not os.path.exists(final):
+                os.replace(part, final)
+                out.append(final)
+                log.warning("export: recuperado %s (grabación cortada, hasta su último checkpoint)", final)
+        except Exception as e:
+            log.warning("export: no pude recuperar %s: %s", part, e)
+    # parquet: pedazos cerrados '.<archivo>.NNNNN.rg.parquet' de una grabación cortada
+    chunks: dict[str, list[str]] = {}
+    for name in names if pq is not None else ():
+        if name.startswith(".") and name.endswith(PARQUET_CHUNK_SUFFIX):
+            base = name[1:-len(PARQUET_CHUNK_SUFFIX)].rpartition(".")[0]
+            chunks.setdefault(base, []).append(os.path.join(folder, name))
+    for base, parts in chunks.items():
+        final = os.path.join(folder, base)
+        parts.sort()
+        try:
+            if not os.path.exists(final):   # si existe, close() llegó a publicarlo: son restos
+                merge_parquet(final, pq.read_schema(parts[0]), parts)
+                out.append(final)
+                log.warning("export: recuperado %s (grabación cortada, hasta su último row group)", final)
+            for p in parts:
+                os.unlink(p)
+        except Exception as e:
+            log.warning("export: no pude recuperar %s: %s", final, e)
+    return out
+
+def open_sink(fmt: str, path: str, tags: list[str]) -> ExportSink:
+    cls = _SINKS.get(fmt)
+    if cls is None:
+        raise ValueError(f"format inválido: {fmt!r} (usa {', '.join(FORMATS)})")
+    return cls(path, tags)
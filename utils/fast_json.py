@@ -0,0 +1,111 @@
+# utils/fast_json.py
+import json, math, os
+from json.encoder import encode_basestring   # versión C, sin ensure_ascii
+
+try:
+    import orjson  # opcional: backend nativo
+except ImportError:
+    orjson = None
+
+# auto (orjson si está, si no json) | orjson | template | json
+BACKEND = os.getenv("FAST_JSON_BACKEND", "auto").lower()
+
+_BOOL_JSON = {True: "true", False: "false"}
+_NONFINITE = (":nan", ":inf", ":-inf")
+
+def _enc_any(v) -> str:
+    t = type(v)
+    if t is float:
+        return float.__repr__(v) if math.isfinite(v) else json.dumps(v)
+    if t is bool:
+        return _BOOL_JSON[v]
+    if t is int:
+        return int.__repr__(v)
+    if t is str:
+        return encode_basestring(v)
+    if v is None:
+        return "null"
+    return json.dumps(v, ensure_ascii=False, separators=(",", ":"), default=str)
+
+class _Template:
+    """Fragmentos de clave ya codificados para un esquema (orden de claves) concreto."""
+    __slots__ = ("version", "segs")
+
+    def __init__(self, version: int, sample: dict):
+        self.version = version
+        self.segs = []
+        first = True
+        for k, v in sample.items():
+            prefix = ("{" if first else ",") + encode_basestring(k) + ":"
+            first = False
+            if type(v) is dict:
+                keys = [encode_basestring(name).replace("%", "%%") + ":" for name in v]
+                fmt_r = "{" + ",".join(kf + "%r" for kf in keys) + "}"   # float/int: repr en C
+                fmt_s = "{" + ",".join(kf + "%s" for kf in keys) + "}"   # ya convertidos a str
+                self.segs.append((prefix, fmt_r, fmt_s))
+            else:
+                self.segs.append((prefix, None, None))
+
+def _enc_group(fmt_r: str, fmt_s: str, vals: tuple) -> str:
+    types = set(map(type, vals))
+    if types == {float} or types == {int} or types == {float, int}:
+        out = fmt_r % vals
+        if not any(x in out for x in _NONFINITE):
+            return out
+    elif types == {bool}:
+        return fmt_s % tuple(map(_BOOL_JSON.__getitem__, vals))
+    return fmt_s % tuple(map(_enc_any, vals))
+
+class SampleEncoder:
+    """
+    Codifica muestras {grupo: {tag: valor}, "timestamp": .., "__seq__": ..}.
+      • orjson:   nativo, ~10x json.dumps (ver bench/bench_json.py)
+      • template: con el esquema de tags fijo las claves nunca cambian; se cachean
+                  los fragmentos '"tag":' por versión de esquema y solo se formatean
+                  los valores. En CPython empata con el json en C (el costo es el
+                  repr de los float), así que 'auto' cae a json si no hay orjson.
+      • json:     el de siempre
+    """
+    def __init__(self, backend: str = BACKEND, max_schemas: int = 16):
+        if backend == "auto":
+            backend = "orjson" if orjson is not None else "json"
+        if backend == "orjson" and orjson is None:
+            backend = "json"
+        self.backend = backend
+        self.max_schemas = max_schemas
+        self._templates: dict[tuple, _Template] = {}
+        self.schema_version = 0
+
+    def _template(self, sample: dict) -> _Template:
+        shape = tuple((k, tuple(v)) if type(v) is dict else k for k, v in sample.items())
+        tpl = self._templates.get(shape)
+        if tpl is None:
+            if len(self._templates) >= self.max_schemas:
+                self._templates.clear()
+            self.schema_version += 1
+            tpl = _Template(self.schema_version, sample)
+            self._templates[shape] = tpl
+        return tpl
+
+    def encode(self, obj) -> str:
+        if self.backend == "orjson":
+            return orjson.dumps(obj, default=str).decode("utf-8")
+        if self.backend == "json" or type(obj) is not dict or not obj:
+            return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str)
+
+        tpl = self._template(obj)
+        parts = []
+        for (prefix, fmt_r, fmt_s), v in zip(tpl.segs, obj.values()):
+            parts.append(prefix)
+            if fmt_r is None:
+                parts.append(_enc_any(v))
+            else:
+                parts.append(_enc_group(fmt_r, fmt_s, tuple(v.values())))
+        parts.append("}")
+        return "".join(parts)
+
+# instancia compartida (WS/SSE, ExcelLogger)
+encoder = SampleEncoder()
+
+def dumps(obj) -> str:
+    return encoder.encode(obj)
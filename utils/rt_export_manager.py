@@ -1,10 +1,34 @@
 # utils/rt_export_manager.py
-import os, time, json, threading
+import os, time, logging, queue, threading, uuid
 from datetime import datetime
-from openpyxl import Workbook
-from openpyxl.utils import get_column_letter
+from utils.export_sinks import EXTENSIONS, FORMATS, MEDIA_TYPES, open_sink, recover_parts
 
-def _flatten(obj, prefix="", out=None):
+try:
+    import psutil  # opcional, solo para RSS en status()
+except Exception:
+    psutil = None
+
+log = logging.getLogger("uvicorn")
+
+def rss_mb():
+    """RSS del proceso en MB (psutil o /proc); None si no se puede medir."""
+    if psutil is not None:
+        return round(psutil.Process().memory_info().rss / 2**20, 1)
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+    except Exception:
+        return None
+
+EXPORT_QUEUE_MAX = int(os.getenv("EXPORT_QUEUE_MAX", "20000"))   # muestras en espera por escritor
+EXPORT_STOP_TIMEOUT_S = float(os.getenv("EXPORT_STOP_TIMEOUT_S", "60"))
+EXPORT_WRITERS = int(os.getenv("EXPORT_WRITERS", "2"))            # hilos escritores compartidos
+EXPORT_KEEP_SESSIONS = int(os.getenv("EXPORT_KEEP_SESSIONS", "50"))  # terminadas que se recuerdan
+
+_STOP = object()
+
+def flatten(obj, prefix="", out=None):
+    """{"REAL": {"a": 1}} -> {"REAL.a": 1} (anidado con puntos)."""
     if out is None:
         out = {}
     if not isinstance(obj, dict):
@@ -12,134 +36,377 @@ def _flatten(obj, prefix="", out=None):
     for k, v in obj.items():
         key = f"{prefix}.{k}" if prefix else k
         if isinstance(v, dict):
-            _flatten(v, key, out)
+            flatten(v, key, out)
         else:
             out[key] = v
     return out
 
-class RtExportManager:
-    """
-    Grabación RT a Excel:
-    - start(tags): inicia nuevo xlsx (timestamp + tags)
-    - ingest(sample): mete una fila (si active)
-    - stop(): finaliza y deja listo para download
-    - status(): estado + contador
-    """
-    def __init__(self, out_dir="exports", checkpoint_s=1.5):
-        self.out_dir = out_dir
+def sample_dt(sample: dict, flat: dict) -> datetime:
+    # timestamp robusto
+    ts_raw = sample.get("timestamp", flat.get("timestamp", time.time()))
+
+    try:
+        if isinstance(ts_raw, (int, float)):
+            dt = datetime.fromtimestamp(float(ts_raw))
+        elif isinstance(ts_raw, str):
+            s = ts_raw.strip()
+            # string numérico epoch
+            try:
+                dt = datetime.fromtimestamp(float(s))
+            except Exception:
+                # ISO string (ej. 2026-02-20T15:41:36.833Z)
+                dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
+        else:
+            dt = datetime.now()
+    except Exception:
+        dt = datetime.now()
+
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)  # todo en hora local, como el resto
+    return dt
+
+class ExportSession:
+    """Una grabación: sus tags, formato, tasa y archivo. La escribe un solo hilo del pool."""
+    def __init__(self, out_dir: str, tags: list[str], fmt: str, rate_hz: float | None,
+                 checkpoint_s: float, prefix: str = "rt_export"):
+        self.id = uuid.uuid4().hex[:12]
+        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.path = os.path.join(out_dir, f"{prefix}_{ts}_{self.id}{EXTENSIONS[fmt]}")
+        self.format = fmt
+        self.tags = tags
+        self.rate_hz = rate_hz
         self.checkpoint_s = checkpoint_s
-        os.makedirs(out_dir, exist_ok=True)
+        self._period = 1.0 / rate_hz if rate_hz else 0.0
+        self._next_t = None
+
+        # pre_seconds: mientras se siembra desde el buffer, lo vivo se retiene en _held
+        self.pre_seconds = 0.0
+        self.seeded_rows = 0
+        self.seeded_from = None
+        self._seeding = False
+        self._held: list = []
+        self._min_seq = 0
 
         self._lock = threading.Lock()
-        self.active = False
-        self.tags = []
-        self.rows_written = 0
-        self.path = None
-        self.started_at = None
+        self._sink = open_sink(fmt, self.path, tags)  # ValueError si falta pyarrow
+        self.writer = None
+        self.active = True
+        self.started_at = time.time()
+        self.stopped_at = None
 
-        self._wb = None
-        self._ws = None
-        self._last_save = 0.0
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.dropped = 0
+        self.decimated = 0
+        self._last_save = self._rate_t = time.time()
+        self._rate_rows = 0
+        self.rows_per_s = 0.0
 
-    def start(self, tags: list[str]) -> dict:
-        tags = [t for t in tags if isinstance(t, str) and t.strip()]
-        if not tags:
-            raise ValueError("tags vacío")
+    def seed(self, samples: list[dict]):
+        """
+        Escribe el histórico (ya copiado del buffer) y después lo vivo retenido
+        mientras tanto, salteando por __seq__ lo que ya vino en el histórico.
+        """
+        last_seq = 0
+        for sample in samples:
+            flat = flatten(sample)
+            with self._lock:
+                self._write_locked(flat, sample_dt(sample, flat))
+            last_seq = sample.get("__seq__", last_seq)
+        with self._lock:
+            self.seeded_rows = self.rows_written
+            if samples:
+                self.seeded_from = samples[0].get("timestamp")
+            self._min_seq = last_seq
+            held, self._held = self._held, []
+            for flat, dt in held:
+                if flat.get("__seq__", last_seq + 1) > last_seq:
+                    self._write_locked(flat, dt)
+            self._seeding = False
 
+    # --- llamado desde el hilo escritor ---
+    def write(self, flat: dict, dt: datetime):
         with self._lock:
-            ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-            self.path = os.path.join(self.out_dir, f"rt_export_{ts}.xlsx")
+            if self._seeding:
+                self._held.append((flat, dt))
+                return
+            if self._min_seq and flat.get("__seq__", self._min_seq + 1) <= self._min_seq:
+                return  # ya vino en el histórico
+            self._write_locked(flat, dt)
 
-            self._wb = Workbook()
-            self._ws = self._wb.active
-            self._ws.title = "rt"
+    def _write_locked(self, flat: dict, dt: datetime):
+        if self._sink is None:
+            return
+        if self._period:
+            t = dt.timestamp()
+            if self._next_t is not None and t < self._next_t:
+                self.decimated += 1
+                return
+            # grilla fija; si hubo un hueco se re-ancla en la muestra actual
+            nxt = (self._next_t or t) + self._period
+            self._next_t = nxt if nxt > t else t + self._period
 
-            self.tags = tags
-            self.rows_written = 0
-            self.started_at = time.time()
-            self.active = True
+        # cada sink formatea el timestamp a su manera (texto en xlsx/csv, timestamp[ms] en arrow)
+        row = [dt] + [flat.get(tag) for tag in self.tags]
+        self._sink.append(row)
+        self.rows_written += 1
 
-            # header
-            self._ws.append(["timestamp"] + self.tags)
-            self._last_save = 0.0
-            self._save(force=True)
+    def checkpoint(self, force=False):
+        # checkpoint barato: baja a disco el lote pendiente (O(lote), no re-escribe nada).
+        # Es solo un flush: el archivo final recién existe en finalize(); tras un crash
+        # recover_parts() lo rearma al arrancar con lo volcado hasta acá.
+        with self._lock:
+            if self._sink is None:
+                return
+            now = time.time()
+            if force or (now - self._last_save) >= self.checkpoint_s:
+                self._sink.flush()
+                self.bytes_written = self._sink.bytes_written
+                self._last_save = now
+                dt = now - self._rate_t
+                if dt > 0:
+                    self.rows_per_s = round((self.rows_written - self._rate_rows) / dt, 1)
+                self._rate_t, self._rate_rows = now, self.rows_written
 
-            return self.status()
+    def snapshot(self) -> dict | None:
+        """
+        Vista de lo grabado hasta ahora, sin frenar la grabación más que un flush:
+        fija el límite bajo el lock y el armado/lectura queda para quien descarga.
+        None si la sesión ya cerró (usar el archivo final). SnapshotUnavailable según formato.
+        """
+        with self._lock:
+            if self._sink is None:
+                return None
+            self._sink.flush()
+            self.bytes_written = self._sink.bytes_written
+            snap = self._sink.snapshot()
+            snap["rows"] = self.rows_written
+            if snap["kind"] == "prefix":
+                snap["file"] = open(snap["path"], "rb")  # abierto antes de un posible rename
+            else:
+                snap["sink"] = self._sink
+            return snap
 
-    def ingest(self, sample: dict):
+    def finalize(self):
+        self.checkpoint(force=True)
         with self._lock:
-            if not self.active or not self._ws:
+            sink, self._sink = self._sink, None
+            if sink is None:
                 return
+            sink.close()
+            try:
+                self.bytes_written = os.path.getsize(self.path)
+            except OSError:
+                pass
 
-            if not isinstance(sample, dict):
-                return
+    def status(self) -> dict:
+        return {
+            "id": self.id,
+            "active": self.active,
+            "rows_written": self.rows_written,
+            "path": self.path,
+            "tags": self.tags,
+            "started_at": self.started_at,
+            "stopped_at": self.stopped_at,
+            "rows_per_s": self.rows_per_s,
+            "rate_hz": self.rate_hz,
+            "pre_seconds": self.pre_seconds,
+            "seeded_rows": self.seeded_rows,
+            "seeded_from": self.seeded_from,
+            "format": self.format,
+            "media_type": MEDIA_TYPES[self.format],
+            "bytes_written": self.bytes_written,
+            "dropped": self.dropped,
+            "decimated": self.decimated,
+            "writer": self.writer.name if self.writer else None,
+        }
+
+class _ExportWriter(threading.Thread):
+    """Hilo del pool: cola acotada propia + sus sesiones (orden por sesión garantizado)."""
+    def __init__(self, idx: int):
+        super().__init__(name=f"rt-export-writer-{idx}", daemon=True)
+        self.q: queue.Queue = queue.Queue(maxsize=EXPORT_QUEUE_MAX)
+        self.sessions: tuple[ExportSession, ...] = ()   # copy-on-write: el hot path lo lee sin lock
+        self._lock = threading.Lock()
 
-            flat = _flatten(sample)
+    def add(self, s: ExportSession):
+        with self._lock:
+            self.sessions = self.sessions + (s,)
+        s.writer = self
+        if not self.is_alive():
+            try:
+                self.start()
+            except RuntimeError:
+                pass  # ya arrancado
 
-            # timestamp robusto
-            ts_raw = sample.get("timestamp", flat.get("timestamp", time.time()))
+    def remove(self, s: ExportSession):
+        with self._lock:
+            self.sessions = tuple(x for x in self.sessions if x is not s)
 
+    def offer(self, sample: dict):
+        try:
+            self.q.put_nowait(sample)
+        except queue.Full:
+            for s in self.sessions:
+                s.dropped += 1
+
+    def run(self):
+        while True:
             try:
-                if isinstance(ts_raw, (int, float)):
-                    dt = datetime.fromtimestamp(float(ts_raw))
-                elif isinstance(ts_raw, str):
-                    s = ts_raw.strip()
-                    # string numérico epoch
+                items = [self.q.get(timeout=0.5)]
+            except queue.Empty:
+                items = []
+            # drenar lo que haya en un solo paso
+            while items and len(items) < 1000:
+                try:
+                    items.append(self.q.get_nowait())
+                except queue.Empty:
+                    break
+            for item in items:
+                if type(item) is tuple and item[0] is _STOP:
+                    _, s, done = item
                     try:
-                        dt = datetime.fromtimestamp(float(s))
-                    except Exception:
-                        # ISO string (ej. 2026-02-20T15:41:36.833Z)
-                        dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
-                else:
-                    dt = datetime.now()
-            except Exception:
-                dt = datetime.now()
+                        s.finalize()
+                    except Exception as e:
+                        log.exception("RT export %s: error al finalizar: %s", s.id, e)
+                    finally:
+                        self.remove(s)
+                        done.set()
+                    continue
+                if not isinstance(item, dict):
+                    continue
+                # flatten + timestamp una vez por muestra, compartido por las sesiones del hilo
+                flat = flatten(item)
+                dt = sample_dt(item, flat)
+                for s in self.sessions:
+                    try:
+                        s.write(flat, dt)
+                    except Exception as e:
+                        log.exception("RT export %s: error escribiendo: %s", s.id, e)
+            for s in self.sessions:
+                try:
+                    s.checkpoint()
+                except Exception as e:
+                    log.exception("RT export %s: error en checkpoint: %s", s.id, e)
 
-            dt_str = dt.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+class RtExportManager:
+    """
+    Grabaciones RT (xlsx/csv/parquet/arrow), varias a la vez e independientes:
+    - start(tags, fmt, rate_hz): nueva sesión -> status con su 'id'
+    - ingest(sample): encola en los escritores que tienen sesiones; nunca toca disco
+    - stop(id): drena la cola, finaliza y deja listo para download
+    - get(id) / list() / status(id)
+    Un pool de EXPORT_WRITERS hilos escribe en streaming (memoria y costo por
+    fila constantes); cada sesión queda fija a un hilo (el de menos sesiones).
+    Sin id (API vieja) se usa la última sesión iniciada.
+    """
+    def __init__(self, out_dir="exports", checkpoint_s=1.5, writers: int = EXPORT_WRITERS,
+                 buffer=None):
+        self.out_dir = out_dir
+        self.buffer = buffer  # DataBuffer para pre_seconds (histórico reciente)
+        self.checkpoint_s = checkpoint_s
+        os.makedirs(out_dir, exist_ok=True)
+        # grabaciones cortadas por un crash: se publican hasta su último checkpoint
+        self.recovered = recover_parts(out_dir)
 
-            row = [dt_str] + [flat.get(t) for t in self.tags]
-            self._ws.append(row)
-            self.rows_written += 1
+        self._lock = threading.Lock()
+        self._sessions: dict[str, ExportSession] = {}
+        self._current: str | None = None
+        self._writers = [_ExportWriter(i) for i in range(max(1, writers))]
 
-            # debug temporal
-            if self.rows_written <= 3 or self.rows_written % 20 == 0:
-                import logging
-                logging.getLogger("uvicorn").info(
-                    "RT export wrote row #%s | ts=%s",
-                    self.rows_written, dt_str
-                )
+    @property
+    def active(self) -> bool:
+        return any(w.sessions for w in self._writers)
 
-            self._save()
+    def start(self, tags: list[str], fmt: str = "xlsx", rate_hz: float | None = None,
+              pre_seconds: float | None = None) -> dict:
+        tags = [t for t in tags if isinstance(t, str) and t.strip()]
+        if not tags:
+            raise ValueError("tags vacío")
+        fmt = (fmt or "xlsx").lower()
+        if fmt not in FORMATS:
+            raise ValueError(f"format inválido: {fmt!r} (usa {', '.join(FORMATS)})")
+        if rate_hz is not None:
+            rate_hz = float(rate_hz)
+            if rate_hz <= 0:
+                rate_hz = None
+        pre_seconds = max(0.0, float(pre_seconds or 0))
+        if pre_seconds and self.buffer is None:
+            raise ValueError("pre_seconds sin buffer de histórico")
 
-    def stop(self) -> dict:
+        s = ExportSession(self.out_dir, tags, fmt, rate_hz, self.checkpoint_s)
+        s.pre_seconds = pre_seconds
+        s._seeding = bool(pre_seconds)
+        # primero se engancha a lo vivo (retenido) y recién después se copia el
+        # histórico: así no queda hueco entre el buffer y el stream
         with self._lock:
-            if not self.active:
-                return self.status()
-            self.active = False
-            self._save(force=True)
-            return self.status()
-
-    def _save(self, force=False):
-        if not self._wb or not self.path:
-            return
-        now = time.time()
-        if force or (now - self._last_save) >= self.checkpoint_s:
-            # ancho básico
+            self._sessions[s.id] = s
+            self._current = s.id
+            self._prune()
+            w = min(self._writers, key=lambda w: len(w.sessions))
+            w.add(s)
+        if pre_seconds:
             try:
-                for i in range(1, 2 + len(self.tags)):
-                    col = get_column_letter(i)
-                    self._ws.column_dimensions[col].width = 24
+                s.seed(self.buffer.since(time.time() - pre_seconds))
             except Exception:
-                pass
+                s._seeding = False
+                self.stop(s.id)
+                raise
+        return s.status()
 
-            self._wb.save(self.path)
-            self._last_save = now
+    def _prune(self):
+        done = [s for s in self._sessions.values() if not s.active]
+        for s in sorted(done, key=lambda s: s.started_at)[:max(0, len(done) - EXPORT_KEEP_SESSIONS)]:
+            self._sessions.pop(s.id, None)
 
-    def status(self) -> dict:
-        return {
-            "active": self.active,
-            "rows_written": self.rows_written,
-            "path": self.path,
-            "tags": self.tags,
-            "started_at": self.started_at,
-        }
+    def ingest(self, sample: dict):
+        # hot path (hilo de adquisición): solo encolar, sin lock ni disco
+        for w in self._writers:
+            if w.sessions:
+                w.offer(sample)
+
+    def get(self, session_id: str | None = None) -> ExportSession | None:
+        sid = session_id or self._current
+        return self._sessions.get(sid) if sid else None
+
+    def stop(self, session_id: str | None = None) -> dict:
+        s = self.get(session_id)
+        if s is None:
+            if session_id:
+                raise KeyError(session_id)
+            return self.status()
+        with self._lock:
+            if not s.active:
+                return s.status()
+            s.active = False
+            s.stopped_at = time.time()
+        # el marcador va detrás de las muestras ya encoladas: se escriben todas antes de cerrar
+        done = threading.Event()
+        s.writer.q.put((_STOP, s, done))
+        if not done.wait(EXPORT_STOP_TIMEOUT_S):
+            log.warning("RT export %s: stop() no terminó en %.0fs", s.id, EXPORT_STOP_TIMEOUT_S)
+        return s.status()
+
+    def snapshot(self, session_id: str | None = None) -> tuple[ExportSession, dict | None]:
+        s = self.get(session_id)
+        if s is None:
+            raise KeyError(session_id)
+        return s, s.snapshot()
+
+    def list(self) -> list[dict]:
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return [s.status() for s in sorted(sessions, key=lambda s: s.started_at, reverse=True)]
+
+    def status(self, session_id: str | None = None) -> dict:
+        s = self.get(session_id)
+        if s is None:
+            if session_id:
+                raise KeyError(session_id)
+            st = {"id": None, "active": False, "rows_written": 0, "path": None, "tags": [],
+                  "started_at": None, "format": None, "media_type": None}
+        else:
+            st = s.status()
+        st["queued"] = sum(w.q.qsize() for w in self._writers)
+        st["rss_mb"] = rss_mb()
+        return st
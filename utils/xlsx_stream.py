@@ -0,0 +1,519 @@
+# utils/xlsx_stream.py
+import os, re, json, time, shutil, logging, tempfile, zipfile
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+# Escritor XLSX en streaming: las filas se serializan a XML y se agregan a un
+# archivo temporal en disco (memoria constante, sin objetos celda); el zip con
+# workbook/estilos/tabla se arma recién en close(). Costo por fila O(1), no
+# crece con el tamaño del archivo como Workbook.save().
+#
+# Ojo: mientras graba NO hay .xlsx en disco. Un checkpoint (flush) solo baja las
+# filas al cuerpo '.<archivo>.*.sheet.part' y reescribe el journal
+# '.<archivo>.journal.json' (hojas, header, bytes/filas volcados). Si el proceso
+# muere, recover_dir() arma el .xlsx con lo que había hasta el último checkpoint
+# y borra los temporales; llamarlo al arrancar, antes de abrir escritores.
+
+log = logging.getLogger("uvicorn")
+
+try:
+    import psutil  # opcional, solo para saber si el dueño de un journal sigue vivo
+except Exception:
+    psutil = None
+
+JOURNAL_SUFFIX = ".journal.json"
+XLSX_ORPHAN_AGE_S = float(os.getenv("XLSX_ORPHAN_AGE_S", "3600"))   # .sheet.part sin journal: se borra
+
+_ILLEGAL_XML = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+_EXCEL_EPOCH = datetime(1899, 12, 30)
+
+_NS = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+_NS_R = 'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+STYLE_DATETIME = 1  # índice en cellXfs (ver _STYLES)
+
+_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    f'<styleSheet {_NS}>'
+    '<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy-mm-dd hh:mm:ss.000"/></numFmts>'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+def col_letter(idx: int) -> str:
+    """1 -> A, 27 -> AA."""
+    out = ""
+    while idx > 0:
+        idx, rem = divmod(idx - 1, 26)
+        out = chr(65 + rem) + out
+    return out
+
+def excel_serial(dt: datetime) -> float:
+    """datetime naive (hora local) -> número de serie Excel."""
+    d = dt - _EXCEL_EPOCH
+    return d.days + (d.seconds + d.microseconds / 1e6) / 86400.0
+
+def _xml_text(s: str) -> str:
+    return escape(_ILLEGAL_XML.sub("", s))
+
+class StreamSheet:
+    """Una hoja: header (fila 1, se emite al cerrar) + cuerpo en un temporal en disco."""
+    def __init__(self, name: str, tmp_dir: str, table_name: str | None = None,
+                 prefix: str = ".", part: str | None = None):
+        self.name = name
+        self.table_name = table_name
+        self.header: list[str] = []
+        self.widths: dict[int, float] = {}        # idx columna (1..) -> ancho
+        self.datetime_cols: set[int] = set()      # idx columna con estilo fecha/hora
+        self.rows = 0                             # filas de datos (sin header)
+        self.ncols = 0
+        self._cols: list[str] = []                # letras cacheadas
+        if part is None:
+            self._body = tempfile.NamedTemporaryFile(dir=tmp_dir, prefix=prefix, suffix=".sheet.part", delete=False)
+            self.part = self._body.name
+        else:
+            self._body = None   # cuerpo huérfano de una corrida anterior (recover_dir)
+            self.part = part
+        self.bytes_written = 0
+
+    def _letters(self, n: int) -> list[str]:
+        while len(self._cols) < n:
+            self._cols.append(col_letter(len(self._cols) + 1))
+        return self._cols
+
+    def append(self, row) -> None:
+        r = self.rows + 2
+        cols = self._letters(len(row))
+        dtc = self.datetime_cols
+        parts = [f'<row r="{r}">']
+        add = parts.append
+        # 'r' de la celda es opcional (posición implícita): solo hace falta
+        # después de saltear una celda vacía
+        ref = ""
+        for i, v in enumerate(row):
+            t = type(v)
+            if t is float:
+                if v - v != 0.0:   # nan / inf: Excel no los representa
+                    ref = None
+                    continue
+            elif v is None:
+                ref = None
+                continue
+            if ref is None or ref:
+                ref = f' r="{cols[i]}{r}"'
+            if t is float or t is int:
+                if dtc and (i + 1) in dtc:
+                    add(f'<c{ref} s="{STYLE_DATETIME}"><v>{v!r}</v></c>')
+                else:
+                    add(f'<c{ref}><v>{v!r}</v></c>')
+            elif t is bool:
+                add(f'<c{ref} t="b"><v>{1 if v else 0}</v></c>')
+            elif t is datetime:
+                add(f'<c{ref} s="{STYLE_DATETIME}"><v>{excel_serial(v)!r}</v></c>')
+            else:
+                add(f'<c{ref} t="inlineStr"><is><t>{_xml_text(str(v))}</t></is></c>')
+        add("</row>")
+        data = "".join(parts).encode("utf-8")
+        self._body.write(data)
+        self.bytes_written += len(data)
+        self.rows += 1
+        if len(row) > self.ncols:
+            self.ncols = len(row)
+
+    def flush(self):
+        self._body.flush()
+
+    def discard(self):
+        try:
+            if self._body is not None:
+                self._body.close()
+        finally:
+            try:
+                os.unlink(self.part)
+            except OSError:
+                pass
+
+    def meta(self) -> dict:
+        """Lo necesario para rearmar la hoja desde el .part (journal); llamar tras flush()."""
+        return {"name": self.name, "table_name": self.table_name, "part": os.path.basename(self.part),
+                "header": list(self.header), "widths": self.widths,
+                "datetime_cols": sorted(self.datetime_cols),
+                "bytes": self.bytes_written, "rows": self.rows, "ncols": self.ncols}
+
+    # --- armado final ---
+    def _table_headers(self) -> list[str]:
+        # Excel exige nombres de columna de tabla únicos y no vacíos
+        seen, out = set(), []
+        for i in range(max(self.ncols, len(self.header))):
+            base = (self.header[i] if i < len(self.header) else "") or f"col{i + 1}"
+            name, k = base, 2
+            while name.lower() in seen:
+                name = f"{base}_{k}"
+                k += 1
+            seen.add(name.lower())
+            out.append(name)
+        return out
+
+    def _has_table(self, rows: int) -> bool:
+        return bool(self.table_name) and rows > 0
+
+    def state(self) -> tuple[int, int, int]:
+        """(bytes, filas, columnas) del cuerpo ya volcado: límite consistente para un snapshot."""
+        self._body.flush()
+        return self.bytes_written, self.rows, self.ncols
+
+    def write_xml(self, out, state: tuple[int, int, int] | None = None):
+        """Escribe el XML de la hoja en 'out'; con state (ver state()) solo ese prefijo."""
+        if state is None:
+            self._body.flush()
+            body_bytes, rows, data_cols = None, self.rows, self.ncols
+        else:
+            body_bytes, rows, data_cols = state
+        has_table = self._has_table(rows)
+        headers = self._table_headers() if has_table else list(self.header)
+        ncols = max(len(headers), 1)
+        out.write(
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<worksheet {_NS} {_NS_R}>'
+            .encode("utf-8"))
+        last_col = col_letter(max(ncols, data_cols, 1))
+        out.write(f'<dimension ref="A1:{last_col}{rows + 1}"/>'.encode("utf-8"))
+        if self.widths:
+            cols = "".join(
+                f'<col min="{i}" max="{i}" width="{w:.1f}" customWidth="1"/>'
+                for i, w in sorted(self.widths.items()))
+            out.write(f"<cols>{cols}</cols>".encode("utf-8"))
+        out.write(b"<sheetData>")
+        if headers:
+            letters = self._letters(len(headers))
+            cells = "".join(
+                f'<c r="{letters[i]}1" t="inlineStr"><is><t>{_xml_text(h)}</t></is></c>'
+                for i, h in enumerate(headers))
+            out.write(f'<row r="1">{cells}</row>'.encode("utf-8"))
+        with open(self.part, "rb") as f:
+            if body_bytes is None:
+                shutil.copyfileobj(f, out, 1 << 20)
+            else:
+                left = body_bytes
+                while left > 0:
+                    chunk = f.read(min(left, 1 << 20))
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    left -= len(chunk)
+        out.write(b"</sheetData>")
+        if has_table:
+            out.write(b'<tableParts count="1"><tablePart r:id="rId1"/></tableParts>')
+        out.write(b"</worksheet>")
+        return headers, ncols, rows, has_table
+
+class XlsxStreamWriter:
+    """
+    w = XlsxStreamWriter(path); sh = w.add_sheet("rt", table_name="tbl_rt")
+    sh.header = [...]; sh.append([...]) ...; w.close()  -> arma el .xlsx
+    """
+    def __init__(self, path: str, compresslevel: int = 6):
+        self.path = path
+        self.compresslevel = compresslevel
+        self.sheets: list[StreamSheet] = []
+        self._tmp_dir = os.path.dirname(os.path.abspath(path)) or "."
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        self._prefix = f".{os.path.basename(path)}."
+        self.journal_path = journal_for(path)
+        self.extra: dict = {}   # datos del dueño que viajan en el journal (p.ej. hasta qué rowid)
+        self.closed = False
+
+    def add_sheet(self, name: str, table_name: str | None = None) -> StreamSheet:
+        sh = StreamSheet(name, self._tmp_dir, table_name, prefix=self._prefix)
+        self.sheets.append(sh)
+        self._write_journal()
+        return sh
+
+    @property
+    def rows(self) -> int:
+        return sum(s.rows for s in self.sheets)
+
+    @property
+    def bytes_written(self) -> int:
+        return sum(s.bytes_written for s in self.sheets)
+
+    def flush(self):
+        for s in self.sheets:
+            s.flush()
+        self._write_journal()
+
+    def _write_journal(self):
+        # temp + rename: un crash a mitad de escritura deja el journal anterior entero
+        meta = {"path": os.path.abspath(self.path), "pid": os.getpid(), "saved_at": time.time(),
+                "compresslevel": self.compresslevel, "sheets": [s.meta() for s in self.sheets],
+                "extra": self.extra}
+        tmp = self.journal_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.journal_path)
+
+    def _drop_journal(self):
+        try:
+            os.unlink(self.journal_path)
+        except OSError:
+            pass
+
+    def _write_zip(self, target: str, states: list | None = None):
+        tables = []
+        with zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED, compresslevel=self.compresslevel) as zf:
+            for i, sh in enumerate(self.sheets, start=1):
+                with zf.open(f"xl/worksheets/sheet{i}.xml", "w", force_zip64=True) as out:
+                    headers, ncols, nrows, has_table = sh.write_xml(out, None if states is None else states[i - 1])
+                if has_table:
+                    tables.append((i, sh, headers, ncols, nrows))
+
+            for n, (i, sh, headers, ncols, nrows) in enumerate(tables, start=1):
+                ref = f"A1:{col_letter(ncols)}{nrows + 1}"
+                cols = "".join(f'<tableColumn id="{k}" name="{escape(h, {chr(34): "&quot;"})}"/>'
+                               for k, h in enumerate(headers, start=1))
+                zf.writestr(f"xl/tables/table{n}.xml", (
+                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                    f'<table {_NS} id="{n}" name="{sh.table_name}" displayName="{sh.table_name}" ref="{ref}">'
+                    f'<autoFilter ref="{ref}"/><tableColumns count="{len(headers)}">{cols}</tableColumns>'
+                    '<tableStyleInfo name="TableStyleMedium2" showFirstColumn="0" showLastColumn="0" '
+                    'showRowStripes="1" showColumnStripes="0"/></table>'))
+                zf.writestr(f"xl/worksheets/_rels/sheet{i}.xml.rels", (
+                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                    f'<Relationship Id="rId1" Type="{_REL}/table" Target="../tables/table{n}.xml"/>'
+                    '</Relationships>'))
+
+            n_sheets = len(self.sheets)
+            ct_sheets = "".join(
+                f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                for i in range(1, n_sheets + 1))
+            ct_tables = "".join(
+                f'<Override PartName="/xl/tables/table{n}.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.table+xml"/>'
+                for n in range(1, len(tables) + 1))
+            zf.writestr("[Content_Types].xml", (
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                '<Default Extension="xml" ContentType="application/xml"/>'
+                '<Override PartName="/xl/workbook.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                '<Override PartName="/xl/styles.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+                f'{ct_sheets}{ct_tables}</Types>'))
+            zf.writestr("_rels/.rels", (
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                f'<Relationship Id="rId1" Type="{_REL}/officeDocument" Target="xl/workbook.xml"/>'
+                '</Relationships>'))
+            sheets_xml = "".join(
+                f'<sheet name="{escape(sh.name[:31])}" sheetId="{i}" r:id="rId{i}"/>'
+                for i, sh in enumerate(self.sheets, start=1))
+            zf.writestr("xl/workbook.xml", (
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                f'<workbook {_NS} {_NS_R}><sheets>{sheets_xml}</sheets></workbook>'))
+            rels = "".join(
+                f'<Relationship Id="rId{i}" Type="{_REL}/worksheet" Target="worksheets/sheet{i}.xml"/>'
+                for i in range(1, n_sheets + 1))
+            rels += f'<Relationship Id="rId{n_sheets + 1}" Type="{_REL}/styles" Target="styles.xml"/>'
+            zf.writestr("xl/_rels/workbook.xml.rels", (
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                f'{rels}</Relationships>'))
+            zf.writestr("xl/styles.xml", _STYLES)
+
+    def snapshot_state(self) -> list:
+        """Foto consistente (bytes/filas por hoja); tomarla con las escrituras frenadas."""
+        return [s.state() for s in self.sheets]
+
+    def snapshot(self, target: str, states: list):
+        """
+        .xlsx válido con las filas hasta 'states', armado sin tocar al escritor:
+        solo lee el prefijo ya volcado de cada hoja (que nunca se reescribe).
+        """
+        tmp = target + ".tmp"
+        try:
+            self._write_zip(tmp, states)
+            os.replace(tmp, target)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+
+    def close(self):
+        """Arma el .xlsx final (header, anchos, tabla, zip) y borra los temporales."""
+        if self.closed:
+            return
+        self.flush()
+        tmp = self.path + ".tmp"
+        try:
+            # temp + rename atómico: un download nunca ve un zip a medio escribir
+            self._write_zip(tmp)
+            os.replace(tmp, self.path)
+            self._drop_journal()   # ya publicado: journal presente <=> falta el .xlsx
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        finally:
+            self.closed = True
+            for s in self.sheets:
+                s.discard()
+            self._drop_journal()
+
+    def discard(self):
+        self.closed = True
+        for s in self.sheets:
+            s.discard()
+        self._drop_journal()
+
+def journal_for(path: str) -> str:
+    """Journal de recuperación del escritor de 'path' ('.<archivo>.journal.json' al lado)."""
+    folder, name = os.path.split(os.path.abspath(path))
+    return os.path.join(folder, f".{name}{JOURNAL_SUFFIX}")
+
+def _recovered_state(sh: StreamSheet, meta: dict) -> tuple[int, int, int]:
+    """(bytes, filas, columnas) utilizables del .part: el checkpoint del journal, o menos si el disco perdió la cola."""
+    size = os.path.getsize(sh.part)
+    if size >= meta["bytes"]:
+        return meta["bytes"], meta["rows"], meta["ncols"]
+    # el SO no llegó a bajar todo: hasta la última fila entera, contándolas
+    with open(sh.part, "rb") as f:
+        data = f.read(size)
+    end = data.rfind(b"</row>")
+    end = end + len(b"</row>") if end >= 0 else 0
+    return end, data.count(b"</row>", 0, end), meta["ncols"]
+
+def _free_path(path: str) -> str:
+    if not os.path.exists(path):
+        return path
+    root, ext = os.path.splitext(path)
+    k = 1
+    while os.path.exists(f"{root}.recovered{k}{ext}"):
+        k += 1
+    return f"{root}.recovered{k}{ext}"
+
+def recover_journal(journal_path: str, rebuild: bool = True) -> str | None:
+    """
+    Arma el .xlsx de un escritor que no llegó a close() con lo volcado hasta su
+    último checkpoint y borra journal + .part. Devuelve la ruta escrita (el path
+    original, o '<archivo>.recoveredN.xlsx' si ya existe) o None si no había filas.
+    rebuild=False solo borra (el dueño vuelve a exportar esos datos).
+    """
+    with open(journal_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    folder = os.path.dirname(journal_path)
+    w = XlsxStreamWriter.__new__(XlsxStreamWriter)
+    w.path = meta["path"]
+    w.compresslevel = meta.get("compresslevel", 6)
+    w.journal_path = journal_path
+    w.closed = True
+    w.sheets = []
+    states = []
+    for m in meta["sheets"]:
+        sh = StreamSheet(m["name"], folder, m.get("table_name"), part=os.path.join(folder, m["part"]))
+        sh.header = m["header"]
+        sh.widths = {int(k): v for k, v in m["widths"].items()}
+        sh.datetime_cols = set(m["datetime_cols"])
+        w.sheets.append(sh)
+        states.append(_recovered_state(sh, m) if os.path.exists(sh.part) else (0, 0, 0))
+    target = None
+    try:
+        if rebuild and any(rows for _, rows, _ in states):
+            target = _free_path(w.path)
+            w.snapshot(target, states)
+    finally:
+        w.discard()
+    return target
+
+def _pid_alive(pid) -> bool:
+    # ante la duda "vivo": a lo sumo se recupera en el próximo arranque
+    if not isinstance(pid, int) or pid <= 0:
+        return False
+    if pid == os.getpid():
+        return True
+    if psutil is not None:
+        return psutil.pid_exists(pid)
+    if os.name == "nt":
+        try:
+            import ctypes
+            k32 = ctypes.windll.kernel32
+            h = k32.OpenProcess(0x1000, False, pid)   # PROCESS_QUERY_LIMITED_INFORMATION
+            if not h:
+                return False
+            code = ctypes.c_ulong()
+            ok = k32.GetExitCodeProcess(h, ctypes.byref(code))
+            k32.CloseHandle(h)
+            return not ok or code.value == 259        # STILL_ACTIVE
+        except Exception:
+            return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+def recover_dir(folder: str, orphan_age_s: float = XLSX_ORPHAN_AGE_S, prefix: str = "") -> list[str]:
+    """
+    Al arrancar: recupera los escritores que murieron sin close() (ver recover_journal)
+    y borra los .sheet.part que ningún journal referencia y tienen más de
+    orphan_age_s (versiones viejas sin journal). Devuelve los .xlsx recuperados.
+    No toca journals cuyo proceso sigue vivo: la carpeta puede ser compartida
+    (logs/ la usan main.py y script_excel.py); con 'prefix' solo los archivos
+    cuyo nombre empieza así (los de otro dueño, p.ej. con manifest, no se tocan).
+    """
+    mine = "." + prefix
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return []
+    recovered, live = [], set()   # live: .part que no se tocan
+    for name in names:
+        if not (name.startswith(mine) and name.endswith(JOURNAL_SUFFIX)):
+            continue
+        jp = os.path.join(folder, name)
+        try:
+            with open(jp, encoding="utf-8") as f:
+                meta = json.load(f)
+            parts = [m["part"] for m in meta["sheets"]]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning("xlsx: journal ilegible %s: %s", jp, e)
+            continue
+        if _pid_alive(meta.get("pid")):
+            live.update(parts)
+            continue
+        try:
+            out = recover_journal(jp)
+        except Exception as e:
+            live.update(parts)   # no se pudo armar: los datos quedan para revisar a mano
+            log.warning("xlsx: no pude recuperar %s: %s", jp, e)
+            continue
+        if out:
+            recovered.append(out)
+            log.warning("xlsx: recuperado %s (grabación interrumpida, hasta su último checkpoint)", out)
+    now = time.time()
+    for name in names:
+        if not (name.startswith(mine) and name.endswith(".sheet.part")) or name in live:
+            continue
+        p = os.path.join(folder, name)
+        try:
+            if os.path.exists(p) and now - os.path.getmtime(p) > orphan_age_s:
+                os.unlink(p)
+                log.info("xlsx: borrado temporal huérfano %s", p)
+        except OSError:
+            pass
+    return recovered
@@ -0,0 +1,154 @@
+# ws/compression.py
+import itertools, json, os, time, zlib
+from fastapi import WebSocket, WebSocketDisconnect
+
+# Compresión por mensaje a nivel app (deflate crudo, RFC 1951) para /ws y /ws_write.
+#   • el cliente la pide con ?compress=deflate (o WS_COMPRESS=deflate para todos)
+#   • mensajes >= min_bytes viajan como frame BINARIO deflate; el resto, texto normal
+#   • en el navegador: new Response(blob.stream().pipeThrough(new DecompressionStream("deflate-raw")))
+# El permessage-deflate del transporte (uvicorn --ws-per-message-deflate) es otra
+# capa: si activas esta, apaga esa (WS_PERMESSAGE_DEFLATE=false) para no comprimir dos veces.
+COMPRESS_DEFAULT = os.getenv("WS_COMPRESS", "off").lower()
+COMPRESS_MIN_BYTES = int(os.getenv("WS_COMPRESS_MIN_BYTES", "512"))
+COMPRESS_LEVEL = int(os.getenv("WS_COMPRESS_LEVEL", "1"))           # 1 = barato en CPU del ctrlX
+COMPRESS_CONTEXT = os.getenv("WS_COMPRESS_CONTEXT", "false").lower() == "true"
+
+_ids = itertools.count(1)
+active: dict[int, "WsCompressor"] = {}
+
+def deflate_raw(data: bytes, level: int) -> bytes:
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush()
+
+class WsCompressor:
+    """
+    Política + medición de compresión de UN websocket.
+    Sin context takeover cada mensaje se comprime solo, así el resultado de un
+    Frame se puede cachear y compartir entre clientes; con context takeover
+    (compress=deflate-ctx) el diccionario se arrastra entre mensajes (mejor
+    ratio, el cliente debe usar un único inflater con Z_SYNC_FLUSH).
+    """
+    def __init__(self, endpoint: str, peer: str = "", mode: str = "off",
+                 level: int = COMPRESS_LEVEL, min_bytes: int = COMPRESS_MIN_BYTES,
+                 transport_offered: bool = False):
+        self.id = next(_ids)
+        self.endpoint = endpoint
+        self.peer = peer
+        self.mode = mode if mode in ("off", "deflate", "deflate-ctx") else "off"
+        self.level = max(0, min(9, level))
+        self.min_bytes = max(0, min_bytes)
+        self.transport_offered = transport_offered
+        self._ctx = zlib.compressobj(self.level, zlib.DEFLATED, -15) if self.mode == "deflate-ctx" else None
+        self._inflater = zlib.decompressobj(-15)
+
+        self.msgs_out = 0
+        self.msgs_compressed = 0
+        self.raw_bytes_out = 0
+        self.wire_bytes_out = 0
+        self.raw_bytes_in = 0
+        self.wire_bytes_in = 0
+        self.cpu_s = 0.0
+
+    @classmethod
+    def from_websocket(cls, websocket: WebSocket, endpoint: str) -> "WsCompressor":
+        qp = websocket.query_params
+        mode = (qp.get("compress") or COMPRESS_DEFAULT).lower()
+        if mode in ("1", "true", "on"):
+            mode = "deflate-ctx" if COMPRESS_CONTEXT else "deflate"
+
+        def _int(name, default):
+            try:
+                return int(qp.get(name)) if qp.get(name) not in (None, "") else default
+            except ValueError:
+                return default
+
+        peer = f"{websocket.client.host}:{websocket.client.port}" if websocket.client else ""
+        ext = (websocket.headers.get("sec-websocket-extensions") or "").lower()
+        comp = cls(endpoint, peer, mode,
+                   level=_int("level", COMPRESS_LEVEL),
+                   min_bytes=_int("min_bytes", COMPRESS_MIN_BYTES),
+                   transport_offered="permessage-deflate" in ext)
+        active[comp.id] = comp
+        return comp
+
+    def close(self):
+        active.pop(self.id, None)
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def _compress(self, data: bytes) -> bytes:
+        if self._ctx is not None:
+            out = self._ctx.compress(data) + self._ctx.flush(zlib.Z_SYNC_FLUSH)
+            return out[:-4] if out.endswith(b"\x00\x00\xff\xff") else out
+        return deflate_raw(data, self.level)
+
+    async def send_text(self, websocket: WebSocket, text: str, frame=None, flt=None):
+        """Manda 'text'; si es un Frame sin context takeover reutiliza su deflate cacheado."""
+        data = text.encode("utf-8")
+        self.msgs_out += 1
+        self.raw_bytes_out += len(data)
+        if not self.enabled or len(data) < self.min_bytes:
+            await websocket.send_text(text)
+            self.wire_bytes_out += len(data)
+            return
+
+        t0 = time.thread_time()
+        if frame is not None and self._ctx is None:
+            payload = frame.deflated(flt, self.level)
+        else:
+            payload = self._compress(data)
+        self.cpu_s += time.thread_time() - t0
+
+        await websocket.send_bytes(payload)
+        self.msgs_compressed += 1
+        self.wire_bytes_out += len(payload)
+
+    async def send_json(self, websocket: WebSocket, obj) -> None:
+        await self.send_text(websocket, json.dumps(obj, ensure_ascii=False, separators=(",", ":")))
+
+    async def receive_json(self, websocket: WebSocket):
+        """Acepta texto JSON o binario deflate crudo (mismo formato que enviamos)."""
+        msg = await websocket.receive()
+        if msg["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(msg.get("code", 1000))
+        if msg.get("bytes") is not None:
+            raw = msg["bytes"]
+            t0 = time.thread_time()
+            if self.mode == "deflate-ctx":
+                # diccionario compartido entre mensajes (trailer de sync flush recortado)
+                data = self._inflater.decompress(raw + b"\x00\x00\xff\xff")
+            else:
+                data = zlib.decompressobj(-15).decompress(raw)
+            self.cpu_s += time.thread_time() - t0
+            self.wire_bytes_in += len(raw)
+            self.raw_bytes_in += len(data)
+            return json.loads(data)
+        text = msg.get("text") or ""
+        self.wire_bytes_in += len(text)
+        self.raw_bytes_in += len(text)
+        return json.loads(text)
+
+    def stats(self) -> dict:
+        return {
+            "id": self.id,
+            "endpoint": self.endpoint,
+            "peer": self.peer,
+            "mode": self.mode,
+            "level": self.level,
+            "min_bytes": self.min_bytes,
+            "transport_deflate_offered": self.transport_offered,
+            "msgs_out": self.msgs_out,
+            "msgs_compressed": self.msgs_compressed,
+            "raw_bytes_out": self.raw_bytes_out,
+            "wire_bytes_out": self.wire_bytes_out,
+            "ratio": round(self.raw_bytes_out / self.wire_bytes_out, 2) if self.wire_bytes_out else None,
+            "raw_bytes_in": self.raw_bytes_in,
+            "wire_bytes_in": self.wire_bytes_in,
+            "cpu_ms": round(self.cpu_s * 1000.0, 2),
+            "cpu_us_per_msg": round(self.cpu_s * 1e6 / self.msgs_compressed, 1) if self.msgs_compressed else None,
+        }
+
+def status() -> list[dict]:
+    return [c.stats() for c in list(active.values())]
@@ -0,0 +1,82 @@
+# ws/frames.py
+import zlib
+from utils.fast_json import encoder
+
+class TagFilter:
+    """
+    Filtro de tags compartido por /ws, /api/stream y /api/latest.
+      tags="REAL.fast_1,BOOL.window_ready"  -> solo esas variables
+      tags="REAL"                           -> grupo completo
+    'timestamp' y '__seq__' siempre viajan.
+    """
+    __slots__ = ("key", "groups")
+
+    def __init__(self, tags: list[str]):
+        groups: dict[str, set | None] = {}
+        for t in tags:
+            g, _, name = t.partition(".")
+            if not name:
+                groups[g] = None  # grupo entero
+            elif groups.get(g, set()) is not None:
+                groups.setdefault(g, set()).add(name)
+        self.groups = groups
+        self.key = ",".join(sorted(tags))
+
+    @classmethod
+    def parse(cls, raw: str | None) -> "TagFilter | None":
+        tags = sorted({t.strip() for t in (raw or "").split(",") if t.strip()})
+        return cls(tags) if tags else None
+
+    def apply(self, sample: dict) -> dict:
+        out = {}
+        for g, names in self.groups.items():
+            v = sample.get(g)
+            if isinstance(v, dict):
+                out[g] = v if names is None else {n: v[n] for n in names if n in v}
+        for k in ("timestamp", "__seq__"):
+            if k in sample:
+                out[k] = sample[k]
+        return out
+
+class Frame:
+    """
+    Muestra + su JSON codificado UNA sola vez por filtro; lo comparten todos
+    los clientes (WS, SSE, long-poll) que piden lo mismo.
+    """
+    __slots__ = ("seq", "sample", "_enc", "_zenc")
+
+    def __init__(self, sample: dict):
+        self.seq = sample.get("__seq__")
+        self.sample = sample
+        self._enc: dict[str | None, str] = {}
+        self._zenc: dict | None = None
+
+    def text(self, flt: TagFilter | None = None) -> str:
+        key = flt.key if flt is not None else None
+        t = self._enc.get(key)
+        if t is None:
+            obj = flt.apply(self.sample) if flt is not None else self.sample
+            t = encoder.encode(obj)
+            self._enc[key] = t
+        return t
+
+    def deflated(self, flt: TagFilter | None, level: int) -> bytes:
+        # deflate crudo del mismo JSON, también cacheado (clientes sin context takeover)
+        key = (flt.key if flt is not None else None, level)
+        if self._zenc is None:
+            self._zenc = {}
+        b = self._zenc.get(key)
+        if b is None:
+            c = zlib.compressobj(level, zlib.DEFLATED, -15)
+            data = self.text(flt).encode("utf-8")
+            b = c.compress(data) + c.flush()
+            self._zenc[key] = b
+        return b
+
+def batch_text(frames: list[Frame], flt: TagFilter | None = None) -> str:
+    # arma el frame de lote pegando los JSON ya codificados (sin re-encode)
+    return (
+        f'{{"type":"batch","first_seq":{frames[0].seq},"last_seq":{frames[-1].seq},"samples":['
+        + ",".join(f.text(flt) for f in frames)
+        + "]}"
+    )
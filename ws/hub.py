@@ -0,0 +1,205 @@
+# ws/hub.py
+import asyncio, itertools, logging, os, time
+from collections import deque
+from plc.buffer import data_buffer
+from ws.frames import Frame, TagFilter
+
+log = logging.getLogger("ws.hub")
+
+HUB_TICK_MS    = float(os.getenv("WS_HUB_TICK_MS", "20"))
+QUEUE_MAX      = int(os.getenv("WS_QUEUE_MAX", "2000"))      # por cliente, modo full
+MAX_LAG_S      = float(os.getenv("WS_MAX_LAG_S", "5.0"))     # política disconnect
+FULL_POLICY    = os.getenv("WS_FULL_POLICY", "drop_oldest").lower()
+LATEST_POLICY  = os.getenv("WS_LATEST_POLICY", "conflate").lower()
+
+POLICIES = ("conflate", "drop_oldest", "disconnect")
+
+class ClientChannel:
+    """
+    Cola de salida acotada de UN cliente. El hub solo hace offer() (nunca await),
+    así un socket lento no frena al resto:
+      • conflate:    se queda con la última muestra (cola de 1)
+      • drop_oldest: cola acotada; al desbordar tira la más vieja (y avisa gap)
+      • disconnect:  cola acotada; si desborda o el lag pasa MAX_LAG_S -> se echa
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, mode: str, policy: str, maxlen: int = QUEUE_MAX,
+                 max_lag_s: float = MAX_LAG_S, peer: str = "", tag_filter: TagFilter | None = None):
+        if policy not in POLICIES:
+            raise ValueError(f"policy inválida: {policy}")
+        self.id = next(self._ids)
+        self.mode = mode
+        self.policy = policy
+        self.maxlen = 1 if policy == "conflate" else max(1, maxlen)
+        self.max_lag_s = max_lag_s
+        self.peer = peer
+        self.tag_filter = tag_filter
+        self.connected_at = time.time()
+
+        self._q: deque = deque()          # (t_enqueue, Frame)
+        self._event = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.compressor = None            # ws.compression.WsCompressor (solo /ws)
+        self.kicked: str | None = None
+
+        self.last_sent_seq = None
+        self.sent = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.queue_peak = 0
+        self.send_s_last = 0.0
+        self.send_s_max = 0.0
+        self._gap: list[int] | None = None  # [from, to] descartado por drop_oldest
+
+    # --- lado hub (sin await) ---
+    def offer(self, frame: Frame):
+        if self.kicked:
+            return
+        now = time.monotonic()
+        if len(self._q) >= self.maxlen:
+            if self.policy == "conflate":
+                self._q.clear()
+                self.conflated += 1
+            elif self.policy == "drop_oldest":
+                _, old = self._q.popleft()
+                self.dropped += 1
+                seq = old.seq
+                if seq is not None:
+                    if self._gap is None:
+                        self._gap = [seq, seq]
+                    else:
+                        self._gap[1] = seq
+            else:
+                self.kick("queue llena")
+                return
+        self._q.append((now, frame))
+        self.queue_peak = max(self.queue_peak, len(self._q))
+        self._event.set()
+
+        if self.policy == "disconnect" and self.lag_s(now) > self.max_lag_s:
+            self.kick(f"lag > {self.max_lag_s:.1f}s")
+
+    def kick(self, reason: str):
+        if self.kicked:
+            return
+        self.kicked = reason
+        self._q.clear()
+        log.warning("WS cliente #%s (%s) desconectado por backpressure: %s", self.id, self.peer, reason)
+        # cancela el envío aunque esté bloqueado en un send lento
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    def lag_s(self, now: float | None = None) -> float:
+        if not self._q:
+            return 0.0
+        return (now or time.monotonic()) - self._q[0][0]
+
+    # --- lado cliente ---
+    async def wait(self, timeout: float | None = None):
+        if self._q:
+            return
+        self._event.clear()
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def take(self, max_items: int | None = None) -> list[Frame]:
+        n = len(self._q) if max_items is None else min(max_items, len(self._q))
+        return [self._q.popleft()[1] for _ in range(n)]
+
+    def take_gap(self) -> list[int] | None:
+        gap, self._gap = self._gap, None
+        return gap
+
+    def mark_sent(self, frames: list[Frame], dt: float):
+        if frames:
+            self.last_sent_seq = frames[-1].seq
+        self.sent += len(frames)
+        self.send_s_last = dt
+        self.send_s_max = max(self.send_s_max, dt)
+
+    def status(self, hub_seq: int) -> dict:
+        return {
+            "id": self.id,
+            "peer": self.peer,
+            "mode": self.mode,
+            "policy": self.policy,
+            "tags": self.tag_filter.key if self.tag_filter else None,
+            "connected_at": self.connected_at,
+            "queue_len": len(self._q),
+            "queue_max": self.maxlen,
+            "queue_peak": self.queue_peak,
+            "lag_s": round(self.lag_s(), 3),
+            "lag_seq": (hub_seq - self.last_sent_seq) if self.last_sent_seq is not None else None,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "conflated": self.conflated,
+            "send_ms_last": round(self.send_s_last * 1000.0, 2),
+            "send_ms_max": round(self.send_s_max * 1000.0, 2),
+            "kicked": self.kicked,
+            "compression": self.compressor.stats() if self.compressor else None,
+        }
+
+class StreamHub:
+    """
+    Fan-out único: una sola tarea lee el DataBuffer y reparte a las colas
+    de cada cliente. Arranca con el primer cliente y se apaga con el último.
+    """
+    def __init__(self, buffer, tick_s: float = HUB_TICK_MS / 1000.0):
+        self.buffer = buffer
+        self.tick_s = tick_s
+        self.clients: dict[int, ClientChannel] = {}
+        self.last_seq = 0
+        self.latest: Frame | None = None
+        self._task: asyncio.Task | None = None
+
+    def register(self, ch: ClientChannel) -> int:
+        """Registra y devuelve el seq a partir del cual el hub le entrega muestras."""
+        if not self.clients:
+            _, self.last_seq = self.buffer.seq_range()
+        self.clients[ch.id] = ch
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._pump())
+        return self.last_seq
+
+    def unregister(self, ch: ClientChannel):
+        self.clients.pop(ch.id, None)
+
+    async def _pump(self):
+        while self.clients:
+            try:
+                samples = self.buffer.after(self.last_seq)
+                if samples:
+                    # cada muestra se envuelve una vez; su JSON se cachea en el Frame
+                    frames = [Frame(s) for s in samples]
+                    self.last_seq = frames[-1].seq
+                    self.latest = frames[-1]
+                    for ch in list(self.clients.values()):
+                        if ch.policy == "conflate":
+                            ch.conflated += len(frames) - 1
+                            ch.offer(frames[-1])
+                        else:
+                            for f in frames:
+                                ch.offer(f)
+            except Exception as e:
+                log.exception("StreamHub pump: %s", e)
+            await asyncio.sleep(self.tick_s)
+
+    def latest_frame(self) -> Frame | None:
+        # reusa el Frame del pump si es el último; si no (hub parado) envuelve el del buffer
+        sample = self.buffer.latest()
+        if sample is None:
+            return None
+        if self.latest is None or self.latest.seq != sample.get("__seq__"):
+            self.latest = Frame(sample)
+        return self.latest
+
+    def status(self) -> dict:
+        return {
+            "last_seq": self.last_seq,
+            "clients": [ch.status(self.last_seq) for ch in self.clients.values()],
+        }
+
+hub = StreamHub(data_buffer)
@@ -0,0 +1,158 @@
+# ws/sse_endpoint.py
+import asyncio, json, time, logging, os
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from plc.buffer import data_buffer
+from ws.hub import hub, ClientChannel, POLICIES, FULL_POLICY, LATEST_POLICY, QUEUE_MAX, MAX_LAG_S
+from ws.frames import Frame, TagFilter
+
+log = logging.getLogger("ws.sse")
+
+# mismos frames (JSON codificado una vez) que /ws, para paneles/proxies sin WebSocket
+SSE_INTERVAL_MS = float(os.getenv("SSE_INTERVAL_MS", "200"))   # modo latest
+SSE_KEEPALIVE_S = float(os.getenv("SSE_KEEPALIVE_S", "15"))
+LONGPOLL_MAX_S  = float(os.getenv("LONGPOLL_MAX_S", "30"))
+
+def _int_param(request: Request, name: str) -> int | None:
+    raw = request.query_params.get(name)
+    if raw is None or raw == "":
+        return None
+    try:
+        return int(raw)
+    except ValueError:
+        return None
+
+def _peer(request: Request) -> str:
+    return f"{request.client.host}:{request.client.port}" if request.client else ""
+
+def _event(frame: Frame, flt: TagFilter | None) -> str:
+    return f"id: {frame.seq}\nevent: sample\ndata: {frame.text(flt)}\n\n"
+
+async def sse_stream(request: Request) -> StreamingResponse:
+    """
+    GET /api/stream?tags=&mode=latest|full
+      • latest: última muestra cada SSE_INTERVAL_MS (conflate)
+      • full:   cada muestra; reanuda con Last-Event-ID (o ?resume_from=) desde el buffer
+    """
+    mode = (request.query_params.get("mode") or "latest").lower()
+    policy = (request.query_params.get("policy") or "").lower()
+    if policy not in POLICIES:
+        policy = FULL_POLICY if mode == "full" else LATEST_POLICY
+    flt = TagFilter.parse(request.query_params.get("tags"))
+
+    resume_from = _int_param(request, "resume_from")
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        resume_from = int(last_event_id)
+
+    ch = ClientChannel(f"sse-{mode}", policy, maxlen=_int_param(request, "queue_max") or QUEUE_MAX,
+                       max_lag_s=MAX_LAG_S, peer=_peer(request), tag_filter=flt)
+    hub_seq = hub.register(ch)
+
+    async def gen():
+        try:
+            # el navegador reintenta solo; 'retry' en ms
+            yield "retry: 2000\n\n"
+            last_ping = time.monotonic()
+
+            if mode == "full" and resume_from is not None and 0 <= resume_from < hub_seq:
+                last_seq = resume_from
+                while last_seq < hub_seq:
+                    oldest, _ = data_buffer.seq_range()
+                    if oldest is not None and last_seq + 1 < oldest:
+                        to = min(oldest - 1, hub_seq)
+                        gap = {"from": last_seq + 1, "to": to, "lost": to - last_seq}
+                        yield f"event: gap\ndata: {json.dumps(gap)}\n\n"
+                        last_seq = to
+                        continue
+                    samples = data_buffer.after(last_seq, limit=min(500, hub_seq - last_seq))
+                    if not samples:
+                        break
+                    frames = [Frame(s) for s in samples]
+                    yield "".join(_event(f, flt) for f in frames)
+                    ch.mark_sent(frames, 0.0)
+                    last_seq = frames[-1].seq
+
+            while not ch.kicked:
+                await ch.wait(timeout=1.0)
+                if await request.is_disconnected():
+                    break
+
+                gap = ch.take_gap()
+                if gap:
+                    yield f"event: gap\ndata: {json.dumps({'from': gap[0], 'to': gap[1], 'lost': gap[1] - gap[0] + 1})}\n\n"
+
+                frames = ch.take()
+                if frames:
+                    if mode != "full":
+                        frames = frames[-1:]
+                    t0 = time.perf_counter()
+                    yield "".join(_event(f, flt) for f in frames)
+                    ch.mark_sent(frames, time.perf_counter() - t0)
+                    last_ping = time.monotonic()
+                elif time.monotonic() - last_ping >= SSE_KEEPALIVE_S:
+                    yield ": ping\n\n"
+                    last_ping = time.monotonic()
+
+                if mode != "full":
+                    await asyncio.sleep(SSE_INTERVAL_MS / 1000.0)
+        finally:
+            hub.unregister(ch)
+
+    return StreamingResponse(gen(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # que nginx/reverse proxy no lo bufferee
+    })
+
+def _etag_seq(raw: str | None) -> int | None:
+    if not raw:
+        return None
+    v = raw.strip()
+    if v.startswith("W/"):
+        v = v[2:]
+    v = v.strip('"')
+    return int(v) if v.isdigit() else None
+
+async def latest_longpoll(request: Request) -> Response:
+    """
+    GET /api/latest?after_seq=&tags=&timeout=
+    Devuelve la última muestra si su seq > after_seq (o If-None-Match); si no,
+    espera hasta 'timeout' s una nueva. ETag = seq. Sin novedades -> 304 (o 204).
+    """
+    flt = TagFilter.parse(request.query_params.get("tags"))
+    inm = _etag_seq(request.headers.get("if-none-match"))
+    after_seq = _int_param(request, "after_seq")
+    if after_seq is None:
+        after_seq = inm
+    try:
+        timeout = float(request.query_params.get("timeout") or 25.0)
+    except ValueError:
+        timeout = 25.0
+    timeout = max(0.0, min(timeout, LONGPOLL_MAX_S))
+
+    frame = hub.latest_frame()
+    if after_seq is not None and (frame is None or frame.seq <= after_seq) and timeout > 0:
+        ch = ClientChannel("longpoll", "conflate", peer=_peer(request), tag_filter=flt)
+        hub.register(ch)
+        try:
+            deadline = time.monotonic() + timeout
+            while (left := deadline - time.monotonic()) > 0:
+                await ch.wait(timeout=left)
+                frames = ch.take()
+                if frames and frames[-1].seq > after_seq:
+                    frame = frames[-1]
+                    ch.mark_sent(frames, 0.0)
+                    break
+        finally:
+            hub.unregister(ch)
+
+    if frame is None or (after_seq is not None and frame.seq <= after_seq):
+        headers = {"Cache-Control": "no-cache"}
+        if after_seq is not None:
+            headers["ETag"] = f'"{after_seq}"'
+        return Response(status_code=304 if inm is not None else 204, headers=headers)
+
+    return Response(frame.text(flt), media_type="application/json", headers={
+        "ETag": f'"{frame.seq}"',
+        "Cache-Control": "no-cache",
+    })
@@ -1,35 +1,135 @@
-import asyncio, json, time, logging
+import asyncio, json, time, logging, os
 from fastapi import WebSocket, WebSocketDisconnect
 from plc.buffer import data_buffer
+from ws.hub import hub, ClientChannel, POLICIES, FULL_POLICY, LATEST_POLICY, QUEUE_MAX, MAX_LAG_S
+from ws.frames import Frame, TagFilter, batch_text
+from ws.compression import WsCompressor
 
 log = logging.getLogger("ws")
 
+# modo "full": todas las muestras desde el último seq, en frames por lotes
+FULL_BATCH_MS  = float(os.getenv("WS_FULL_BATCH_MS", "100"))
+FULL_MAX_BATCH = int(os.getenv("WS_FULL_MAX_BATCH", "500"))
+
+def _int_param(websocket: WebSocket, name: str) -> int | None:
+    raw = websocket.query_params.get(name)
+    if raw is None or raw == "":
+        return None
+    try:
+        return int(raw)
+    except ValueError:
+        return None
+
+async def _send_timed(websocket: WebSocket, ch: ClientChannel, text: str, frames: list[Frame],
+                      frame: Frame | None = None):
+    t0 = time.perf_counter()
+    await ch.compressor.send_text(websocket, text, frame=frame, flt=ch.tag_filter)
+    ch.mark_sent(frames, time.perf_counter() - t0)
+
+async def _stream_latest(websocket: WebSocket, ch: ClientChannel):
+    while True:
+        await ch.wait(timeout=1.0)
+        frames = ch.take()
+        if frames:
+            frame = frames[-1]
+
+            # ✅ enviar a UI (JSON ya codificado y compartido entre clientes)
+            await _send_timed(websocket, ch, frame.text(ch.tag_filter), [frame], frame=frame)
+
+        await asyncio.sleep(0.2)  # 5 Hz para UI
+
+async def _stream_full(websocket: WebSocket, ch: ClientChannel, hub_seq: int):
+    """
+    Sin pérdidas: manda TODAS las muestras con seq > last_seq en frames
+      {"type":"batch","first_seq":a,"last_seq":b,"samples":[...]}
+    Con ?resume_from=<seq> rellena el hueco desde el buffer; lo que ya no está
+    (o lo que la cola del cliente tuvo que descartar) se avisa con
+      {"type":"gap","from":x,"to":y,"lost":n}.
+    """
+    batch_ms = _int_param(websocket, "batch_ms")   # 0 explícito = sin espera entre lotes
+    batch_s = max(0.0, (FULL_BATCH_MS if batch_ms is None else batch_ms) / 1000.0)
+    max_batch = max(1, _int_param(websocket, "max_batch") or FULL_MAX_BATCH)
+    resume_from = _int_param(websocket, "resume_from")
+
+    oldest, newest = data_buffer.seq_range()
+    if resume_from is None or resume_from < 0 or resume_from >= hub_seq:
+        last_seq = hub_seq  # arranca en vivo (lo nuevo llega por la cola del hub)
+        if resume_from is not None and resume_from > newest:
+            # el backend reinició (seq volvió a 0): no hay forma de empalmar
+            await ch.compressor.send_json(websocket, {"type": "reset", "resume_from": resume_from, "last_seq": newest})
+    else:
+        last_seq = resume_from
+
+    await ch.compressor.send_json(websocket, {
+        "type": "hello", "mode": "full", "policy": ch.policy, "compress": ch.compressor.mode,
+        "resume_from": resume_from,
+        "oldest_seq": oldest, "last_seq": newest,
+    })
+
+    # 1) back-fill desde el buffer hasta donde el hub empezó a encolar
+    while last_seq < hub_seq:
+        oldest, _ = data_buffer.seq_range()
+        if oldest is not None and last_seq + 1 < oldest:
+            # el buffer ya rotó esas muestras -> irrecuperables
+            to = min(oldest - 1, hub_seq)
+            await ch.compressor.send_json(websocket, {"type": "gap", "from": last_seq + 1, "to": to, "lost": to - last_seq})
+            last_seq = to
+            continue
+        samples = data_buffer.after(last_seq, limit=min(max_batch, hub_seq - last_seq))
+        if not samples:
+            break
+        await _send_batch(websocket, ch, [Frame(s) for s in samples])
+        last_seq = samples[-1]["__seq__"]
+
+    # 2) en vivo desde la cola acotada del cliente
+    while True:
+        await ch.wait(timeout=1.0)
+        gap = ch.take_gap()
+        if gap:
+            await ch.compressor.send_json(websocket, {"type": "gap", "from": gap[0], "to": gap[1], "lost": gap[1] - gap[0] + 1})
+        frames = ch.take(max_batch)
+        if frames:
+            await _send_batch(websocket, ch, frames)
+            if len(frames) >= max_batch:
+                continue  # poniéndose al día: no dormir
+
+        await asyncio.sleep(batch_s)
+
+async def _send_batch(websocket: WebSocket, ch: ClientChannel, frames: list[Frame]):
+    await _send_timed(websocket, ch, batch_text(frames, ch.tag_filter), frames)
+
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     print("[WS] cliente conectado")
 
+    mode = (websocket.query_params.get("mode") or "latest").lower()
+    policy = (websocket.query_params.get("policy") or "").lower()
+    if policy not in POLICIES:
+        policy = FULL_POLICY if mode == "full" else LATEST_POLICY
+    peer = f"{websocket.client.host}:{websocket.client.port}" if websocket.client else ""
+    ch = ClientChannel(mode, policy,
+                       maxlen=_int_param(websocket, "queue_max") or QUEUE_MAX,
+                       max_lag_s=MAX_LAG_S, peer=peer,
+                       tag_filter=TagFilter.parse(websocket.query_params.get("tags")))
+    ch.compressor = WsCompressor.from_websocket(websocket, "/ws")
+    hub_seq = hub.register(ch)
+
+    if mode == "full":
+        ch.task = asyncio.ensure_future(_stream_full(websocket, ch, hub_seq))
+    else:
+        ch.task = asyncio.ensure_future(_stream_latest(websocket, ch))
+
     try:
-        last_seq = None
-
-        while True:
-            sample = data_buffer.latest()
-            if sample:
-                seq = sample.get("__seq__")
-                if seq != last_seq:
-                    # ✅ enviar a export RT también
-                    try:
-                        export_mgr = getattr(websocket.app.state, "export_mgr", None)
-                        if export_mgr is not None:
-                            export_mgr.ingest(sample)
-                    except Exception as e:
-                        log.exception("Error export_mgr.ingest en ws_endpoint: %s", e)
-
-                    # ✅ enviar a UI
-                    await websocket.send_json(sample)
-                    last_seq = seq
-
-            await asyncio.sleep(0.2)  # 5 Hz para UI
+        await ch.task
 
+    except asyncio.CancelledError:
+        if not ch.kicked:
+            raise
+        # echado por backpressure: 1013 = try again later
+        try:
+            await asyncio.wait_for(websocket.close(code=1013, reason=ch.kicked[:120]), 1.0)
+        except Exception:
+            pass
     except WebSocketDisconnect:
         print("[WS] cliente desconectado")
     except Exception as e:
@@ -37,4 +137,9 @@ async def websocket_endpoint(websocket: WebSocket):
         try:
             await websocket.close()
         except:
-            pass
\ No newline at end of file
+            pass
+    finally:
+        hub.unregister(ch)
+        ch.compressor.close()
+        if not ch.task.done():
+            ch.task.cancel()
@@ -1,53 +1,79 @@
 # ws/ws_write_endpoint.py
-from fastapi import WebSocket
-from opcua import Client, ua
-from plc.opc_client import PLCReader  # Usa el mismo browse_by_names, etc.
+from fastapi import WebSocket, WebSocketDisconnect
+from starlette.concurrency import run_in_threadpool
+from opcua import ua
+from plc.session_pool import opc_pool, parse_write_items, write_scheduler
+from ws.compression import WsCompressor
 
-# Debes reutilizar los mismos datos de conexión de main.py, así que puedes importarlos, o pasarlos como parámetro si lo refactorizas más
-
-URL = "opc.tcp://192.168.17.60:4840"
-USER = "boschrexroth"
-PASSWORD = "boschrexroth"
+# Escrituras por la sesión OPC UA compartida del login (/api/opcua/login):
+# una conexión autenticada + índice nombre -> NodeId/DataType, armado una vez.
+#   {"variable": "x", "value": 1}                        -> una variable
+#   {"id": 7, "writes": [{"variable":..,"value":..}, ..]} -> lote en un solo Write,
+#       responde {"id", "status", "ok", "ms", "results": [{variable, status, code}]}
+# Con ?coalesce=1 (o "coalesce": true en el mensaje) el valor va al WriteScheduler:
+# latest-wins por tag, flush a WRITE_MAX_HZ fuera del event loop; ack solo si trae "id".
 
 async def websocket_write_endpoint(websocket: WebSocket):
     await websocket.accept()
-    # OPC UA client SOLO para este endpoint de escritura (puedes optimizar esto después)
-    cli = Client(URL)
-    cli.set_user(USER)
-    cli.set_password(PASSWORD)
-    cli.connect()
+    comp = WsCompressor.from_websocket(websocket, "/ws_write")
     try:
-        # Reutiliza el método browse_by_names de tu clase
-        reader = PLCReader(URL, USER, PASSWORD, [])
-        root = cli.get_root_node()
-        plc_prg = reader.browse_by_names(
-            root, "Objects", "Datalayer", "plc", "app", "Application", "sym", "PLC_PRG"
-        )
+        session = opc_pool.current()
+        if session is None:
+            await comp.send_json(websocket, {"status": "error", "msg": "Primero haz login en /api/opcua/login"})
+            await websocket.close()
+            return
+        # conecta + indexa fuera del event loop (solo la primera vez del pool)
+        await run_in_threadpool(session.ensure)
+
+        coalesce_all = websocket.query_params.get("coalesce", "").lower() in ("1", "true")
         while True:
-            msg = await websocket.receive_json()
+            msg = await comp.receive_json(websocket)
+            if isinstance(msg, dict) and (coalesce_all or msg.get("coalesce")):
+                try:
+                    items = (parse_write_items(msg["writes"]) if "writes" in msg
+                             else parse_write_items([msg]))
+                except ValueError as e:
+                    await comp.send_json(websocket, {"status": "error", "msg": str(e), "id": msg.get("id")})
+                    continue
+                for name, value in items:
+                    write_scheduler.submit(name, value)
+                if "id" in msg:
+                    await comp.send_json(websocket, {"status": "queued", "id": msg["id"], "n": len(items)})
+                continue
+
+            if isinstance(msg, dict) and isinstance(msg.get("writes"), list):
+                # lote: {"id":..,"writes":[{"variable":..,"value":..},..]} -> un solo Write
+                try:
+                    out = await run_in_threadpool(session.write_many, parse_write_items(msg["writes"]))
+                except Exception as e:
+                    out = {"ok": False, "msg": str(e), "results": []}
+                out["status"] = "ok" if out["ok"] else "error"
+                if "id" in msg:
+                    out["id"] = msg["id"]
+                await comp.send_json(websocket, out)
+                continue
+
             var_name = msg.get("variable")
             value = msg.get("value")
             if not var_name:
-                await websocket.send_json({"status": "error", "msg": "No variable name"})
+                await comp.send_json(websocket, {"status": "error", "msg": "No variable name"})
                 continue
 
-            for ch in plc_prg.get_children():
-                if ch.get_browse_name().Name == var_name:
-                    # Aquí puedes usar VariantType según el tipo, ej: BOOL o REAL
-                    if isinstance(value, bool):
-                        ch.set_value(value, ua.VariantType.Boolean)
-                    elif isinstance(value, float):
-                        ch.set_value(value, ua.VariantType.Float)
-                    elif isinstance(value, int):
-                        ch.set_value(value, ua.VariantType.Int16)
-                    else:
-                        await websocket.send_json({"status": "error", "msg": "Tipo de valor no soportado"})
-                        break
-                    await websocket.send_json({"status": "ok", "msg": f"{var_name} actualizado"})
-                    break
-            else:
-                await websocket.send_json({"status": "error", "msg": "Variable no encontrada"})
+            try:
+                ms = await run_in_threadpool(session.write, var_name, value)
+            except KeyError:
+                await comp.send_json(websocket, {"status": "error", "msg": "Variable no encontrada"})
+                continue
+            except ValueError as e:
+                await comp.send_json(websocket, {"status": "error", "msg": str(e)})
+                continue
+            except ua.UaError as e:
+                await comp.send_json(websocket, {"status": "error", "msg": f"{var_name}: {e}"})
+                continue
+            await comp.send_json(websocket, {"status": "ok", "msg": f"{var_name} actualizado", "ms": round(ms, 2)})
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
         print("Error en escritura:", e)
     finally:
-        cli.disconnect()
+        comp.close()